@@ -19,6 +19,11 @@ def _override_model_defaults():
     Server.freq_scale_min = conf.freq_scale_min
     Server.freq_scale_delta = conf.freq_scale_delta
     Server.freq_scale_digits = conf.freq_scale_digits
+    # set the State implementation used by the cloud model
+    Cloud.state_class = state_engines[conf.state_engine]
+    # set how often the cloud keeps checkpoints of the real state
+    Cloud.checkpoint_interval = conf.checkpoint_interval
+    Cloud.max_checkpoints = conf.max_checkpoints
     # TODO: also set Server.resource_types
 
 
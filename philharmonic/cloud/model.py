@@ -8,7 +8,13 @@ Created on Jul 11, 2013
 
 import copy
 import itertools
-from philharmonic.utils import deprecated, CommonEqualityMixin
+from functools import lru_cache
+from collections.abc import Mapping
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+
+import numpy as np
+from philharmonic.utils import deprecated
 from philharmonic.cloud import visualiser
 
 
@@ -38,16 +44,21 @@ class MachineMeta(type):
     @property
     def weights(cls):
         """weights class property - only calculate on the 1st call
-        from cls.resource_types
+        (or after changing the resources) from cls.resource_types
         """
-        if cls._weights is None:
+        if (cls._weights is None or
+                set(cls._weights) != set(cls.resource_types)):
             uniform_weight = 1. / len(cls.resource_types)
             cls._weights = {r: uniform_weight for r in cls.resource_types}
         return cls._weights
 
 
 class Machine(metaclass=MachineMeta):
+    __slots__ = ('id', 'spec', 'vec', 'cloud')
+    # any number of resources can be used (e.g. add 'disk IO', 'GPUs')
     resource_types = ['RAM', '#CPUs']  # can be overridden
+    # the resource holding the number of CPU cores (multicore model)
+    core_resource = '#CPUs'
     _weights = None
 
     def __init__(self, *args):
@@ -55,6 +66,28 @@ class Machine(metaclass=MachineMeta):
         self.spec = {}
         for (i, arg) in enumerate(args):
             self.spec[self.resource_types[i]] = arg
+        self.vec = self.resource_vector(self.spec)
+
+    @classmethod
+    def resource_vector(cls, spec):
+        """The float32 row of the amounts in spec, one per resource type."""
+        return np.array([spec.get(r, 0) for r in cls.resource_types],
+                        dtype=np.float32)
+
+    def __getstate__(self):
+        return {name: getattr(self, name)
+                for cls in type(self).__mro__
+                for name in getattr(cls, '__slots__', ())
+                if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple): # (__dict__, slots) of the default pickling
+            state = dict(state[0] or {}, **(state[1] or {}))
+        for name, value in state.items():
+            if name not in ('res', 'cap'): # these are aliases of spec
+                setattr(self, name, value)
+        if not hasattr(self, 'vec'): # pickled before there were vectors
+            self.vec = self.resource_vector(self.spec)
 
     def __str__(self):
         return self.__repr__()
@@ -95,16 +128,21 @@ def _delegate_to_obj(obj, method_name, *args):
 
 class VM(Machine):
 
+    __slots__ = ('price', 'beta')
     machine_type = 'VM'
     _new_id = itertools.count(start=1).__next__
 
     def __init__(self, *args):
         super(VM, self).__init__(*args)
-        self.res = self.spec
         self.price = 0.026  # $/h - default price Amazon US East t2.small
         # beta or CPU-boundedness: 1. CPU-bounded, towards 0. not CPU-bounded
         self.beta = 1.
 
+    @property
+    def res(self):
+        """The VM's resource requirements."""
+        return self.spec
+
     def __repr__(self):
         s = "{}:{}".format(self.machine_type, str(self.id))
         try:
@@ -156,6 +194,7 @@ class VM(Machine):
 class Server(Machine):
     """A physical server."""
 
+    __slots__ = ('_loc',)
     machine_type = 'PM'
     _new_id = itertools.count(start=1).__next__
     # freq_scale parameters can be overridden
@@ -168,10 +207,14 @@ class Server(Machine):
     def __init__(self, *args, **kwargs):
         """@param location: server's geographical location"""
         super(Server, self).__init__(*args)
-        self.cap = self.spec
         if 'location' in kwargs:
             self._loc = kwargs['location']
 
+    @property
+    def cap(self):
+        """The server's resource capacities."""
+        return self.spec
+
     def get_location(self):
         return self._loc
 
@@ -196,6 +239,84 @@ class Server(Machine):
 # ==========
 
 
+def _weight_vector(weights):
+    """The resource weights dict as a vector (in resource_types order)."""
+    return np.array([weights[r] for r in Machine.resource_types])
+
+def resource_key(vec):
+    """A sort key for a resource vector (e.g. free capacity or VM size).
+    The resources are compared in the reverse order of resource_types
+    (#CPUs before RAM by default)."""
+    return tuple(vec[::-1].tolist())
+
+
+class _Resources(Mapping):
+    """Read-only {resource: amount} view of a resource vector."""
+    __slots__ = ('vec',)
+
+    def __init__(self, vec):
+        self.vec = vec
+
+    def __getitem__(self, r):
+        try:
+            return self.vec[Machine.resource_types.index(r)].item()
+        except ValueError:
+            raise KeyError(r)
+
+    def __iter__(self):
+        return iter(Machine.resource_types)
+
+    def __len__(self):
+        return len(Machine.resource_types)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _FreeCapMap(Mapping):
+    """Read-only server -> {resource: free capacity} view of a State."""
+    __slots__ = ('_vecs',)
+
+    def __init__(self, vecs):
+        self._vecs = vecs
+
+    def __getitem__(self, s):
+        return _Resources(self._vecs[s])
+
+    def __iter__(self):
+        return iter(self._vecs)
+
+    def __len__(self):
+        return len(self._vecs)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+_MASK64 = (1 << 64) - 1
+
+@lru_cache(maxsize=1 << 16)
+def _zobrist(*ints):
+    """A pseudo-random 64-bit key for a tuple of ints (splitmix64 based,
+    so the keys are the same in every process)."""
+    h = 0
+    for i in ints:
+        h = (h ^ (i & _MASK64)) + 0x9E3779B97F4A7C15 & _MASK64
+        h = (h ^ (h >> 30)) * 0xBF58476D1CE4E5B9 & _MASK64
+        h = (h ^ (h >> 27)) * 0x94D049BB133111EB & _MASK64
+        h ^= h >> 31
+    return h
+
+def _alloc_key(vm, server):
+    """Zobrist key of vm being allocated to server."""
+    return _zobrist(0, vm.id, server.id)
+
+def _freq_key(server, freq_scale):
+    """Zobrist key of server running at freq_scale."""
+    level = int(round(freq_scale * 10**Server.freq_scale_digits))
+    return _zobrist(1, server.id, level)
+
+
 class State:
     """The state of the cloud at a single moment. Various methods like migrate,
     pause... for changing it."""
@@ -210,11 +331,16 @@ class State:
         # When adding new properties also change:
         # - the copy method
         # - the limit_to_server method
+        # - the _own method (if it's a per-server container)
         self.servers = servers
         self.vms = vms
         self._alloc = {} # servers -> allocated machines
-        # servers -> remaining free capacity
-        self.free_cap = {s: copy.copy(s.cap) for s in servers}
+        self._vm_host = {} # reverse of _alloc: VM -> its server
+        # servers -> remaining free capacity (resource vectors)
+        self._free_vecs = {s: s.vec.copy() for s in servers}
+        # servers whose alloc set and free capacity are not shared with
+        # any copy of this state (see copy and _own)
+        self._owned = set(servers)
         # server capacities in a handy DataFrame for further calculations
         self.cap_df = pd.DataFrame({s: s.cap for s in self.servers})
         self.paused = set()  # those VMs that are paused
@@ -223,6 +349,9 @@ class State:
         self.freq_scale = {s: 1. for s in servers}
         for s in self.servers:
             self._alloc[s] = set()
+        # running aggregates kept up to date by place/remove (see
+        # _update_aggregates) and the fingerprint
+        self._init_aggregates()
         if auto_allocate:
             self.auto_allocate()
 
@@ -242,11 +371,59 @@ class State:
         # - make dictionary read only
         return self._alloc
 
-    def _copy_alloc(self, other_alloc):
-        """Copy other_alloc to your own alloc."""
-        self._alloc = {}
-        for s, vms in other_alloc.items():
-            self.alloc[s] = set(vms)  # create a new set
+    @property
+    def free_cap(self):
+        """A dict-like view giving for every server its remaining free
+        capacity as a {resource: amount} mapping."""
+        return _FreeCapMap(self._free_vecs)
+
+    def free_vector(self, s):
+        """The free capacity of server s as a resource vector."""
+        return self._free_vecs[s]
+
+    def _own(self, s):
+        """Copy-on-write: make sure the alloc set and free capacity of
+        server s are not shared with another state before changing them."""
+        if s not in self._owned:
+            self._alloc[s] = set(self._alloc[s])
+            self._free_vecs[s] = self._free_vecs[s].copy()
+            self._owned.add(s)
+
+    @property
+    def fingerprint(self):
+        """A 64-bit hash of the allocation and the frequency scales, equal
+        for states that reached the same allocation in different ways (up
+        to very unlikely collisions). Updated incrementally by every change
+        (Zobrist hashing), so reading it costs O(1)."""
+        return self._fingerprint
+
+    def _init_aggregates(self):
+        """Calculate the running aggregates and the fingerprint from
+        scratch."""
+        self._utils = {} # servers -> basic utilisation (default weights)
+        self._overcap = {} # overcapacitated servers -> overcap ratio
+        fingerprint = 0
+        for s in self.servers:
+            self._update_aggregates(s)
+            fingerprint ^= _freq_key(s, self.freq_scale[s])
+            for vm in self._alloc[s]:
+                fingerprint ^= _alloc_key(vm, s)
+        self._fingerprint = fingerprint
+
+    def _update_aggregates(self, s):
+        """Recalculate the aggregates of server s after its free capacity
+        changed - O(resources) instead of O(servers + VMs) when reading
+        them."""
+        free = self._free_vecs[s]
+        used = np.divide(s.vec - free, s.vec, dtype=float)
+        self._utils[s] = float(np.minimum(used, 1).dot(
+            _weight_vector(Machine.weights)))
+        over = free < 0
+        if over.any():
+            ratios = np.divide(-free[over], s.vec[over], dtype=float)
+            self._overcap[s] = float(ratios.max())
+        else:
+            self._overcap.pop(s, None)
 
     def auto_allocate(self):
         """Place all VMs on the first server."""
@@ -258,24 +435,44 @@ class State:
     def place(self, vm, s):
         """Change current state to have vm on server s."""
         if vm not in self._alloc[s]:
+            self._log_undo('_unplace', vm, s, self._vm_host.get(vm))
+            self._own(s)
             self._alloc[s].add(vm)
-            for r in s.resource_types:  # update free capacity
-                self.free_cap[s][r] -= vm.res[r]
+            self._vm_host[vm] = s
+            self._fingerprint ^= _alloc_key(vm, s)
+            self._free_vecs[s] -= vm.vec # update free capacity
+            self._update_aggregates(s)
         return self
 
 
     def remove(self, vm, s):
         """Change current state to not have vm on server s."""
         if vm in self._alloc[s]:
+            self._log_undo('_unremove', vm, s, self._vm_host.get(vm))
+            self._own(s)
             self._alloc[s].remove(vm)
-            for r in s.resource_types:  # update free capacity
-                self.free_cap[s][r] += vm.res[r]
+            if self._vm_host.get(vm) == s:
+                del self._vm_host[vm]
+            self._fingerprint ^= _alloc_key(vm, s)
+            self._free_vecs[s] += vm.vec # update free capacity
+            self._update_aggregates(s)
         return self
 
     def remove_all(self, s):
         """Change current state to have no VMs on server s."""
+        hosted = {}
+        for vm in self._alloc[s]:
+            if self._vm_host.get(vm) == s:
+                hosted[vm] = s
+                del self._vm_host[vm]
+            self._fingerprint ^= _alloc_key(vm, s)
+        # the old containers are replaced, not changed, so keep them for undo
+        self._log_undo('_unremove_all', s, self._alloc[s],
+                       self._free_vecs[s], hosted, s in self._owned)
         self._alloc[s] = set()
-        self.free_cap[s] = copy.copy(s.cap)
+        self._free_vecs[s] = s.vec.copy()
+        self._owned.add(s)
+        self._update_aggregates(s)
         return self
 
     # action effects (consequence of applying Action to State)
@@ -285,23 +482,23 @@ class State:
         """change current state to have vm in s instead of the old location"""
         if vm not in self.vms:
             raise ModelUsageError("attempt to migrate VM that isn't booted")
-        for server, vms in self._alloc.items():
-            if vm in vms:
-                if server == s:
-                    # it's already there
-                    return
-                else:  # VM was elsewhere - removing
-                    # remove from old server
-                    self.remove(vm, server)
+        server = self._vm_host.get(vm)
+        if server is not None:
+            if server == s:
+                # it's already there
+                return
+            else:  # VM was elsewhere - removing
+                # remove from old server
+                self.remove(vm, server)
         # add it to the new one
         if s is not None: # if s is None, vm is being deleted
             self.place(vm, s)
-        # TODO: faster reverse-dictionary lookup
-        # http://stackoverflow.com/a/2569076/544059
         return self
 
     def pause(self, vm):
         """Pause vm."""
+        if vm not in self.paused:
+            self._log_undo('unpause', vm)
         self.paused.add(vm)  # add to paused set
         return self
 
@@ -309,12 +506,15 @@ class State:
         """Unpause vm."""
         try:
             self.paused.remove(vm)  # remove from paused set
+            self._log_undo('pause', vm)
         except KeyError:
             pass
         return self
 
     def boot(self, vm):
         """A VM is requested by the user, but is not yet allocated."""
+        if vm not in self.vms:
+            self._log_undo('_unboot', vm)
         self.vms.add(vm)
         return self
 
@@ -323,6 +523,7 @@ class State:
         self.migrate(vm, None)  # remove vm from its host server
         try:  # remove the vm from this state's active vms
             self.vms.remove(vm)
+            self._log_undo('boot', vm)
         except KeyError: # the VM wasn't even there (booted outside environment)
             pass
         return self
@@ -331,35 +532,119 @@ class State:
         """Put the server into a higher frequency mode (if it exists)"""
         current = self.freq_scale[server]
         if current != Server.freq_scale_max:
-            self.freq_scale[server] = round(current + Server.freq_scale_delta,
-                                            Server.freq_scale_digits)
+            self._log_undo('_set_freq', server, current)
+            self._set_freq(server, round(current + Server.freq_scale_delta,
+                                         Server.freq_scale_digits))
 
     def decrease_freq(self, server):
         """Put the server into a lower frequency mode (if it exists)"""
         current = self.freq_scale[server]
         if current != Server.freq_scale_min:
-            self.freq_scale[server] = round(current - Server.freq_scale_delta,
-                                            Server.freq_scale_digits)
+            self._log_undo('_set_freq', server, current)
+            self._set_freq(server, round(current - Server.freq_scale_delta,
+                                         Server.freq_scale_digits))
+
+    # undo log
+    #---------
+    # While a checkpoint is open, every change to the state records the
+    # (method name, args) of its inverse, so rolling back costs
+    # O(changes made) instead of a copy of the whole state. copy and
+    # limit_to_server are not recorded (copies start without a log).
+
+    _undo_log = None
+
+    def _log_undo(self, name, *args):
+        if self._undo_log is not None:
+            self._undo_log.append((name, args))
+
+    def checkpoint(self):
+        """Start recording changes (if not already) and return a token
+        for rollback or commit."""
+        if self._undo_log is None:
+            self._undo_log = []
+        return len(self._undo_log)
+
+    def rollback(self, token):
+        """Undo all the changes made since checkpoint returned token."""
+        log = self._undo_log
+        if log is None:
+            raise ModelUsageError("rollback without a checkpoint")
+        self._undo_log = None # don't record the undoing itself
+        while len(log) > token:
+            name, args = log.pop()
+            getattr(self, name)(*args)
+        self._undo_log = log
+        self.commit(token)
+
+    def commit(self, token):
+        """Keep the changes made since token. Stop recording if token
+        belongs to the outermost checkpoint."""
+        if token == 0:
+            self._undo_log = None
+
+    def _unplace(self, vm, s, host):
+        self.remove(vm, s)
+        self._restore_host(vm, host)
+
+    def _unremove(self, vm, s, host):
+        self.place(vm, s)
+        self._restore_host(vm, host)
+
+    def _restore_host(self, vm, host):
+        if host is None:
+            self._vm_host.pop(vm, None)
+        else:
+            self._vm_host[vm] = host
+
+    def _unremove_all(self, s, vms, free, hosted, owned):
+        for vm in vms:
+            self._fingerprint ^= _alloc_key(vm, s)
+        self._alloc[s] = vms
+        self._free_vecs[s] = free
+        self._vm_host.update(hosted)
+        if not owned:
+            self._owned.discard(s)
+        self._update_aggregates(s)
+
+    def _unboot(self, vm):
+        self.vms.discard(vm)
+
+    def _set_freq(self, server, value):
+        self._fingerprint ^= (_freq_key(server, self.freq_scale[server]) ^
+                              _freq_key(server, value))
+        self.freq_scale[server] = value
 
 
     def copy(self):
-        """Return a copy of the state with a new alloc instance."""
+        """Return a copy of the state with a new alloc instance.
+
+        The per-server alloc sets and free capacities are shared between
+        the two states and only duplicated once either of them changes
+        a server (copy-on-write), so a transition only copies the servers
+        it actually touches.
+
+        """
         new_state = State.__new__(State) # new empty State instance
         #new_state.__dict__.update(self.__dict__)
         # these two don't copy objects, as we assume servers don't change
         new_state.servers = self.servers
         new_state.cap_df = self.cap_df
         new_state.vms = copy.copy(self.vms)
-        new_state._copy_alloc(self._alloc)
-        new_state.free_cap = {}
-        for s in self.servers:
-            # copy the free_cap dictionary
-            try:
-                new_state.free_cap[s] = copy.copy(self.free_cap[s])
-            except AttributeError: # temp fix due to supporting old servers.pkl
-                self.free_cap = {s : copy.copy(s.cap) for s in self.servers}
-                new_state.free_cap[s] = copy.copy(self.free_cap[s])
-        #TODO: copy.copy - probably faster
+        new_state._alloc = copy.copy(self._alloc)
+        new_state._vm_host = copy.copy(self._vm_host)
+        try:
+            new_state._free_vecs = copy.copy(self._free_vecs)
+        except AttributeError: # temp fix due to supporting old servers.pkl
+            self._free_vecs = {s: s.vec - sum(vm.vec for vm in self._alloc[s])
+                               for s in self.servers}
+            new_state._free_vecs = copy.copy(self._free_vecs)
+            self._init_aggregates()
+        new_state._utils = copy.copy(self._utils)
+        new_state._overcap = copy.copy(self._overcap)
+        new_state._fingerprint = self._fingerprint
+        # the per-server containers are now shared by both states
+        self._owned = set()
+        new_state._owned = set()
         new_state.paused = copy.copy(self.paused)
         new_state.suspended = copy.copy(self.suspended)
         new_state.freq_scale = copy.copy(self.freq_scale)
@@ -368,13 +653,16 @@ class State:
     def limit_to_server(self, server):
         """Modifies itself to only provide information about a single server."""
         self.servers = [server]
-        self.vms = self._alloc[server]
+        self.vms = set(self._alloc[server])
         self._alloc = {server : self._alloc[server]}
-        self.free_cap = {server : self.free_cap[server]}
+        self._vm_host = {vm: server for vm in self._alloc[server]}
+        self._free_vecs = {server : self._free_vecs[server]}
+        self._owned = self._owned & set([server])
         self.cap_df = pd.DataFrame({server: server.cap})
         self.paused = self.paused & set([server])
         self.suspended = self.suspended & set([server])
         self.freq_scale = {server : self.freq_scale[server]}
+        self._init_aggregates()
 
     # creates a new VMs list
     def transition(self, action, inplace=False):
@@ -391,21 +679,19 @@ class State:
         return state
 
     def _utilisation_basic(self, s, weights):
-        total_utilisation = 0.
-        for r in s.resource_types:
-            used = s.cap[r] - self.free_cap[s][r]
-            utilisation = used / float(s.cap[r])
-            if utilisation > 1:
-                utilisation = 1
-            total_utilisation += weights[r] * utilisation
-        return total_utilisation
+        if weights is Machine.weights: # maintained by _update_aggregates
+            return self._utils[s]
+        used = s.vec - self._free_vecs[s]
+        # the ratios in double precision (the vectors are float32)
+        utilisation = np.minimum(np.divide(used, s.vec, dtype=float), 1)
+        return float(utilisation.dot(_weight_vector(weights)))
 
     def _utilisation_multicore(self, s, weights):
-        cores = s.spec['#CPUs']
-        active_cores = cores - self.free_cap[s]['#CPUs']
+        cores = s.spec[Machine.core_resource]
+        active_cores = cores - self.free_cap[s][Machine.core_resource]
         util = 0
         for vm in self.alloc[s]:
-            vm_cores = vm.spec['#CPUs']
+            vm_cores = vm.spec[Machine.core_resource]
             #gamma = float(vm.beta)
             gamma_max = weights[0] * 1. + weights[1] * 1. + weights[2]
             gamma = (weights[0] * float(vm.beta)
@@ -435,6 +721,8 @@ class State:
 
     def calculate_utilisations(self, method="basic", weights=None):
         """Return dict server -> utilisation rate."""
+        if weights is None and method in ("basic", "freq"):
+            return dict(self._utils)
         return {server: self.utilisation(server, weights, method) \
                 for server in self.servers}
 
@@ -446,38 +734,31 @@ class State:
     # C1
     def is_allocated(self, vm):
         """True if @param vm is allocated to any server in this state."""
-        for s in self.servers:
-            if vm in self._alloc[s]:
-                return True
-        return False
+        return vm in self._vm_host
 
     def allocation(self, vm):
         """The server to which @param vm is allocated or None."""
-        for s in self.servers:
-            if vm in self._alloc[s]:
-                return s
-        return None
+        return self._vm_host.get(vm)
 
     def unallocated_vms(self):
         """Return the set of unallocated VMs."""
-        unallocated = set(copy.copy(self.vms))
-        for s in self.servers:
-            unallocated = unallocated.difference(self._alloc[s])
-        return unallocated
+        return set(vm for vm in self.vms if vm not in self._vm_host)
 
     def all_allocated(self):
         """True if all currently requested VMs are allocated."""
         return len(self.unallocated_vms()) == 0
 
     def ratio_allocated(self):
-        """The ratio of allocated VMs compared to all the requested VMs."""
-        to_check = set(copy.copy(self.vms))
-        total = len(to_check)
+        """The ratio of allocated VMs compared to all the requested VMs.
+
+        Only booted VMs are allocated (migrate enforces it), so every VM
+        with a host counts.
+
+        """
+        total = len(self.vms)
         if total == 0:
             return 1.0
-        for s in self.servers:
-            to_check = to_check.difference(self._alloc[s])
-        allocated = total - len(to_check)
+        allocated = len(self._vm_host)
         ratio = float(allocated) / total
         return ratio
 
@@ -487,27 +768,15 @@ class State:
         VMs and check if it exceeds the available resource capacity.
 
         """
-        if s is None:
-            pass
-        for i in s.resource_types:
-            if self.free_cap[s][i] < 0:
-                return False
-        return True
+        return bool((self._free_vecs[s] >= 0).all())
 
     def overcapacitated_servers(self):
         """Return the set of servers that are not within capacity."""
-        servers = set(self.servers)
-        overcap = servers.difference(
-            set([s for s in servers if self.within_capacity(s)])
-        )
-        return overcap
+        return set(self._overcap)
 
     def all_within_capacity(self):
         """Are all the servers within capacity?"""
-        for s in self.servers:
-            if not self.within_capacity(s):
-                return False
-        return True
+        return len(self._overcap) == 0
 
     def capacity_penalty(self):
         """Return a penalty 0-1.0, indicating by how much the capacity
@@ -515,36 +784,19 @@ class State:
         are overcapacitated).
 
         """
-        # TODO: see if this method using DataFrames could be faster
-        # (free_cap instance of DataFrame?)
-        # free_cap_df = pd.DataFrame(self.free_cap)
-        # ratio_overcap = -1 * free_cap_df[free_cap_df < 0] / self.cap_df
-        # ratio_overcap[ratio_overcap.isnull()] = 0
-        # penalty = ratio_overcap.max().mean()
-        ratio_overcap = {s: 0. for s in self.servers}
-        for s in self.servers:
-            max_overcap_ratio = 0
-            for r in Machine.resource_types:
-                overcap = -1 * self.free_cap[s][r]
-                res_ratio_overcap = float(overcap) / s.cap[r]
-                if res_ratio_overcap > max_overcap_ratio:
-                    max_overcap_ratio = res_ratio_overcap
-                    ratio_overcap[s] = res_ratio_overcap
-        penalty = pd.Series(ratio_overcap).mean()
+        if len(self.servers) == 0:
+            return np.nan
+        # only the overcapacitated servers contribute
+        penalty = sum(self._overcap.values()) / len(self.servers)
         if penalty > 1.:
             penalty = 1.
         return penalty
 
     def ratio_within_capacity(self): # TODO: by resource overflows
         """Ratio of servers that are within capacity."""
-        num_ok = 0
-        for s in self.servers:
-            if self.within_capacity(s):
-                num_ok += 1
         if len(self.servers) == 0:
             return 1.0
-        ratio = float(num_ok) / len(self.servers)
-        return ratio
+        return 1. - float(len(self._overcap)) / len(self.servers)
 
     def server_free(self, s):
         """True if there are no VMs allocated to server @param s."""
@@ -554,62 +806,496 @@ class State:
         """If the server is non-empty and utilisation below threshold."""
         return not self.server_free(s) and self.utilisation(s) < threshold
 
+class _VMRegistry:
+    """Append-only VM -> column index shared by all the ArrayState copies
+    descending from the same initial state (VMs never change their resources,
+    so their resource rows can be shared too).
+
+    """
+    def __init__(self, resource_types):
+        self.resource_types = resource_types
+        self.index = {}
+        self.vms = []
+        self.res = np.zeros((8, len(resource_types)), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.vms)
+
+    def add(self, vm):
+        """Return the column of @param vm, registering it if it is new."""
+        try:
+            return self.index[vm]
+        except KeyError:
+            pass
+        i = len(self.vms)
+        if i == len(self.res): # grow by doubling
+            self.res = np.vstack([self.res, np.zeros_like(self.res)])
+        self.res[i] = vm.vec
+        self.index[vm] = i
+        self.vms.append(vm)
+        return i
+
+
+class _AllocView:
+    """Read-only dict-like server -> set of VMs view of an ArrayState."""
+    def __init__(self, state):
+        self._state = state
+
+    def __getitem__(self, s):
+        state = self._state
+        si = state._server_index[s]
+        vms = state._registry.vms
+        return set(vms[i] for i in np.flatnonzero(state._host == si))
+
+    def __contains__(self, s):
+        return s in self._state._server_index
+
+    def __iter__(self):
+        return iter(self._state.servers)
+
+    def __len__(self):
+        return len(self._state.servers)
+
+    def keys(self):
+        return list(self._state.servers)
+
+    def values(self):
+        return [self[s] for s in self._state.servers]
+
+    def items(self):
+        return [(s, self[s]) for s in self._state.servers]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class _FreeCapView(_AllocView):
+    """Read-only dict-like server -> {resource: free capacity} view."""
+    def __getitem__(self, s):
+        state = self._state
+        row = state._free[state._server_index[s]]
+        return dict(zip(state._resource_types, row.tolist()))
+
+
+class _FreqView(_AllocView):
+    """Dict-like server -> freq_scale view (setting items is allowed)."""
+    def __getitem__(self, s):
+        state = self._state
+        return float(state._freq[state._server_index[s]])
+
+    def __setitem__(self, s, value):
+        state = self._state
+        state._freq[state._server_index[s]] = value
+
+
+class ArrayState(State):
+    """A State that keeps the server capacities, free capacities, frequency
+    scales and the VM -> server assignment in contiguous NumPy arrays, so that
+    copying it costs a couple of memcpys instead of rebuilding per-server
+    dicts and sets. Exposes the same interface as State (alloc, free_cap and
+    freq_scale are dict-like views).
+
+    Unlike State, a VM is allocated to at most one server - placing it on
+    a new server implicitly removes it from the old one.
+
+    """
+
+    def __init__(self, servers=[], vms=set(), auto_allocate=False):
+        self.servers = servers
+        self.vms = vms
+        self._resource_types = list(Machine.resource_types)
+        self._server_index = {s: i for i, s in enumerate(servers)}
+        self._cap = np.array([s.vec for s in servers], dtype=np.float32)
+        self._cap.shape = (len(servers), len(self._resource_types))
+        self._free = self._cap.copy()
+        self._freq = np.ones(len(servers))
+        self._registry = _VMRegistry(self._resource_types)
+        self._host = np.empty(0, dtype=np.int32) # VM column -> server row
+        self.cap_df = pd.DataFrame({s: s.cap for s in self.servers})
+        self.paused = set()
+        self.suspended = set()
+        self._init_fingerprint()
+        if auto_allocate:
+            self.auto_allocate()
+
+    def __repr__(self):
+        rep = ''
+        for s in self.servers:
+            rep += '{}^{} -> {};\n'.format(s, self.freq_scale[s],
+                                           self.alloc[s])
+        return rep
+
+    @property
+    def alloc(self):
+        """A dict-like view giving for every server the set of VMs
+        allocated to it."""
+        return _AllocView(self)
+
+    @property
+    def free_cap(self):
+        """A dict-like view of every server's remaining free capacity."""
+        return _FreeCapView(self)
+
+    @property
+    def freq_scale(self):
+        """A dict-like view of every server's CPU frequency scale."""
+        return _FreqView(self)
+
+    def free_vector(self, s):
+        """The free capacity of server s as a resource vector."""
+        return self._free[self._server_index[s]]
+
+    def _init_fingerprint(self):
+        """Calculate the fingerprint from scratch."""
+        fingerprint = 0
+        for si, s in enumerate(self.servers):
+            fingerprint ^= _freq_key(s, self._freq[si])
+        for i in np.flatnonzero(self._host >= 0):
+            fingerprint ^= self._alloc_key(i, self._host[i])
+        self._fingerprint = fingerprint
+
+    def _alloc_key(self, i, row):
+        return _alloc_key(self._registry.vms[i], self.servers[row])
+
+    def _vm_column(self, vm):
+        """The column of vm in the assignment array (grown if necessary)."""
+        i = self._registry.add(vm)
+        if i >= len(self._host):
+            missing = len(self._registry.res) - len(self._host)
+            self._host = np.append(self._host,
+                                   np.full(missing, -1, dtype=np.int32))
+        return i
+
+    def _host_row(self, vm):
+        """The row of the server hosting vm or -1 if it's unallocated."""
+        i = self._registry.index.get(vm)
+        if i is None or i >= len(self._host):
+            return -1
+        return self._host[i]
+
+    def _set_host(self, i, row):
+        """Move the VM in column i to server row (-1 - unallocated)."""
+        old = self._host[i]
+        if old != row:
+            self._log_undo('_set_host', i, old)
+            if old >= 0:
+                self._free[old] += self._registry.res[i]
+                self._fingerprint ^= self._alloc_key(i, old)
+            if row >= 0:
+                self._free[row] -= self._registry.res[i]
+                self._fingerprint ^= self._alloc_key(i, row)
+            self._host[i] = row
+
+    def place(self, vm, s):
+        """Change current state to have vm on server s."""
+        self._set_host(self._vm_column(vm), self._server_index[s])
+        return self
+
+    def remove(self, vm, s):
+        """Change current state to not have vm on server s."""
+        si = self._server_index[s]
+        if self._host_row(vm) == si:
+            self._set_host(self._registry.index[vm], -1)
+        return self
+
+    def remove_all(self, s):
+        """Change current state to have no VMs on server s."""
+        si = self._server_index[s]
+        hosted = np.flatnonzero(self._host == si)
+        self._log_undo('_unremove_all', si, hosted, self._free[si].copy())
+        for i in hosted:
+            self._fingerprint ^= self._alloc_key(i, si)
+        self._host[hosted] = -1
+        self._free[si] = self._cap[si]
+        return self
+
+    def _unremove_all(self, si, hosted, free):
+        for i in hosted:
+            self._fingerprint ^= self._alloc_key(i, si)
+        self._host[hosted] = si
+        self._free[si] = free
+
+    def migrate(self, vm, s):
+        """change current state to have vm in s instead of the old location"""
+        if vm not in self.vms:
+            raise ModelUsageError("attempt to migrate VM that isn't booted")
+        if s is None: # vm is being deleted
+            old = self._host_row(vm)
+            if old >= 0:
+                self.remove(vm, self.servers[old])
+        else:
+            self.place(vm, s)
+        return self
+
+    def increase_freq(self, server):
+        """Put the server into a higher frequency mode (if it exists)"""
+        current = float(self._freq[self._server_index[server]])
+        if current != Server.freq_scale_max:
+            self._log_undo('_set_freq', server, current)
+            self._set_freq(server, round(current + Server.freq_scale_delta,
+                                         Server.freq_scale_digits))
+
+    def decrease_freq(self, server):
+        """Put the server into a lower frequency mode (if it exists)"""
+        current = float(self._freq[self._server_index[server]])
+        if current != Server.freq_scale_min:
+            self._log_undo('_set_freq', server, current)
+            self._set_freq(server, round(current - Server.freq_scale_delta,
+                                         Server.freq_scale_digits))
+
+    def copy(self):
+        """Return a copy of the state with new arrays."""
+        new_state = ArrayState.__new__(ArrayState)
+        # servers, capacities and the VM registry never change - share them
+        new_state.servers = self.servers
+        new_state.cap_df = self.cap_df
+        new_state._resource_types = self._resource_types
+        new_state._server_index = self._server_index
+        new_state._cap = self._cap
+        new_state._registry = self._registry
+        new_state.vms = copy.copy(self.vms)
+        new_state._free = self._free.copy()
+        new_state._freq = self._freq.copy()
+        new_state._host = self._host.copy()
+        new_state._fingerprint = self._fingerprint
+        new_state.paused = copy.copy(self.paused)
+        new_state.suspended = copy.copy(self.suspended)
+        return new_state
+
+    def limit_to_server(self, server):
+        """Modifies itself to only provide information about a single server."""
+        si = self._server_index[server]
+        self.vms = self.alloc[server]
+        self.servers = [server]
+        self._server_index = {server: 0}
+        self._cap = self._cap[si:si + 1]
+        self._free = self._free[si:si + 1].copy()
+        self._freq = self._freq[si:si + 1].copy()
+        self._host = np.where(self._host == si, 0, -1).astype(np.int32)
+        self.cap_df = pd.DataFrame({server: server.cap})
+        self.paused = self.paused & set([server])
+        self.suspended = self.suspended & set([server])
+        self._init_fingerprint()
+
+    def _utilisation_vector(self, weights):
+        """Basic utilisation of all the servers at once."""
+        used = self._cap - self._free
+        utilisation = np.minimum(np.divide(used, self._cap, dtype=float), 1)
+        return utilisation.dot(_weight_vector(weights))
+
+    def _multicore_vector(self, weights):
+        """Multicore utilisation of all the servers at once."""
+        cpus = self._resource_types.index(Machine.core_resource)
+        active_cores = self._cap[:, cpus] - self._free[:, cpus]
+        n = len(self._registry)
+        allocated = np.flatnonzero(self._host[:n] >= 0)
+        gamma_max = weights[0] * 1. + weights[1] * 1. + weights[2]
+        beta = np.array([float(self._registry.vms[i].beta)
+                         for i in allocated])
+        gamma = (weights[0] * beta + weights[1] * beta**2
+                 + weights[2]) / gamma_max
+        assert ((0. <= gamma) & (gamma <= 1.)).all()
+        used = np.bincount(self._host[allocated],
+                           weights=gamma * self._registry.res[allocated, cpus],
+                           minlength=len(self.servers))
+        util = np.zeros(len(self.servers))
+        np.divide(used, active_cores, out=util, where=active_cores != 0)
+        return util
+
+    def _utilisation_basic(self, s, weights):
+        si = self._server_index[s]
+        used = self._cap[si] - self._free[si]
+        utilisation = np.minimum(np.divide(used, self._cap[si], dtype=float),
+                                 1)
+        return float(utilisation.dot(_weight_vector(weights)))
+
+    def _utilisation_multicore(self, s, weights):
+        return float(self._multicore_vector(weights)[self._server_index[s]])
+
+    def calculate_utilisations(self, method="basic", weights=None):
+        """Return dict server -> utilisation rate."""
+        if weights is None:
+            weights = Machine.weights
+        if method == "basic" or method == "freq":
+            util = self._utilisation_vector(weights)
+        elif method == "multicore":
+            util = self._multicore_vector(weights)
+        else:
+            msg = "unknown utilisation calculation method {}".format(method)
+            raise ValueError(msg)
+        return dict(zip(self.servers, util.tolist()))
+
+    def is_allocated(self, vm):
+        """True if @param vm is allocated to any server in this state."""
+        return self._host_row(vm) >= 0
+
+    def allocation(self, vm):
+        """The server to which @param vm is allocated or None."""
+        si = self._host_row(vm)
+        if si < 0:
+            return None
+        return self.servers[si]
+
+    def unallocated_vms(self):
+        """Return the set of unallocated VMs."""
+        return set(vm for vm in self.vms if self._host_row(vm) < 0)
+
+    def ratio_allocated(self):
+        """The ratio of allocated VMs compared to all the requested VMs."""
+        total = len(self.vms)
+        if total == 0:
+            return 1.0
+        return float(np.count_nonzero(self._host >= 0)) / total
+
+    def within_capacity(self, s):
+        """Server s within capacity? Check resources occupied by the allocated
+        VMs and check if it exceeds the available resource capacity.
+
+        """
+        return bool((self._free[self._server_index[s]] >= 0).all())
+
+    def overcapacitated_servers(self):
+        """Return the set of servers that are not within capacity."""
+        overcap = (self._free < 0).any(axis=1)
+        return set(self.servers[i] for i in np.flatnonzero(overcap))
+
+    def all_within_capacity(self):
+        """Are all the servers within capacity?"""
+        return bool((self._free >= 0).all())
+
+    def capacity_penalty(self):
+        """Return a penalty 0-1.0, indicating by how much the capacity
+        of all the servers has been exceeded (closer to 1. means more servers
+        are overcapacitated).
+
+        """
+        ratio_overcap = np.divide(-self._free, self._cap, dtype=float)
+        ratio_overcap = np.maximum(ratio_overcap.max(axis=1), 0)
+        penalty = ratio_overcap.mean()
+        if penalty > 1.:
+            penalty = 1.
+        return penalty
+
+    def ratio_within_capacity(self):
+        """Ratio of servers that are within capacity."""
+        if len(self.servers) == 0:
+            return 1.0
+        return float((self._free >= 0).all(axis=1).mean())
+
+    def server_free(self, s):
+        """True if there are no VMs allocated to server @param s."""
+        return not (self._host == self._server_index[s]).any()
+
+
 # The ranking determines which the order in which to apply the actions,
 # given the same timestamps.
 actions = ['boot', 'delete', 'increase_freq', 'decrease_freq',
            'migrate', 'pause', 'unpause']
 action_rank = dict(list(zip(actions, list(range(len(actions))))))
 
-class Action(CommonEqualityMixin):
+class Action:
     """A static representation of an action on the cloud.
-    Has to be immutable (no dicts).
+    Has to be immutable (no dicts). Actions are compared and hashed by
+    their key - (kind, VM id, server id), the kind being the action's rank.
+
     """
+    # __dict__ is only there so that actions can still be annotated
+    __slots__ = ('args', 'vm', 'server', 'key', '__dict__')
     name = ''
-    args = None
+
+    def _record(self, *args):
+        """Set the (read-only) arguments of the action."""
+        vm = server = None
+        for arg in args:
+            if isinstance(arg, VM):
+                vm = arg
+            elif isinstance(arg, Server):
+                server = arg
+        key = (action_rank[self.name],
+               -1 if vm is None else vm.id,
+               -1 if server is None else server.id)
+        for field, value in zip(Action.__slots__,
+                                (args, vm, server, key)):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        if name in Action.__slots__:
+            raise AttributeError("actions are immutable")
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}), args=self.args)
+        for name in type(self).__slots__: # e.g. VMRequest.what
+            if name not in Action.__slots__:
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple): # (__dict__, slots)
+            state = dict(state[0] or {}, **(state[1] or {}))
+        state = dict(state)
+        for name in ('name', 'what'): # set by VMRequest
+            if name in state:
+                object.__setattr__(self, name, state.pop(name))
+        self._record(*state.pop('args'))
+        for name in Action.__slots__:
+            state.pop(name, None)
+        self.__dict__.update(state)
+
+    def __eq__(self, other):
+        return isinstance(other, Action) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key)
+
     def __repr__(self):
         return '{0}: {1}'.format(self.name, str(self.args))
     def __str__(self):
         return self.__repr__()
     def rank(self):
         """The action's rank - used for sorting."""
-        return action_rank[self.name]
+        return self.key[0]
 
 class Migration(Action):
     """Migrate vm to server."""
+    __slots__ = ()
     def __init__(self, vm, server):
-        self.vm = vm
-        self.server = server
-        self.args = (vm, server)
+        self._record(vm, server)
     name = 'migrate'
     def __repr__(self):
         return '{} -> {}'.format(str(self.vm), str(self.server))
 
 class Pause(Action):
     """Pause vm."""
+    __slots__ = ()
     def __init__(self, vm):
-        self.args = (vm,)
+        self._record(vm)
     name = 'pause'
 
 class Unpause(Action):
     """Unpause vm."""
+    __slots__ = ()
     def __init__(self, vm):
-        self.args = (vm,)
+        self._record(vm)
     name = 'unpause'
 
 
 class IncreaseFreq(Action):
     """Increase a server's CPU frequency if possible."""
+    __slots__ = ()
     def __init__(self, server):
-        self.args = (server,)
-        self.server = server
+        self._record(server)
     name = 'increase_freq'
 
 
 class DecreaseFreq(Action):
     """Decrease a server's CPU frequency if possible."""
+    __slots__ = ()
     def __init__(self, server):
-        self.args = (server,)
-        self.server = server
+        self._record(server)
     name = 'decrease_freq'
 
 
@@ -619,94 +1305,303 @@ class VMRequest(Action):
     action also unallocates the VM and frees the server's resources.
 
     """
+    __slots__ = ('what', 'name')
     def __init__(self, vm, what):
-        self.vm = vm
-        self.args = (vm,)
-        self.what = what
-        self.name = self.what
+        object.__setattr__(self, 'what', what)
+        object.__setattr__(self, 'name', what)
+        self._record(vm)
     def __str__(self):
         return "{0} {1}".format(self.what, self.vm)
     def __repr__(self):
         return self.__str__()
 
+# rank -> function creating the action from its VM and/or server
+_action_factories = {
+    action_rank['boot']: lambda vm: VMRequest(vm, 'boot'),
+    action_rank['delete']: lambda vm: VMRequest(vm, 'delete'),
+    action_rank['increase_freq']: IncreaseFreq,
+    action_rank['decrease_freq']: DecreaseFreq,
+    action_rank['migrate']: Migration,
+    action_rank['pause']: Pause,
+    action_rank['unpause']: Unpause,
+}
+
 import pandas as pd
 
+# State implementations selectable through conf.state_engine
+state_engines = {'dict': State, 'array': ArrayState}
+
+
+def _last_occurrences(*columns):
+    """Boolean mask of the rows that are the last ones with their key
+    (the values in @param columns)."""
+    keys = np.column_stack(columns)[::-1]
+    _, first = np.unique(keys, axis=0, return_index=True)
+    mask = np.zeros(len(keys), dtype=bool)
+    mask[len(keys) - 1 - first] = True
+    return mask
+
 
 class Schedule:
-    """(initial state? - part of Cloud) and a time series of actions"""
+    """(initial state? - part of Cloud) and a time series of actions
+
+    The actions are kept in parallel lists sorted by (time, rank) - int64
+    timestamps, (timestamp, rank) keys, the ids of the VMs and servers
+    the actions are about and the Action objects - so that add is a
+    bisect insertion and sort and clean are NumPy operations. The pandas
+    Series in actions is only created when it's read (and cached until
+    the schedule changes).
+
+    """
+    _columns = ['_times', '_keys', '_vm_ids', '_server_ids', '_actions']
+
     def __init__(self):
-        self.actions = pd.Series()
-        self.actions.name = 'actions'
+        self._times = [] # int64 nanosecond timestamps
+        self._keys = [] # (timestamp, rank) pairs - the sort key
+        self._vm_ids = [] # -1 - not about a VM
+        self._server_ids = [] # -1 - not about a server
+        self._actions = []
+        self._series = None
+
+    def _ranks(self):
+        return np.array([rank for t, rank in self._keys], dtype=np.int64)
+
+    def _take(self, positions):
+        """Only keep the actions at positions (in that order)."""
+        for column in self._columns:
+            values = getattr(self, column)
+            setattr(self, column, [values[i] for i in positions])
+        self._series = None
+
+    def _set_columns(self, times, ranks, vm_ids, server_ids, actions):
+        """Set the columns to the given ones, sorted by (time, rank)."""
+        self._times = [int(t) for t in times]
+        self._keys = list(zip(self._times, [int(rank) for rank in ranks]))
+        self._vm_ids = [int(i) for i in vm_ids]
+        self._server_ids = [int(i) for i in server_ids]
+        self._actions = list(actions)
+        self._take(np.lexsort((ranks, times))) # stable
+
+    def _series_slice(self, lo=0, hi=None):
+        index = pd.DatetimeIndex(np.array(self._times[lo:hi],
+                                          dtype='datetime64[ns]'))
+        return pd.Series(self._actions[lo:hi], index, dtype=object,
+                         name='actions')
+
+    def get_actions(self):
+        if self._series is None:
+            self._series = self._series_slice()
+        return self._series
+
+    def set_actions(self, actions):
+        self._take([]) # empty
+        self.extend(actions, supersede=False)
+
+    actions = property(get_actions, set_actions,
+                       doc="time series of the actions (sorted by rank)")
+
+    def __len__(self):
+        return len(self._actions)
+
+    def __copy__(self):
+        new_schedule = self.__class__.__new__(self.__class__)
+        new_schedule.__dict__.update(self.__dict__)
+        for column in self._columns:
+            setattr(new_schedule, column, list(getattr(self, column)))
+        return new_schedule
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_series'] = None
+        state.pop('_replay_prefixes', None) # the evaluator's cache
+        return state
+
+    def __setstate__(self, state):
+        actions = state.pop('actions', None)
+        self.__dict__.update(state)
+        if actions is not None: # pickled before the lists were introduced
+            self.actions = actions
 
     def copy(self):
         return copy.copy(self)
 
     def sort(self):
-        # - actions in the current time have to be sorted by Action.rank()
-        # - sort_index has to be stable - not sure if it is
-        # self.actions = self.actions.sort_index()
-        # maybe cache ranked_actions, don't create it from scratch every time
-        ranked_actions = pd.DataFrame({'actions': self.actions,
-                                       'rank': [a.rank() for a in self.actions],
-                                       'index': self.actions.index},
-                                      index=self.actions.index)
-        self.actions = ranked_actions.sort_values(by=['index', 'rank']).actions
-        self.actions.name = 'actions'
+        """Sort the actions by time and (for the same time) by Action.rank().
+        Actions with the same time and rank keep their order."""
+        times = np.array(self._times, dtype=np.int64)
+        self._take(np.lexsort((self._ranks(), times)))
 
     def clean(self):
         """Remove duplicates and only consider the last action on a VM if
         multiple exist for the same timestamp.
 
         """
+        if len(self._actions) == 0:
+            return
         # TODO: is a check to leave boots alone necessary?
+        times = np.array(self._times, dtype=np.int64)
+        ranks = self._ranks() # the rank identifies the kind of action
+        vm_ids = np.array(self._vm_ids, dtype=np.int64)
+        server_ids = np.array(self._server_ids, dtype=np.int64)
         # remove exact duplicates on same index
-        df = pd.DataFrame({'index': self.actions.index,
-                           'actions': self.actions.values})
-        df.drop_duplicates(subset=['actions', 'index'],
-                           keep='last', inplace=True)
+        keep = _last_occurrences(times, ranks, vm_ids, server_ids)
         # only take the last action applied to a VM at some index
-        df['vm'] = df.actions.apply(lambda a : a.vm)
-        df['name'] = df.actions.apply(lambda a : a.name)
-        df.drop_duplicates(subset=['index', 'vm', 'name'],
-                           keep='last', inplace=True)
-        # back to the original form
-        self.actions = df.set_index('index').actions
+        # (actions that aren't about a VM get keys of their own)
+        no_vm = vm_ids < 0
+        vm_ids[no_vm] = -1 - np.flatnonzero(no_vm)
+        rows = np.flatnonzero(keep)
+        last = _last_occurrences(times[rows], ranks[rows], vm_ids[rows])
+        self._take(rows[last])
+
+    def _delete(self, i):
+        for column in self._columns:
+            del getattr(self, column)[i]
+        self._series = None
+
+    def _window(self, t, period=None):
+        """Positions of the actions in [t, t + period)."""
+        lo = bisect_left(self._times, pd.Timestamp(t).value)
+        if period is None:
+            return lo, len(self._times)
+        justabit = pd.offsets.Micro(1)
+        end = pd.Timestamp(t) + period - justabit
+        return lo, bisect_right(self._times, end.value)
 
     def add(self, action, t):
         """Add an action to the schedule. Make sure it's still sorted.
         Return True/False to indicate success."""
         try:
-            existing_actions = self.filter_current_actions(
-                t, self.environment.period)
+            period = self.environment.period
         except AttributeError: # if no environment available
             pass # TODO: maybe raise after all - confusing
         else:
-            for t_ex, existing in existing_actions.items():
+            lo, hi = self._window(t, period)
+            superseded = []
+            for i in range(lo, hi):
+                existing = self._actions[i]
                 if existing == action:
                     # we don't add anything as there already exists the same
                     # action at time t
+                    for j in reversed(superseded):
+                        self._delete(j)
                     return False
                 if existing.name == action.name and existing.vm == action.vm:
                     # only if there was another action of the same name
                     # (e.g. migrate) for this VM, do we
                     # remove the old one, as the new one supersedes it
-                    self.actions = self.actions[self.actions != existing]
-        new_action = pd.Series({t: action})
-        self.actions = pd.concat([self.actions, new_action])
-        #TODO: optimise this to only sort the new actions
-        self.sort()
+                    superseded.append(i)
+            for j in reversed(superseded):
+                self._delete(j)
+        key = (pd.Timestamp(t).value, action.rank())
+        i = bisect_right(self._keys, key) # after the equal ones (stable)
+        vm_id, server_id = action.key[1:]
+        self._times.insert(i, key[0])
+        self._keys.insert(i, key)
+        self._vm_ids.insert(i, vm_id)
+        self._server_ids.insert(i, server_id)
+        self._actions.insert(i, action)
+        self._series = None
         return True
 
+    @classmethod
+    def from_arrays(cls, times, actions):
+        """Create a schedule from the action times and actions (sorted
+        once, instead of an add for every action)."""
+        schedule = cls()
+        schedule.extend(pd.Series(list(actions), times, dtype=object))
+        return schedule
+
+    def codes(self):
+        """A compact encoding of the actions - int64 arrays of the times,
+        ranks, VM ids and server ids (see from_codes)."""
+        return (np.array(self._times, dtype=np.int64), self._ranks(),
+                np.array(self._vm_ids, dtype=np.int64),
+                np.array(self._server_ids, dtype=np.int64))
+
+    @classmethod
+    def from_codes(cls, codes, vms, servers):
+        """Create a schedule from its codes (see codes), given the dicts of
+        the VMs and servers by id."""
+        times, ranks, vm_ids, server_ids = codes
+        actions = []
+        for rank, vm_id, server_id in zip(ranks, vm_ids, server_ids):
+            args = [vms[vm_id]] if vm_id >= 0 else []
+            if server_id >= 0:
+                args.append(servers[server_id])
+            actions.append(_action_factories[rank](*args))
+        schedule = cls()
+        schedule._set_columns(times, ranks, vm_ids, server_ids, actions)
+        return schedule
+
+    def extend(self, batch, supersede=True):
+        """Add a batch of actions - a Series of actions indexed by time or
+        (t, action) pairs - with a single sort. The result is the same as
+        adding them one by one, in order, except that superseding (if there
+        is an environment) only considers actions at the same time.
+
+        """
+        if isinstance(batch, pd.Series):
+            times, actions = batch.index, list(batch.values)
+        else:
+            batch = list(batch)
+            times = [t for t, action in batch]
+            actions = [action for t, action in batch]
+        if len(actions) == 0:
+            return
+        times = np.concatenate([np.array(self._times, dtype=np.int64),
+                                pd.DatetimeIndex(times).asi8])
+        ranks = np.concatenate([self._ranks(),
+                                [action.rank() for action in actions]])
+        ids = [action.key[1:] for action in actions]
+        # existing actions come first, so they stay in front of new
+        # ones with the same time and rank (as with add)
+        self._set_columns(times, ranks,
+                          self._vm_ids + [vm_id for vm_id, _ in ids],
+                          self._server_ids + [s_id for _, s_id in ids],
+                          self._actions + actions)
+        if supersede and hasattr(self, 'environment'):
+            self._supersede()
+
+    def _supersede(self):
+        """Apply the rules of add to the (sorted) actions: drop actions
+        identical to an earlier one and let the last action of a kind on
+        a VM at a time replace the others."""
+        keep = [True] * len(self._actions)
+        current = {} # (t, rank, vm id) -> position of the surviving action
+        for i, (key, vm_id) in enumerate(zip(self._keys, self._vm_ids)):
+            if vm_id < 0:
+                continue
+            j = current.get((key, vm_id))
+            if j is None:
+                current[(key, vm_id)] = i
+            elif self._actions[j] == self._actions[i]:
+                keep[i] = False
+            else:
+                keep[j] = False
+                current[(key, vm_id)] = i
+        if not all(keep):
+            self._take([i for i, kept in enumerate(keep) if kept])
+
+    def merge(self, other, split_time):
+        """Return a copy of this schedule with its own actions until
+        split_time (inclusive) and other's actions after it. Both are
+        already sorted, so this only concatenates the two parts."""
+        t = pd.Timestamp(split_time).value
+        i = bisect_right(self._times, t)
+        j = bisect_right(other._times, t)
+        merged = copy.copy(self)
+        for column in self._columns:
+            setattr(merged, column,
+                    getattr(self, column)[:i] + getattr(other, column)[j:])
+        merged._series = None
+        return merged
+
     def filter_current_actions(self, t, period=None):
         """return time series of actions in interval
         (closed on the left, open on the right)
 
         """
-        if period is None:
-            return self.actions.loc[t:]
-        justabit = pd.offsets.Micro(1)
-        return self.actions.loc[t:t + period - justabit]
-        #return self.actions[t:t + period - justabit]
+        return self._series_slice(*self._window(t, period))
 
     def __repr__(self):
         return self.actions.__repr__()
@@ -738,12 +1633,29 @@ class Cloud:
     - action on Cloud -> create Action instance -> add to Schedule
 
     """
-    def __init__(self, servers=[], initial_vms=set(), auto_allocate=False):
+    # the State implementation to use - can be overridden (see state_engines)
+    state_class = State
+    # minimum time between two checkpoints of the real state
+    # (pd.offsets.* or None for no checkpoints)
+    checkpoint_interval = None
+    # when exceeded, every other checkpoint is dropped (interval doubles)
+    max_checkpoints = 48
+
+    def __init__(self, servers=[], initial_vms=set(), auto_allocate=False,
+                 state_class=None):
         self._servers = servers
-        self._initial = State(servers, set(initial_vms), auto_allocate)
+        if state_class is not None:
+            self.state_class = state_class
+        self._initial = self.state_class(servers, set(initial_vms),
+                                         auto_allocate)
         for machine in servers + list(initial_vms): # know thy parent
             machine.cloud = self
         self._real = self._initial.copy()
+        self._real_t = None # time of the last action applied to _real
+        # timestamped copies of _real before the actions at that time
+        self._checkpoint_times = []
+        self._checkpoint_states = []
+        self._interval = self.checkpoint_interval
         self.reset_to_real()
 
     def __repr__(self):
@@ -769,6 +1681,46 @@ class Cloud:
         """Set the current state to a copy of the initial state."""
         self._current = self._initial.copy()
 
+    def reset_to_state(self, state):
+        """Set the current state to a copy of state (e.g. an intermediate
+        one kept by the evaluator)."""
+        self._current = state.copy()
+        return self._current
+
+    def reset_to_time(self, t):
+        """Set the current state to a copy of the latest known real state
+        not after t. Returns the time from which on actions still have to
+        be applied to get the state at t: t itself if starting from _real
+        (t not before the last real action), the checkpoint's time or
+        None if starting from _initial.
+
+        """
+        if self._real_t is None or t >= self._real_t:
+            self.reset_to_real()
+            return t
+        i = bisect_right(self._checkpoint_times, t) - 1
+        if i < 0:
+            self.reset_to_initial()
+            return None
+        self._current = self._checkpoint_states[i].copy()
+        return self._checkpoint_times[i]
+
+    def _record_checkpoint(self, t):
+        """Keep a copy of _real if the first action at a new time t comes
+        at least an interval after the last checkpoint."""
+        if self._interval is None or self._real_t is None or t <= self._real_t:
+            return
+        times = self._checkpoint_times
+        if len(times) > 0 and t < times[-1] + self._interval:
+            return
+        times.append(t)
+        self._checkpoint_states.append(self._real.copy())
+        if len(times) > self.max_checkpoints:
+            # thin out - keep every other one (the latest included)
+            self._checkpoint_times = times[::-2][::-1]
+            self._checkpoint_states = self._checkpoint_states[::-2][::-1]
+            self._interval = 2 * self._interval
+
     def get_vms(self):
         """return the VMs in the current state"""
         return self._current.vms
@@ -792,11 +1744,50 @@ class Cloud:
         self._current = self._current.transition(action, inplace=inplace)
         return self._current
 
-    def apply_real(self, action, inplace=False):
+    def checkpoint(self):
+        """Mark the current state, so that the actions applied after this
+        can be undone with rollback (without copying the state)."""
+        return self._current, self._current.checkpoint()
+
+    def rollback(self, token):
+        """Undo the actions applied to the current state since checkpoint."""
+        state, mark = token
+        state.rollback(mark)
+        self._current = state
+
+    def commit(self, token):
+        """Keep the actions applied since checkpoint."""
+        state, mark = token
+        state.commit(mark)
+
+    @contextmanager
+    def trial(self):
+        """Context manager for speculatively applying actions, e.g.:
+
+        with cloud.trial():
+            cloud.apply(action, inplace=True)
+            ... evaluate cloud.get_current() ...
+
+        The current state is rolled back when the block exits.
+
+        """
+        token = self.checkpoint()
+        try:
+            yield self._current
+        finally:
+            self.rollback(token)
+
+    def apply_real(self, action, inplace=False, t=None):
         """Apply an Action on the real state (reflecting the actual physical
-        state) and reset the virtual state."""
+        state) and reset the virtual state.
 
+        @param t: the time of the action, used to timestamp the real state
+        (see reset_to_time)
 
+        """
+        if t is not None:
+            self._record_checkpoint(t)
+            self._real_t = t
         self._real = self._real.transition(action, inplace=inplace)
         self.reset_to_real()
         return self._real
@@ -3,10 +3,12 @@ Created on Jul 11, 2013
 
 @author: kermit
 '''
+import pickle
 import unittest
 from mock import Mock, MagicMock
 
 from nose.tools import *
+import numpy as np
 import pandas as pd
 
 from philharmonic import *
@@ -761,6 +763,69 @@ def test_schedule_sorted():
     assert_sequence_equal(list(schedule.actions.values),
                           [a1, a2, a3, a4, a5, b1, b2])
 
+def test_schedule_add_keeps_order():
+    s1 = Server(4000, 2)
+    vms = [VM(2000, 1) for i in range(5)]
+    times = pd.date_range('2013-01-01 00:00', periods=4, freq='h')
+    schedule = Schedule()
+    expected = []
+    for i, t in reversed(list(enumerate(times))):
+        for vm in vms:
+            schedule.add(Migration(vm, s1), t)
+            schedule.add(VMRequest(vm, 'boot'), t)
+        expected = ([VMRequest(vm, 'boot') for vm in vms] +
+                    [Migration(vm, s1) for vm in vms] + expected)
+    assert_sequence_equal(list(schedule.actions.values), expected)
+    assert_true((schedule.actions.index == times.repeat(10)).all())
+    # the Series is created lazily and cached until the next change
+    assert_is(schedule.actions, schedule.actions)
+    copied = schedule.copy()
+    copied.add(Pause(vms[0]), times[0])
+    assert_equals(len(schedule.actions), 40)
+    assert_equals(len(copied.actions), 41)
+    assert_equals(len(copied.filter_current_actions(times[0],
+                                                    pd.offsets.Hour(1))), 11)
+
+def test_schedule_extend_like_add():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vms = [VM(2000, 1) for i in range(3)]
+    times = pd.date_range('2013-01-01 00:00', periods=3, freq='h')
+    batch = []
+    for i in range(30):
+        vm = vms[i % 3]
+        batch.append((times[i % 2 * 2], Migration(vm, [s1, s2][i % 5 // 3])))
+        batch.append((times[1], VMRequest(vm, 'boot')))
+    environment = Environment()
+    environment.period = pd.offsets.Hour(1)
+    added = Schedule()
+    added.environment = environment
+    for t, action in batch:
+        added.add(action, t)
+    extended = Schedule()
+    extended.environment = environment
+    extended.extend(batch[:10])
+    extended.extend(batch[10:])
+    assert_sequence_equal(list(extended.actions.items()),
+                          list(added.actions.items()))
+    # without an environment nothing is superseded
+    built = Schedule.from_arrays([t for t, a in batch], [a for t, a in batch])
+    assert_equals(len(built.actions), len(batch))
+    assert_true(built.actions.index.is_monotonic_increasing)
+
+def test_schedule_merge():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 1)
+    times = pd.date_range('2013-01-01 00:00', periods=4, freq='h')
+    schedule = Schedule.from_arrays(times, [Migration(vm1, s1)] * 4)
+    other = Schedule.from_arrays(times, [Migration(vm2, s1)] * 4)
+    merged = schedule.merge(other, times[1])
+    assert_sequence_equal(list(merged.actions.values),
+                          [Migration(vm1, s1)] * 2 + [Migration(vm2, s1)] * 2)
+    assert_true((merged.actions.index == times).all())
+    assert_equals(len(schedule.actions), 4)
+
 def test_hash_action():
     s1 = Server(4000, 2)
     s2 = Server(4000, 2)
@@ -771,6 +836,37 @@ def test_hash_action():
     assert_equals(hash(a1), hash(a2))
     assert_not_equals(hash(a1), hash(a3))
 
+def test_action_key():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    a1 = Migration(vm1, s1)
+    assert_equals(a1.key, (a1.rank(), vm1.id, s1.id))
+    assert_equals(Pause(vm1).vm, vm1)
+    assert_not_equals(Pause(vm1), Unpause(vm1))
+    assert_not_equals(VMRequest(vm1, 'boot'), VMRequest(vm1, 'delete'))
+    assert_equals(len(set([a1, Migration(vm1, s1), IncreaseFreq(s1)])), 2)
+    with assert_raises(AttributeError):
+        a1.server = Server(4000, 2) # immutable
+
+def test_pickle_slotted_model():
+    s1 = Server(4000, 2, location='A')
+    vm1 = VM(2000, 1)
+    vm1.beta = 0.5
+    actions = [Migration(vm1, s1), VMRequest(vm1, 'boot'), Pause(vm1)]
+    s1_copy, vm1_copy, actions_copy = pickle.loads(pickle.dumps(
+        (s1, vm1, actions)))
+    assert_equals(s1_copy.cap, s1.cap)
+    assert_equals(s1_copy.loc, 'A')
+    assert_equals(vm1_copy.beta, 0.5)
+    assert_equals(actions_copy, actions)
+    assert_equals(actions_copy[1].name, 'boot')
+    # state pickled from the old dict-based classes
+    old = VM.__new__(VM)
+    old.__setstate__({'id': vm1.id, 'spec': vm1.spec, 'res': vm1.spec,
+                      'price': 0.1, 'beta': 1.})
+    assert_equals(old, vm1)
+    assert_equals(old.res, vm1.res)
+
 def test_schedule_clean():
     schedule = Schedule()
     s1 = Server(4000, 2)
@@ -819,3 +915,327 @@ def test_vm_requests():
     cloud.apply(VMRequest(vm2, 'boot'))
     assert_not_in(vm1, cloud.vms, 'vm1 should be booted')
     assert_in(vm2, cloud.vms, 'vm1 should not be booted')
+
+def test_array_state_constraints():
+    Machine.resource_types = ['RAM', '#CPUs']
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 2)
+    a = ArrayState([s1, s2], set([vm1, vm2]))
+    a.place(vm1, s1)
+    assert_true(a.all_within_capacity())
+    assert_almost_equals(a.ratio_allocated(), 0.5)
+    a.place(vm2, s1)
+    assert_false(a.within_capacity(s1))
+    assert_equals(a.overcapacitated_servers(), set([s1]))
+    assert_almost_equals(a.ratio_within_capacity(), 0.5)
+    assert_true(a.all_allocated())
+    a.migrate(vm2, s2)
+    assert_true(a.all_within_capacity())
+    assert_equals(a.allocation(vm2), s2)
+    assert_equals(a.alloc[s1], set([vm1]))
+    assert_equals(a.free_cap[s1]['RAM'], 2000)
+    assert_equals(a.free_cap[s2]['#CPUs'], 2)
+
+def test_array_state_matches_state():
+    Machine.resource_types = ['RAM', '#CPUs']
+    s1 = Server(4000, 4)
+    s2 = Server(4000, 5)
+    vms = [VM(3000, 3), VM(3000, 3), VM(2100, 3), VM(2100, 3)]
+    states = [State([s1, s2], set(vms)), ArrayState([s1, s2], set(vms))]
+    for state in states:
+        state.place(vms[0], s1)
+        state.place(vms[1], s1)
+        state.place(vms[2], s2)
+        state.decrease_freq(s2)
+    expected, actual = states
+    assert_almost_equals(expected.capacity_penalty(),
+                         actual.capacity_penalty())
+    assert_equals(expected.calculate_utilisations(),
+                  actual.calculate_utilisations())
+    assert_equals(expected.freq_scale[s2], actual.freq_scale[s2])
+    assert_equals(expected.unallocated_vms(), actual.unallocated_vms())
+
+def test_array_state_copy():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    a = ArrayState([s1, s2], set([vm1]))
+    a.place(vm1, s1)
+    b = a.transition(Migration(vm1, s2))
+    c = b.transition(DecreaseFreq(s1))
+    assert_in(vm1, a.alloc[s1], 'changing one state must not affect the other')
+    assert_in(vm1, b.alloc[s2])
+    assert_equals(a.free_cap[s2]['RAM'], 8000)
+    assert_equals(b.free_cap[s2]['RAM'], 6000)
+    assert_equals(b.freq_scale[s1], 1.)
+    assert_equals(c.freq_scale[s1], 0.9)
+    d = c.transition(VMRequest(vm1, 'delete'))
+    assert_false(d.is_allocated(vm1))
+    assert_equals(d.free_cap[s2]['RAM'], 8000)
+
+def test_array_state_multicore_utilisation():
+    vm = VM(2000, 1)
+    s = Server(20000, 10)
+    w = [-1.362, 2.798, 1.31, 2.8]
+    states = [State([s], set([vm])), ArrayState([s], set([vm]))]
+    for state in states:
+        state.place(vm, s)
+    expected, actual = [state.utilisation(s, weights=w, method="multicore")
+                        for state in states]
+    assert_almost_equals(expected, actual)
+
+def test_cloud_state_class():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    cloud = Cloud([s1], [vm1], state_class=ArrayState)
+    assert_is_instance(cloud.get_current(), ArrayState)
+    cloud.apply(Migration(vm1, s1))
+    assert_equals(cloud.get_current().allocation(vm1), s1)
+    assert_equals(cloud._real.allocation(vm1), None)
+
+def test_state_vm_host_index():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(1000, 1)
+    a = State([s1, s2], set([vm1, vm2]))
+    a.place(vm1, s1)
+    a.place(vm2, s1)
+    assert_equals(a.allocation(vm1), s1)
+    b = a.copy()
+    b.migrate(vm1, s2)
+    assert_equals(a.allocation(vm1), s1, 'copies have their own index')
+    assert_equals(b.allocation(vm1), s2)
+    b.remove(vm1, s2)
+    assert_false(b.is_allocated(vm1))
+    assert_equals(b.unallocated_vms(), set([vm1]))
+    a.remove_all(s1)
+    assert_equals(a.allocation(vm2), None)
+    assert_equals(b.allocation(vm2), s1)
+    b.limit_to_server(s1)
+    assert_equals(b.vms, set([vm2]))
+    assert_equals(b.allocation(vm2), s1)
+    b.delete(vm2)
+    assert_false(b.is_allocated(vm2))
+
+def test_state_copy_on_write():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(1000, 1)
+    a = State([s1, s2], set([vm1, vm2]))
+    a.place(vm1, s1)
+    b = a.copy()
+    assert_is(a.alloc[s2], b.alloc[s2], 'untouched servers are shared')
+    b.place(vm2, s2)
+    assert_is_not(a.alloc[s2], b.alloc[s2])
+    assert_is(a.alloc[s1], b.alloc[s1])
+    assert_not_in(vm2, a.alloc[s2])
+    assert_equals(a.free_cap[s2]['RAM'], 8000)
+    # the original must not leak its changes into the copy either
+    a.remove(vm1, s1)
+    assert_in(vm1, b.alloc[s1])
+    assert_equals(b.free_cap[s1]['RAM'], 2000)
+    assert_equals(a.free_cap[s1]['RAM'], 4000)
+
+def _undo_log_actions(state_class):
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(1000, 1)
+    vm3 = VM(1000, 1)
+    cloud = Cloud([s1, s2], set([vm1, vm2]), state_class=state_class)
+    cloud.apply(Migration(vm1, s1), inplace=True)
+    cloud.apply(Migration(vm2, s1), inplace=True)
+    return cloud, [Migration(vm1, s2), DecreaseFreq(s1), Pause(vm2),
+                   VMRequest(vm3, 'boot'), Migration(vm3, s2),
+                   VMRequest(vm2, 'delete')]
+
+def _state_summary(state):
+    return (set(state.vms), {s: set(vms) for s, vms in state.alloc.items()},
+            {s: dict(cap) for s, cap in state.free_cap.items()},
+            dict(state.freq_scale), set(state.paused),
+            {vm: state.allocation(vm) for vm in state.vms})
+
+def test_cloud_trial_rollback():
+    for state_class in [State, ArrayState]:
+        cloud, actions = _undo_log_actions(state_class)
+        state = cloud.get_current()
+        before = _state_summary(state)
+        with cloud.trial():
+            for action in actions:
+                cloud.apply(action, inplace=True)
+            assert_not_equals(_state_summary(state), before)
+        assert_is(cloud.get_current(), state)
+        assert_equals(_state_summary(state), before)
+        assert_is_none(state._undo_log) # stopped recording
+
+def test_cloud_checkpoint_nested():
+    cloud, actions = _undo_log_actions(State)
+    before = _state_summary(cloud.get_current())
+    outer = cloud.checkpoint()
+    cloud.apply(actions[0], inplace=True)
+    after_first = _state_summary(cloud.get_current())
+    inner = cloud.checkpoint()
+    cloud.apply(actions[1], inplace=True)
+    cloud.rollback(inner)
+    assert_equals(_state_summary(cloud.get_current()), after_first)
+    # a non-inplace apply leaves the checkpointed state alone
+    cloud.apply(actions[2])
+    cloud.rollback(outer)
+    assert_equals(_state_summary(cloud.get_current()), before)
+
+def test_cloud_real_checkpoints():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm = VM(2000, 1)
+    cloud = Cloud([s1, s2], set([vm]))
+    cloud.checkpoint_interval = pd.offsets.Hour(1)
+    cloud._interval = cloud.checkpoint_interval
+    times = pd.date_range('2013-02-25 00:00', periods=4, freq='h')
+    for t, server in zip(times, [s1, s2, s1, s2]):
+        cloud.apply_real(Migration(vm, server), t=t)
+    assert_equals(cloud._checkpoint_times, list(times[1:]))
+    # the state before the actions at a checkpoint's time
+    since = cloud.reset_to_time(times[2] + pd.offsets.Minute(30))
+    assert_equals(since, times[2])
+    assert_equals(cloud.get_current().allocation(vm), s2)
+    assert_is_none(cloud.reset_to_time(times[0]))
+    assert_equals(cloud.get_current().allocation(vm), None)
+    # not before the last real action - the real state
+    assert_equals(cloud.reset_to_time(times[3]), times[3])
+    assert_equals(cloud.get_current().allocation(vm), s2)
+    # bounded memory - thinned out when max_checkpoints is exceeded
+    cloud.max_checkpoints = 2
+    cloud.apply_real(Migration(vm, s1), t=times[3] + pd.offsets.Hour(1))
+    assert_equals(len(cloud._checkpoint_times), 2)
+    assert_equals(cloud._checkpoint_times[-1], times[3] + pd.offsets.Hour(1))
+
+def test_schedule_clean_server_actions():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    t1 = pd.Timestamp('2013-01-01 00:00')
+    t2 = pd.Timestamp('2013-01-01 01:00')
+    a1 = DecreaseFreq(s1)
+    a2 = DecreaseFreq(s2)
+    a3 = DecreaseFreq(s1)
+    b1 = Migration(vm1, s1)
+    b2 = Migration(vm1, s2)
+    schedule = Schedule.from_arrays([t1, t1, t1, t1, t1, t2],
+                                    [a1, a2, a3, b1, b2, a1])
+    schedule.clean()
+    # only exact duplicates of actions on servers are removed
+    assert_sequence_equal(list(schedule.actions.values), [a2, a3, b2, a1])
+    assert_sequence_equal(list(schedule.actions.index), [t1, t1, t1, t2])
+
+def test_schedule_codes():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 1)
+    t1 = pd.Timestamp('2013-01-01 00:00')
+    t2 = pd.Timestamp('2013-01-01 01:00')
+    actions = [Migration(vm1, s1), VMRequest(vm2, 'boot'), Pause(vm1),
+               IncreaseFreq(s1), VMRequest(vm2, 'delete'), Unpause(vm1)]
+    schedule = Schedule.from_arrays([t1, t1, t1, t2, t2, t2], actions)
+    decoded = Schedule.from_codes(schedule.codes(),
+                                  {vm1.id: vm1, vm2.id: vm2}, {s1.id: s1})
+    assert_sequence_equal(list(decoded.actions.values),
+                          list(schedule.actions.values))
+    assert_sequence_equal(list(decoded.actions.index),
+                          list(schedule.actions.index))
+    assert_equals(decoded.actions.iloc[0].what, 'boot')
+    # the VMs have to be known
+    assert_raises(KeyError, Schedule.from_codes, schedule.codes(),
+                  {vm1.id: vm1}, {s1.id: s1})
+
+def test_n_resources():
+    resource_types = Machine.resource_types
+    Machine.resource_types = ['RAM', '#CPUs', 'disk IO', 'GPUs']
+    try:
+        s1 = Server(8000, 4, 100, 2)
+        s2 = Server(8000, 4, 100, 0)
+        vm1 = VM(2000, 1, 50, 1)
+        vm2 = VM(2000, 1, 10, 1)
+        for state_class in [State, ArrayState]:
+            state = state_class([s1, s2], set([vm1, vm2]))
+            assert_equals(state.free_vector(s1).dtype, np.float32)
+            state.place(vm1, s1)
+            assert_equals(state.free_cap[s1]['GPUs'], 1)
+            assert_almost_equals(state.utilisation(s1),
+                                 (0.25 + 0.25 + 0.5 + 0.5) / 4)
+            state.place(vm2, s2)
+            assert_equals(state.overcapacitated_servers(), set([s2]))
+            assert_equals(state.capacity_penalty(), 1.) # no GPUs on s2
+            state.migrate(vm2, s1)
+            assert_true(state.all_within_capacity())
+            assert_equals(state.free_cap[s1]['disk IO'], 40)
+    finally:
+        Machine.resource_types = resource_types
+
+def test_state_aggregates():
+    Machine.resource_types = ['RAM', '#CPUs']
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(4000, 2)
+    a = State([s1, s2], set([vm1, vm2]))
+    def check():
+        weights = dict(Machine.weights) # not cached - calculated in full
+        for s in [s1, s2]:
+            assert_almost_equals(a.utilisation(s),
+                                 a.utilisation(s, weights))
+        expected = set(s for s in [s1, s2] if not a.within_capacity(s))
+        assert_equals(a.overcapacitated_servers(), expected)
+        assert_equals(a.ratio_allocated(),
+                      1 - len(a.unallocated_vms()) / 2.)
+    a.place(vm1, s1)
+    check()
+    token = a.checkpoint()
+    a.migrate(vm2, s1)
+    check()
+    assert_almost_equals(a.capacity_penalty(), 0.5 / 2)
+    b = a.copy()
+    a.remove_all(s1)
+    check()
+    assert_almost_equals(a.ratio_within_capacity(), 1.)
+    a.rollback(token)
+    check()
+    assert_almost_equals(a.ratio_allocated(), 0.5)
+    assert_equals(b.overcapacitated_servers(), set([s1]))
+    assert_almost_equals(b.calculate_utilisations()[s1], 1.)
+
+def test_state_fingerprint():
+    Machine.resource_types = ['RAM', '#CPUs']
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 1)
+    fingerprints = []
+    for state_class in [State, ArrayState]:
+        a = state_class([s1, s2], set([vm1, vm2]))
+        b = state_class([s1, s2], set([vm1, vm2]))
+        empty = a.fingerprint
+        a.place(vm1, s1)
+        a.place(vm2, s2)
+        b.place(vm2, s1)
+        assert_not_equals(a.fingerprint, b.fingerprint)
+        b.migrate(vm2, s2)
+        b.place(vm1, s2)
+        b.migrate(vm1, s1)
+        assert_equals(a.fingerprint, b.fingerprint)
+        c = a.copy()
+        token = c.checkpoint()
+        c.remove_all(s1)
+        c.decrease_freq(s2)
+        assert_not_equals(c.fingerprint, a.fingerprint)
+        c.increase_freq(s2)
+        c.remove_all(s2)
+        assert_equals(c.fingerprint, empty)
+        c.rollback(token)
+        assert_equals(c.fingerprint, a.fingerprint)
+        fingerprints.append(a.fingerprint)
+    # the same allocation has the same fingerprint in both representations
+    assert_equals(fingerprints[0], fingerprints[1])
@@ -1,12 +1,13 @@
+import numpy as np
+
 from philharmonic.scheduler.ischeduler import IScheduler
-from philharmonic import Schedule, Migration
+from philharmonic import Schedule, Migration, resource_key
 from philharmonic import calculate_pue
 from philharmonic import conf
 
 def sort_vms_big_first(VMs):
     """Sort VMs by resource size - bigger first."""
-    return sorted(VMs, key=lambda x : (x.res['#CPUs'], x.res['RAM']),
-                  reverse=True)
+    return sorted(VMs, key=lambda x : resource_key(x.vec), reverse=True)
 
 def sort_active_pms(PMs, state, cost):
     """Sort by free capacity increasing (fill out almost full servers first),
@@ -17,23 +18,19 @@ def sort_active_pms(PMs, state, cost):
 
     """
 
-    # TODO: don't hardcode the resources
     return sorted(PMs,
-                  key=lambda x : (state.free_cap[x]['#CPUs'],
-                                  state.free_cap[x]['RAM'],
-                                  cost[x.loc]))
+                  key=lambda x : (resource_key(state.free_vector(x)) +
+                                  (cost[x.loc],)))
 def sort_inactive_pms(PMs, state, cost):
     """Sort by preferring bigger hosts, then by cost
     for waking up inactive hosts.
     e.g. desired: (4 GB, $0.04), (4 GB, $0.08), (2 GB, $0.08)
     """
 
-    # TODO: don't hardcode the resources
     # TODO: check if cost more important in other scenarios
     return sorted(PMs,
-                  key=lambda x : (-state.free_cap[x]['#CPUs'],
-                                  -state.free_cap[x]['RAM'],
-                                  cost[x.loc]))
+                  key=lambda x : (resource_key(-state.free_vector(x)) +
+                                  (cost[x.loc],)))
 
 class BCFScheduler(IScheduler):
     """Best Cost Fit (BCF) scheduling algorithm. Greedily places VMs on servers
@@ -46,25 +43,14 @@ class BCFScheduler(IScheduler):
         or -1 in case some resource's capacity is exceeded.
 
         """
-        # TODO: reuse free_cap data
         # TODO: this method should probably be a part of Cloud
         current = self.cloud.get_current()
-        total_utilisation = 0.
-        utilisations = {}
-        for i in server.resource_types:
-            used = 0.
-            for existing_vm in current.alloc[server]:
-                used += existing_vm.res[i]
-            # add our own VM's resource demand
-            used += vm.res[i]
-            utilisations[i] = used/server.cap[i]
-            if used > server.cap[i]: # capacity exceeded for this resource
-                return -1
-        uniform_weight = 1./len(server.resource_types)
-        weights = {res : uniform_weight for res in server.resource_types}
-        for resource_type, utilisation in utilisations.items():
-            total_utilisation += weights[resource_type] * utilisation
-        return total_utilisation
+        # resources used by the allocated VMs and our own VM's demand
+        used = server.vec - current.free_vector(server) + vm.vec
+        if (used > server.vec).any(): # capacity exceeded for some resource
+            return -1
+        # uniformly weighted utilisation of the resources
+        return float(np.divide(used, server.vec, dtype=float).mean())
 
     def _place(self, vm, host, t):
         """Place vm on host. A migration will be scheduled if necessary or
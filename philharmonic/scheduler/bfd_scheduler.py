@@ -1,14 +1,13 @@
+import numpy as np
+
 from philharmonic.scheduler.ischeduler import IScheduler
-from philharmonic import Schedule, Migration
+from philharmonic import Schedule, Migration, resource_key
 
 def sort_vms_decreasing(VMs):
-    return sorted(VMs, key=lambda x : (x.res['#CPUs'], x.res['RAM']),
-                  reverse=True)
+    return sorted(VMs, key=lambda x : resource_key(x.vec), reverse=True)
 
 def sort_pms_increasing(PMs, state):
-    return sorted(PMs,
-                  key=lambda x : (state.free_cap[x]['#CPUs'],
-                                  state.free_cap[x]['RAM']))
+    return sorted(PMs, key=lambda x : resource_key(state.free_vector(x)))
 
 class BFDScheduler(IScheduler):
     """Best fit decreasing (BFD) scheduler, as proposed for
@@ -25,25 +24,14 @@ class BFDScheduler(IScheduler):
         or -1 in case some resource's capacity is exceeded.
 
         """
-        # TODO: reuse free_cap data
         # TODO: this method should probably be a part of Cloud
         current = self.cloud.get_current()
-        total_utilisation = 0.
-        utilisations = {}
-        for i in server.resource_types:
-            used = 0.
-            for existing_vm in current.alloc[server]:
-                used += existing_vm.res[i]
-            # add our own VM's resource demand
-            used += vm.res[i]
-            utilisations[i] = used/server.cap[i]
-            if used > server.cap[i]: # capacity exceeded for this resource
-                return -1
-        uniform_weight = 1./len(server.resource_types)
-        weights = {res : uniform_weight for res in server.resource_types}
-        for resource_type, utilisation in utilisations.items():
-            total_utilisation += weights[resource_type] * utilisation
-        return total_utilisation
+        # resources used by the allocated VMs and our own VM's demand
+        used = server.vec - current.free_vector(server) + vm.vec
+        if (used > server.vec).any(): # capacity exceeded for some resource
+            return -1
+        # uniformly weighted utilisation of the resources
+        return float(np.divide(used, server.vec, dtype=float).mean())
 
     def _place(self, vm, host, t):
         """Place vm on host. A migration will be scheduled if necessary or
@@ -3,6 +3,9 @@ performed schedule of actions.
 """
 
 import math
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+
 import pandas as pd
 import numpy as np
 import philharmonic as ph
@@ -31,125 +34,166 @@ def print_history(cloud, environment, schedule):
 # TODO: add optional start, end limiters for evaluating a certain period
 
 def calculate_cloud_utilisation(cloud, environment, schedule,
-                                start=None, end=None, method="basic"):
+                                start=None, end=None, method="basic",
+                                replay=None):
     """Calculate utilisations of all servers based on the given schedule.
 
     @param start, end: if given, only this period will be counted,
     cloud model starts from _real. If not, whole environment.start-end
     counted and the first state is _initial.
+    @param replay: the result of replay_schedule to take the values from
+    (otherwise the schedule is replayed)
     """
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
-    #TODO: use more precise pandas methods for indexing (performance)
-    #TODO: maybe move some of this state iteration functionality into Cloud
-    #TODO: see where schedule window should be propagated - here or Scheduler?
-    initial_utilisations = cloud.get_current().calculate_utilisations(method, conf.utilisation_weights)
-    utilisations_list = [initial_utilisations]
-    times = [start]
-    for t in schedule.actions.index.unique():
-        if t == start: # we change the initial utilisation right away
-            utilisations_list = []
-            times = []
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            for action in schedule.actions[t].values:
-                cloud.apply(action)
-        else:
-            action = schedule.actions[t]
-            cloud.apply(action)
-        state = cloud.get_current()
-        new_utilisations = state.calculate_utilisations(method, conf.utilisation_weights)
-        utilisations_list.append(new_utilisations)
-        times.append(t)
-    if times[-1] < end:
-        # the last utilisation values hold until the end - duplicate last
-        times.append(end)
-        utilisations_list.append(utilisations_list[-1])
-    df_util = pd.DataFrame(utilisations_list, times)
-    return df_util
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=method)
+    return replay.server_frame(replay.util)
 
 def precreate_synth_power(start, end, servers):
-    # P_peak = conf.P_peak
-    # P_idle = conf.P_idle
-    # globals()['P_idle'] = P_idle
-    # P_delta = P_peak - P_idle
-    # power_freq = conf.power_freq
-
-    # index = pd.date_range(start, end, freq=power_freq)
-    # P_synth_flat = pd.DataFrame({s: P_delta for s in servers}, index)
-    # globals()['P_synth_flat'] = P_synth_flat
-
-    full_util = {server: [1.0, 1.0] for server in servers}
-    full_util = pd.DataFrame(full_util, index=[start, end])
-    full_util = full_util.resample('H').ffill()  # Resample and forward fill
-    globals()['full_util'] = full_util
-    globals()['cached_end'] = None
-
-# TODO: get rid of this globals nonsense and create a Class (or a generator)
-def generate_cloud_power(util, freq=None, active_cores=None, max_cores=None,
-                         power_model=None, start=None, end=None):
-    """Create power signals from varying utilisation rates."""
-    # TODO: generate active_cores
+    """Prepare the worst case utilisation for evaluate (on the shared
+    default_evaluator)."""
+    default_evaluator.precreate_synth_power(start, end, servers)
+
+def _power_base(util, freq, active_cores, max_cores, out=None):
+    return ph.calculate_power_array(util, conf.P_idle, conf.P_peak, out=out)
+
+def _power_freq(util, freq, active_cores, max_cores, out=None):
+    return ph.calculate_power_freq_array(
+        util, f=freq, P_idle=conf.P_idle, P_base=conf.P_base,
+        P_dif=conf.P_dif, f_base=conf.f_base, out=out
+    )
+
+def _power_multicore(util, freq, active_cores, max_cores, out=None):
+    return ph.calculate_power_multicore_array(
+        util, freq, active_cores, max_cores,
+        freq_abs_min=conf.freq_abs_min, freq_abs_delta=conf.freq_abs_delta,
+        power_weights=conf.power_weights, out=out
+    )
+
+# conf.power_model -> power of the servers from raw arrays
+power_models = {
+    "base": _power_base,
+    "freq": _power_freq,
+    "multicore": _power_multicore,
+}
+
+def calculate_power_values(util, freq=None, active_cores=None, max_cores=None,
+                           power_model=None, out=None):
+    """Power from the utilisation (and frequency, core) arrays of the
+    servers with a model from power_models - no DataFrames involved.
+
+    @param out: array to write the power into (e.g. reused in a loop)
+
+    """
     if power_model is None:
         power_model = conf.power_model
+    model = power_models.get(power_model)
+    if model is None:
+        raise ValueError("Power model {} not supported.".format(power_model))
     if freq is None:
         freq = 2000
-    if power_model == "base":
-        power = ph.calculate_power(util, conf.P_idle, conf.P_peak)
-    elif power_model == "freq":
-        power = ph.calculate_power_freq(
-            util, f=freq, P_idle=conf.P_idle, P_base=conf.P_base,
-            P_dif=conf.P_dif, f_base=conf.f_base
-        )
-    elif power_model == "multicore":
-        if active_cores is None:
-            active_cores = 1
-        if max_cores is None:
-            max_cores = 1
-        power = ph.calculate_power_multicore(
-            util, freq, active_cores, max_cores,
-            freq_abs_min=conf.freq_abs_min, freq_abs_delta=conf.freq_abs_delta,
-            power_weights=conf.power_weights
-        )
-    else:
-        raise ValueError("Power model {} not supported.".format(power_model))
+    if active_cores is None:
+        active_cores = 1
+    if max_cores is None:
+        max_cores = 1
+    return model(util, freq, active_cores, max_cores, out=out)
+
+def _values_like(frame, util):
+    """The values of frame (or a scalar) aligned with util."""
+    if not isinstance(frame, pd.DataFrame):
+        return frame
+    if not (frame.index.equals(util.index) and
+            frame.columns.equals(util.columns)):
+        frame = frame.reindex(index=util.index, columns=util.columns)
+    return frame.values
+
+def generate_cloud_power(util, freq=None, active_cores=None, max_cores=None,
+                         power_model=None, start=None, end=None,
+                         resample=True):
+    """Create power signals from varying utilisation rates.
 
-    power = power.resample(conf.power_freq).ffill()  # Resample and forward fill
+    @param resample: resample to conf.power_freq and add the measurement
+    noise; otherwise the power only changes where the inputs do
+    (piecewise-constant, for the exact integration)
 
-    power[power > 0] += conf.P_std * np.random.randn(*power.shape)
+    """
+    # TODO: generate active_cores
+    power = calculate_power_values(
+        util.values, _values_like(freq, util), _values_like(active_cores, util),
+        _values_like(max_cores, util), power_model
+    )
+    power = pd.DataFrame(power, util.index, util.columns)
+
+    if resample:
+        power = power.resample(conf.power_freq).ffill() # Resample and ffill
+        power[power > 0] += conf.P_std * np.random.randn(*power.shape)
     return power
 
-def calculate_cloud_cost(power, el_prices):
-    """Take power and el. prices DataFrames & calc. the el. cost."""
+def _server_locations(servers):
+    """The location index of every server and the locations (in the order
+    in which they first appear)."""
+    return pd.factorize(pd.Index([server.loc for server in servers]))
+
+def _sum_per_location(values, codes, num_locations):
+    """Sum up the last axis of the values (a server each) per location."""
+    if num_locations == 0:
+        return values[..., :0]
+    order = np.argsort(codes, kind='stable')
+    starts = np.searchsorted(codes[order], np.arange(num_locations))
+    return np.add.reduceat(values[..., order], starts, axis=-1)
+
+def location_sum(frame):
+    """Sum up the columns of the servers at the same location.
+
+    @param frame: DataFrame with a column per server (e.g. power)
+    @returns: DataFrame with a column per location
+
+    """
+    codes, locations = _server_locations(frame.columns)
+    values = _sum_per_location(frame.values, codes, len(locations))
+    return pd.DataFrame(values, index=frame.index, columns=locations)
+
+def _per_column(by_location, columns):
+    """Take the by_location column for each of columns (servers, or
+    locations already) in one go, labelled like columns."""
+    locations = [column.loc if isinstance(column, ph.Machine) else column
+                 for column in columns]
+    return by_location[locations].set_axis(columns, axis=1)
+
+def calculate_cloud_cost(power, el_prices, exact=False):
+    """Take power and el. prices DataFrames & calc. the el. cost.
+
+    @param power: a column per server or per location (see location_sum,
+    cheaper when there are many servers per location)
+    @param exact: power is piecewise-constant (not resampled) - integrate
+    it exactly over the price changes
+
+    """
     start = power.index[0]
     end= power.index[-1]
-    el_prices_loc = pd.DataFrame()
-    for server in power.columns: # this might be very inefficient
-        loc = server.loc
-        el_prices_loc[server] = el_prices[loc][start:end]
+    el_prices_loc = _per_column(el_prices[start:end], power.columns)
+    if exact:
+        return ph.calculate_price_piecewise(power, el_prices_loc)
     cost = ph.calculate_price(power, el_prices_loc)#ph.calculate_price_mean(power, el_prices_loc)
     return cost
 
-def calculate_cloud_cooling(power, temperature):
+def calculate_cloud_cooling(power, temperature, exact=False):
     """Take power and temperature DataFrames & calculate the power with
     cooling overhead.
 
+    @param power: a column per server or per location (see location_sum)
+    @param exact: power is piecewise-constant (not resampled) - keep the
+    changes of both power and temperature
+
     """
     start = power.index[0]
     end= power.index[-1]
-    temperature_server = pd.DataFrame()
-    for server in power.columns: # this might be very inefficient
-        loc = server.loc
-        temperature_server[server] = temperature[loc][start:end]
-    #cost = ph.calculate_price(power, el_prices_loc)
-    power_with_cooling = ph.calculate_cooling_overhead(power,
-                                                       temperature_server)
-    return power_with_cooling
+    pPUE = ph.calculate_pue(temperature[start:end]) # once per location
+    if exact:
+        power, pPUE = ph.align_piecewise(power, pPUE)
+    else:
+        pPUE = pPUE.reindex(power.index, method='ffill')
+    return power * _per_column(pPUE, power.columns)
 
 def _get_freq_or_none(cloud, environment, schedule, start, end):
 
@@ -171,52 +215,71 @@ def _worst_case_power(cloud, environment, start, end): # TODO: use this
 
 def calculate_components(cloud, environment, schedule, el_prices,
                          temperature=None, start=None, end=None,
-                         power_model=None):
+                         power_model=None, replay=None, exact=False,
+                         per_location=False):
     """Calculate all the components that can be gathered based on the
-    power model, whether or not we use temperatures etc."""
+    power model, whether or not we use temperatures etc.
+
+    @param exact: keep the power piecewise-constant (only changing with the
+    schedule and temperatures) instead of resampling it to conf.power_freq
+    @param per_location: sum up the power of the servers per location
+    (see location_sum) before adding the cooling overhead
+
+    """
     if power_model is None:
         power_model = conf.power_model
-    # we first calculate utilisation/freq with start, end = None / timestamp
-    # this way it knows which state to start from
-    # (this is a temp. hack until cloud states get timestamped)
-    util = calculate_cloud_utilisation(cloud, environment, schedule, start, end,
-                                       method=power_model)
+    # utilisation, frequencies and active cores all come from one pass
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=power_model)
+    util = calculate_cloud_utilisation(cloud, environment, schedule,
+                                       replay=replay)
     freq = None
     active_cores = None
     max_cores = None
     if power_model == "freq" or power_model == "multicore":
-        freq = calculate_cloud_frequencies(
-            cloud, environment, schedule, start, end
-        )
+        freq = calculate_cloud_frequencies(cloud, environment, schedule,
+                                           replay=replay)
         if power_model == "multicore":
             # calculate everything necessary for the multicore power model
             active_cores = calculate_cloud_active_cores(
-                cloud, environment, schedule, start, end
+                cloud, environment, schedule, replay=replay
             )
-            max_cores = {s: s.cap['#CPUs'] for s in cloud.servers}
+            cores = ph.Machine.core_resource
+            max_cores = {s: s.cap[cores] for s in cloud.servers}
             max_cores = pd.DataFrame(max_cores, index=active_cores.index)
 
     power_IT = generate_cloud_power(util, freq=freq, active_cores=active_cores,
-                                 max_cores=max_cores)
+                                 max_cores=max_cores, resample=not exact)
+    if per_location:
+        power_IT = location_sum(power_IT)
     if start is None:
         start = environment.start
     if end is None:
         end = environment.end
     if temperature is not None:
-        power_total = calculate_cloud_cooling(power_IT, temperature[start:end])
+        power_total = calculate_cloud_cooling(power_IT, temperature[start:end],
+                                              exact)
     else:
         power_total = power_IT
 
     return util, power_IT, power_total, freq
 
 def combined_cost(cloud, environment, schedule, el_prices, temperature=None,
-                  start=None, end=None, power_model=None):
+                  start=None, end=None, power_model=None, replay=None,
+                  exact=False):
     """Calculate energy costs including IT equipment energy cooling overhead and
-    the real-time electricity price."""
+    the real-time electricity price.
+
+    @param exact: integrate the piecewise-constant power exactly instead of
+    resampling it (see calculate_components)
+
+    """
     _, _, power, _ = calculate_components(cloud, environment, schedule, el_prices,
-                                       temperature, start, end, power_model)
+                                       temperature, start, end, power_model,
+                                       replay, exact, per_location=True)
 
-    cost = calculate_cloud_cost(power, el_prices[start:end])
+    cost = calculate_cloud_cost(power, el_prices[start:end], exact)
     total_cost = cost.sum() # for the whole cloud
     return total_cost
 
@@ -239,7 +302,7 @@ def normalised_combined_cost(cloud, environment, schedule,
     utilisations = {server : [1.0, 1.0] for server in cloud.servers}
     full_util = pd.DataFrame(utilisations,
                              index=[start, end])
-    full_power = generate_cloud_power(full_util)
+    full_power = location_sum(generate_cloud_power(full_util))
     if temperature is not None:
         full_power = calculate_cloud_cooling(full_power, temperature[start:end])
     cost = calculate_cloud_cost(full_power, el_prices[start:end])
@@ -250,9 +313,13 @@ def normalised_combined_cost(cloud, environment, schedule,
     return normalised
 
 def combined_energy(cloud, environment, schedule, temperature=None,
-                    start=None, end=None, power_model=None):
+                    start=None, end=None, power_model=None, replay=None,
+                    exact=False):
     """Calculate energy of IT equipment and cooling if temperature provided.
 
+    @param exact: integrate the piecewise-constant power exactly instead of
+    resampling it (see calculate_components)
+
     @returns: energy in kWh
 
     """
@@ -260,24 +327,28 @@ def combined_energy(cloud, environment, schedule, temperature=None,
 
     if power_model is None:
         power_model = conf.power_model
-    # we first calculate utilisation with start, end = None / some timestamp
-    # this way it knows which state to start from
-    # (this is a temp. hack until cloud states get timestamped)
-    util = calculate_cloud_utilisation(cloud, environment, schedule, start, end,
-                                       method=conf.power_model)
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=conf.power_model)
+    util = calculate_cloud_utilisation(cloud, environment, schedule,
+                                       replay=replay)
     if start is None:
         start = environment.start
     if end is None:
         end = environment.end
     if conf.power_freq_model:
         freq = calculate_cloud_frequencies(cloud, environment, schedule,
-                                           start, end)
+                                           replay=replay)
     else:
         freq = None
-    power = generate_cloud_power(util, freq=freq)
-    if temperature is not None:
-        power = calculate_cloud_cooling(power, temperature[start:end])
-    energy = ph.calculate_energy(power)
+    power = generate_cloud_power(util, freq=freq, resample=not exact)
+    if temperature is not None: # the pPUE per location, not per server
+        power = location_sum(power)
+        power = calculate_cloud_cooling(power, temperature[start:end], exact)
+    if exact:
+        energy = ph.integrate_piecewise(power)
+    else:
+        energy = ph.calculate_energy(power)
     energy_total = energy.sum() # for the whole cloud
     energy_total = ph.joul2kwh(energy_total)
     return energy_total
@@ -287,7 +358,7 @@ def combined_energy(cloud, environment, schedule, temperature=None,
 #------------------------
 
 def calculate_constraint_penalties(cloud, environment, schedule,
-                                   start=None, end=None):
+                                   start=None, end=None, replay=None):
     """Find all violated hard constraints for the given schedule
     and calculate appropriate penalties.
 
@@ -302,41 +373,26 @@ def calculate_constraint_penalties(cloud, environment, schedule,
     """
     cap_weight, sched_weight = 0.6, 0.4
 
-    utilisations = {server : [] for server in cloud.servers}
-    penalties = {}
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
-    # if no actions - scheduling penalty for >0 VMs
-    penalties[start] = sched_weight * np.sign(len(cloud.vms))
-    for t in schedule.actions[start:end].index.unique():
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            for action in schedule.actions[t].values:
-                cloud.apply(action)
-        else:
-            action = schedule.actions[t]
-            cloud.apply(action)
-        state = cloud.get_current()
-        # find violated server capacity constraints - how many violations
-        cap_penalty = 1 - state.ratio_within_capacity()
-        # find unscheduled VMs - how many are not allocated
-        sched_penalty = 1 - state.ratio_allocated()
-        penalty = cap_weight * cap_penalty + sched_weight * sched_penalty
-        penalties[t] = penalty
-    if len(schedule.actions) > 0:
-        penalties[end] = penalty # last penalty holds 'til end
-
-    penalties = pd.Series(penalties)
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=None)
+    # find violated server capacity constraints - how many violations
+    # and unscheduled VMs - how many are not allocated
+    penalties = (cap_weight * replay.overcap_ratio
+                 + sched_weight * replay.sched_penalty)
+    penalties = pd.Series(penalties, replay.times)[:replay.end]
+    if replay.initial:
+        # if no actions - scheduling penalty for >0 VMs
+        penalties.iloc[0] = sched_weight * np.sign(len(replay.initial_vms))
+    if len(penalties) == int(replay.initial) + int(replay.held):
+        penalties = penalties[:1] # no actions in the period
+    elif penalties.index[-1] < replay.end:
+        penalties[replay.end] = penalties.iloc[-1] # last penalty holds 'til end
     constraint_penalty = ph.weighted_mean(penalties)
     return constraint_penalty
 
 def calculate_sla_penalties(cloud, environment, schedule,
-                            start=None, end=None):
+                            start=None, end=None, replay=None):
     """One migration per VM: 0.0; more migrations - closer to 1.0.
 
     @param start, end: if given, only this period will be counted,
@@ -344,23 +400,12 @@ def calculate_sla_penalties(cloud, environment, schedule,
     counted and the first state is _initial.
 
     """
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=None)
+    start, end = replay.start, replay.end
     # count migrations
-    migrations_num = {vm: 0 for vm in cloud.vms}
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
-    for t in schedule.actions[start:end].index.unique():
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            for action in schedule.actions[t].values:
-                migrations_num[action.vm] += 1
-        else:
-            action = schedule.actions[t]
-            migrations_num[action.vm] += 1
+    migrations_num = replay.migrations_num(until=end)
     migrations_num = pd.Series(migrations_num)
     if len(migrations_num) == 0:
         return 0. # no migrations - awesome!
@@ -383,11 +428,52 @@ T_mig = lambda V_mig, R : V_mig/(R/8.) # R assumed to be in Mb/s
 R, D = 1000, 300
 V_thd = 100 # MB; treshold after which post-copying starts
 
+def migration_overheads(replay, el_prices):
+    """The overhead of all the migrations in the replay (until its end) at
+    once, using the Liu et al. model and the mean electricity price between
+    the source and target locations.
+
+    @returns: DataFrame indexed by the migration times with the vm, source,
+    target, n (pre-copy iterations), data (MB), energy (kWh), price ($/kWh)
+    and cost ($) columns
+
+    """
+    migrations = [m for m in replay.migrations if m[0] <= replay.end]
+    times = pd.DatetimeIndex([t for t, vm, source, target in migrations])
+    vms = [vm for t, vm, source, target in migrations]
+    sources = [source for t, vm, source, target in migrations]
+    targets = [target for t, vm, source, target in migrations]
+
+    rows = el_prices.index.get_indexer(times)
+    if (rows < 0).any():
+        raise KeyError(times[rows < 0][0])
+    prices = el_prices.values
+    price_before = prices[rows, el_prices.columns.get_indexer(
+        [s.loc for s in sources])]
+    price_after = prices[rows, el_prices.columns.get_indexer(
+        [s.loc for s in targets])]
+    mean_el_price = (price_before + price_after) / 2.
+
+    memory = np.array([vm.res['RAM'] for vm in vms], dtype=float) * 1000 # MB
+    if D == R:
+        n = np.ones(len(memory), dtype=int)
+    else:
+        with np.errstate(divide='ignore'):
+            n = np.ceil(np.log(V_thd / memory) / np.log(D / float(R)))
+        n[memory == 0] = 1 # TODO: check what raises this error
+        n = n.astype(int)
+    migration_data = V_mig(memory, R, D, n)
+    energy = ph.joul2kwh(E_mig(migration_data)) # Joules -> kWh
+    return pd.DataFrame({'vm': vms, 'source': sources, 'target': targets,
+                         'n': n, 'data': migration_data, 'energy': energy,
+                         'price': mean_el_price,
+                         'cost': energy * mean_el_price}, times)
+
 def calculate_migration_overhead(cloud, environment, schedule,
-                                 start=None, end=None):
+                                 start=None, end=None, replay=None):
     """For every migration, calculate the energy using the  Liu et al. model,
     take the mean electricity price between the current and target locations,
-    and calculate the resulting cost.
+    and calculate the resulting cost (see migration_overheads).
 
     @param start, end: if given, only this period will be counted,
     cloud model starts from _real. If not, whole environment.start-end
@@ -396,53 +482,11 @@ def calculate_migration_overhead(cloud, environment, schedule,
     @returns: energy in kWh, cost in $
 
     """
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
-
-    total_energy = 0.
-    total_cost = 0.
-    for t in schedule.actions[start:end].index.unique():
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            actions = [action for action in schedule.actions[t].values]
-        else:
-            actions = [schedule.actions[t]]
-        for action in actions:
-            if action.name not in set(['boot', 'delete', 'migrate']):
-                continue # we're not interested in other actions
-            before = cloud.get_current()
-            host_before = before.allocation(action.vm)
-            cloud.apply(action)
-            after = cloud.get_current()
-            host_after = after.allocation(action.vm)
-            #if host_before or host_after is None, it's a boot/delete
-            if (action.name == 'migrate' and host_before and
-                host_after and host_before != host_after):
-                price_before = environment.el_prices[host_before.loc][t]
-                price_after = environment.el_prices[host_after.loc][t]
-                mean_el_price = (price_before + price_after) / 2.
-
-                memory = action.vm.res['RAM'] * 1000 # MB
-                try:
-                    n = int(math.ceil(math.log(V_thd/float(memory),
-                                               D/float(R))))
-                except ZeroDivisionError:
-                    n = 1 # TODO: check what raises this error
-                migration_data = V_mig(memory, R, D, n)
-                energy = E_mig(migration_data) # Joules
-                energy = ph.joul2kwh(energy) # kWh
-                total_energy += energy
-                cost = energy * mean_el_price
-                total_cost += cost
-    return total_energy, total_cost
-
-# TODO: utilisation, constraint and sla penalties could all be
-# calculated in one pass through the states
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=None)
+    overheads = migration_overheads(replay, environment.el_prices)
+    return float(overheads['energy'].sum()), float(overheads['cost'].sum())
 
 # TODO: add migration energy overhead into the energy calculation
 
@@ -462,167 +506,260 @@ def calculate_migration_overhead(cloud, environment, schedule,
 #   - calculate simple measure of utilisation * el_price
 #      - e.g. utilprice = tot_util * el_price
 
-def _calculate_constraint_penalty(state):
-    # find violated server capacity constraints - how many violations
-    cap_penalty = state.capacity_penalty()
-    # find unscheduled VMs - how many are not allocated
-    sched_penalty = 1 - state.ratio_allocated()
-    return cap_penalty, sched_penalty
-
-def _reset_cloud_state(cloud, environment, start=None, end=None):
+def _reset_cloud_state(cloud, environment, start=None, end=None,
+                       schedule=None):
     """Undo any actions applied after the _real (if start given)
     or _initial state (if start is None).
 
+    If start is before the last real action, the cloud starts from the
+    nearest timestamped checkpoint of the real state instead and, given the
+    schedule, the actions between the checkpoint and start are applied.
+
     """
     if start is None:
         start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
+        cloud.reset_to_initial()
     else:
-        cloud.reset_to_real()
+        since = cloud.reset_to_time(start)
+        if schedule is not None and since != start \
+           and len(schedule.actions) > 0:
+            times = schedule.actions.index
+            replay = times < start
+            if since is not None:
+                replay &= times >= since
+            for action in schedule.actions[replay].values:
+                cloud.apply(action, inplace=True)
     if end is None:
         end = environment.end
     return start, end
 
-def evaluate(cloud, environment, schedule,
-             el_prices, temperature=None,
-             start=None, end=None):
-    """Calculate utilprice, sla and contstraint penalties
-    of all servers based on the given schedule.
+#-------------------------------------
+# replay engine
+#  - one pass through the schedule for all the metrics
+#-------------------------------------
+
+class Replay:
+    """The per-timestep series gathered in one pass through a schedule
+    (see replay_schedule).
+
+    Row i of every series holds the values from times[i] until the next time.
+    The columns are the cloud's servers (util, freq, active_cores) or the
+    VMs in vms (vm_freq, vm_cores - NaN while a VM isn't booted or the VM
+    frequencies while any VM is unallocated).
+
+    """
+    # the per-timestep arrays
+    step_series = ['util', 'freq', 'active_cores', 'overcap_ratio',
+                   'cap_penalty', 'sched_penalty', 'vm_freq', 'vm_cores']
+
+    def __init__(self, start, end, times, servers, vms, initial, held):
+        self.start = start
+        self.end = end
+        self.times = times
+        self.servers = servers
+        self.vms = vms
+        self.initial = initial # the first row is the state before any action
+        self.held = held # the last row only repeats the previous one at end
+        steps = len(times)
+        self.util = np.zeros((steps, len(servers)))
+        self.freq = np.ones((steps, len(servers))) # freq_scale
+        self.active_cores = np.zeros((steps, len(servers)))
+        self.overcap_ratio = np.zeros(steps) # 1 - ratio_within_capacity
+        self.cap_penalty = np.zeros(steps)
+        self.sched_penalty = np.zeros(steps) # 1 - ratio_allocated
+        self.vm_freq = np.full((steps, len(vms)), np.nan)
+        self.vm_cores = np.full((steps, len(vms)), np.nan)
+        self.initial_vms = set()
+        self.action_times = [] # time and VM of every applied action
+        self.action_vms = []
+        # (t, vm, host before, host after) of the actual VM migrations
+        self.migrations = []
+
+    def server_frame(self, values):
+        return pd.DataFrame(values, self.times, self.servers)
+
+    def vm_frame(self, values):
+        return pd.DataFrame(values, self.times, self.vms).dropna(axis=1,
+                                                                 how='all')
+
+    def migrations_num(self, until=None):
+        """The number of actions per initial VM (raises KeyError for
+        actions on other VMs) - only up to until, if given."""
+        migrations_num = {vm: 0 for vm in self.initial_vms}
+        counts = Counter(vm for t, vm in zip(self.action_times,
+                                             self.action_vms)
+                         if until is None or t <= until)
+        for vm, num in counts.items():
+            migrations_num[vm] += num
+        return migrations_num
+
+
+def _replay_context(cloud, state, start, method):
+    """Everything but the actions that a replay depends on: the servers,
+    the starting state, the start and the utilisation method and weights.
+    The values themselves (not a hash of them) make up the key, so
+    different replays never share snapshots."""
+    weights = conf.utilisation_weights
+    allocation = frozenset((vm, s) for s, vms in state.alloc.items()
+                           for vm in vms)
+    return (tuple(cloud.servers), allocation,
+            frozenset(state.freq_scale.items()), frozenset(state.vms),
+            frozenset(state.paused), frozenset(state.suspended),
+            pd.Timestamp(start).value, method,
+            None if weights is None else tuple(weights))
+
+def replay_schedule(cloud, environment, schedule, start=None, end=None,
+                    method="basic", for_vms=False, resume=False):
+    """Apply the schedule's actions on the cloud model in a single pass and
+    record all the per-timestep series that the metrics need.
 
     @param start, end: if given, only this period will be counted,
     cloud model starts from _real. If not, whole environment.start-end
     counted and the first state is _initial.
+    @param method: utilisation calculation method (None - don't calculate)
+    @param for_vms: also record the frequencies and cores of the VMs
+    @param resume: keep the intermediate states at the action times on
+    the schedule and start from the longest prefix of actions replayed
+    before - by this schedule or the one it was copied from (e.g. the
+    parent of a GA child). Not for for_vms.
+
+    @returns: a Replay
 
     """
-    start, end = _reset_cloud_state(cloud, environment, start, end)
-    #TODO: use more precise pandas methods for indexing (performance)
-    #TODO: maybe move some of this state iteration functionality into Cloud
-    #TODO: see where schedule window should be propagated - here or Scheduler?
-    initial_utilisations = cloud.get_current().calculate_utilisations(weights=conf.utilisation_weights)
-    utilisations_list = [initial_utilisations]
-    times = [start]
-
-    # CONSTRAINTS
-    cap_weight, sched_weight = 0.6, 0.4
-    penalties = {}
-    # if no actions - penalty for the current state
-    # or penalty for start -> t
-    cap_penalty, sched_penalty = _calculate_constraint_penalty(
-        cloud.get_current())
-    penalty = cap_weight * cap_penalty + sched_weight * sched_penalty
-    penalties[start] = penalty
-
-    # SLA
-    migrations_num = {vm: 0 for vm in cloud.vms}
-
-    for t in schedule.actions.index.unique():
-        if t == start: # we change the initial utilisation right away
-            utilisations_list = []
-            times = []
-            # we remove the initial penalty, as there are immediate actions
-            penalties = {}
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            for action in schedule.actions[t].values:
-                cloud.apply(action, inplace=True)
-                try:
-                    migrations_num[action.vm] += 1
-                except KeyError:
-                    error('Explosion! Check environment.get_requests.')
-                    raise
-        else:
-            action = schedule.actions[t]
-            try:
-                migrations_num[action.vm] += 1
-            except KeyError:
-                error('Explosion! Check environment.get_requests.')
-                raise
-            cloud.apply(action, inplace=True)
-        state = cloud.get_current()
-        new_utilisations = state.calculate_utilisations(weights=conf.utilisation_weights)
-        utilisations_list.append(new_utilisations)
-        times.append(t)
+    start, end = _reset_cloud_state(cloud, environment, start, end, schedule)
+    state = cloud.get_current()
+    lo = bisect_left(schedule._times, pd.Timestamp(start).value)
+    action_times = schedule._times[lo:]
+    actions = schedule._actions[lo:]
+
+    step_times = list(np.unique(np.array(action_times, dtype=np.int64)))
+    initial = len(step_times) == 0 or step_times[0] != pd.Timestamp(start).value
+    if initial:
+        step_times.insert(0, pd.Timestamp(start).value)
+    held = step_times[-1] < pd.Timestamp(end).value
+    if held: # the last values hold until the end - duplicate last
+        step_times.append(pd.Timestamp(end).value)
+    times = pd.DatetimeIndex(np.array(step_times, dtype='datetime64[ns]'))
+
+    servers = list(cloud.servers)
+    vms = []
+    if for_vms:
+        vms = list(state.vms)
+        vms += list(set(a.vm for a in actions if a.vm is not None)
+                    - set(vms))
+    vm_columns = {vm: i for i, vm in enumerate(vms)}
+    replay = Replay(start, end, times, servers, vms, initial, held)
+    replay.initial_vms = set(state.vms)
+    try:
+        cores = ph.Machine.resource_types.index(ph.Machine.core_resource)
+    except ValueError: # no core resource
+        cores = None
+
+    def record(i):
+        if method is not None:
+            utilisations = state.calculate_utilisations(
+                method, conf.utilisation_weights)
+            replay.util[i] = [utilisations[s] for s in servers]
+        for j, s in enumerate(servers):
+            replay.freq[i, j] = state.freq_scale[s]
+            if cores is not None:
+                used = s.vec[cores] - state.free_vector(s)[cores]
+                replay.active_cores[i, j] = used
+        replay.overcap_ratio[i] = 1 - state.ratio_within_capacity()
+        replay.cap_penalty[i] = state.capacity_penalty()
+        replay.sched_penalty[i] = 1 - state.ratio_allocated()
+        if for_vms:
+            hosts = {}
+            for vm in state.vms:
+                replay.vm_cores[i, vm_columns[vm]] = \
+                    vm.res[ph.Machine.core_resource]
+                hosts[vm] = state.allocation(vm)
+            if all(host is not None for host in hosts.values()):
+                for vm, host in hosts.items():
+                    replay.vm_freq[i, vm_columns[vm]] = state.freq_scale[host]
+
+    i = 0
+    resumed = 0 # actions already applied
+    if resume and not for_vms:
+        context = _replay_context(cloud, state, start, method)
+        prefix = tuple((t, action.key)
+                       for t, action in zip(action_times, actions))
+        # the numbers of actions applied after every action time
+        ends = [j + 1 for j in range(len(actions))
+                if j + 1 == len(actions)
+                or action_times[j + 1] != action_times[j]]
+        inherited = getattr(schedule, '_replay_prefixes', {})
+        # the own snapshots: the inherited ones taken after exactly the
+        # same actions (and later the new ones)
+        schedule._replay_prefixes = {}
+        snapshot = None
+        for n in ends:
+            key = (context, n)
+            if key in inherited and inherited[key][0] == prefix[:n]:
+                snapshot = schedule._replay_prefixes[key] = inherited[key]
+        if snapshot is not None: # resume after the longest prefix
+            applied, source, i, snapshot_state, migrations = snapshot
+            resumed = len(applied)
+            for name in Replay.step_series:
+                getattr(replay, name)[:i] = getattr(source, name)[:i]
+            replay.action_times = source.action_times[:resumed]
+            replay.action_vms = source.action_vms[:resumed]
+            replay.migrations = source.migrations[:migrations]
+            state = cloud.reset_to_state(snapshot_state)
+    if initial and i == 0:
+        record(i)
+        i += 1
+    for j in range(resumed, len(actions)):
+        action = actions[j]
+        t = action_times[j]
+        vm = action.vm
+        host_before = state.allocation(vm) if action.name == 'migrate' \
+                      else None
+        state = cloud.apply(action, inplace=True)
+        if host_before is not None:
+            host_after = state.allocation(vm)
+            #if host_before or host_after is None, it's a boot/delete
+            if host_after is not None and host_before != host_after:
+                replay.migrations.append((times[i], vm, host_before,
+                                          host_after))
+        replay.action_times.append(times[i])
+        replay.action_vms.append(vm)
+        if j + 1 == len(actions) or action_times[j + 1] != t:
+            record(i) # all the actions at t applied
+            i += 1
+            if resume and not for_vms:
+                schedule._replay_prefixes[(context, j + 1)] = (
+                    prefix[:j + 1], replay, i, state.copy(),
+                    len(replay.migrations)
+                )
+    if held:
+        for name in Replay.step_series:
+            series = getattr(replay, name)
+            series[i] = series[i - 1]
+    return replay
 
-        # CONSTRAINTS
-        cap_penalty, sched_penalty = _calculate_constraint_penalty(state)
-        penalty = cap_weight * cap_penalty + sched_weight * sched_penalty
-        penalties[t] = penalty
-
-    if times[-1] < end:
-        # the last utilisation values hold until the end - duplicate last
-        times.append(end)
-        utilisations_list.append(utilisations_list[-1])
-
-    util = pd.DataFrame(utilisations_list, times)
-
-    # CONSTRAINTS
-    #if len(schedule.actions) > 0: # <- not sure why this if was necessary
-    penalties[end] = penalty # last penalty holds 'til end
-    # CONSTRAINTS
-    penalties = pd.Series(penalties)
-    constraint_penalty = ph.weighted_mean(penalties)
+def evaluate(cloud, environment, schedule,
+             el_prices, temperature=None,
+             start=None, end=None):
+    """Calculate utilprice, sla and contstraint penalties
+    of all servers based on the given schedule (with the shared
+    default_evaluator's caches - see Evaluator.evaluate).
 
-    # SLA
-    migrations_num = pd.Series(migrations_num)
-    if len(migrations_num) == 0:
-        sla_penalty = 0. # no migrations - awesome!
-    else:
-        # average migration rate per 4 hours
-        duration = (end - start).total_seconds() / 3600 # hours
-        migrations_rate = 4 * migrations_num / duration
-        # Migration rate penalty - linear 1-4 migr/4 hours -> 0.0-1.0
-        penalty =  (migrations_rate - 1) / 3.
-        penalty[penalty<0] = 0
-        penalty[penalty>1] = 1
-        # 1 / 4 hours - tolerated, >1 / 4 hours - bad
-        sla_penalty = penalty.mean()
-
-    # COST GOAL
-    #----------
-    # utility + cooling + el. price penalty
-    # -load some cached data (or create & cache if it's a miss)
-    if globals()['cached_end'] == end:
-        el_prices_server = globals()['el_prices_server']
-        utilprice_worst_avg = globals()['utilprice_worst_avg']
-        el_prices_current = globals()['el_prices_current']
-    else:
-        el_prices_current = el_prices[start:end]
-        if temperature is not None:
-            pPUE = ph.calculate_pue(temperature[start:end])
-            el_prices_current = el_prices_current * pPUE
-        globals()['el_prices_current'] = el_prices_current
-        el_prices_server = pd.DataFrame()
-        # TODO: multiply with pPUE - from the temperature model
-        for server in util.columns: # this might be very inefficient
-            loc = server.loc
-            el_prices_server[server] = el_prices_current[loc]
-        globals()['el_prices_server'] = el_prices_server
-        globals()['cached_end'] = end
-
-        # - worst case util
-        full_util_current = globals()['full_util'][start:end]
-        utilprice_worst = el_prices_server * full_util_current
-        utilprice_worst_avg = utilprice_worst.mean().mean()
-        globals()['utilprice_worst_avg'] = utilprice_worst_avg
-
-    # -based on this utility
-    util = util.reindex(el_prices_current.index, method='pad')
-    utilprice = el_prices_server * util
-    utilprice_avg = utilprice.mean().mean()
-    utilprice_penalty = utilprice_avg / float(utilprice_worst_avg)
-
-    # mean nonzero utilisation
-    nonzero_utilisation_avg = util[util>0].mean().mean()
-    if np.isnan(nonzero_utilisation_avg):
-        nonzero_utilisation_avg = 0
-    # goal: high utilisation -> 0.0 good, high utilisation; 1.0 low utilisation
-    util_penalty = float(1 - nonzero_utilisation_avg)
-
-    #cost_penalty = 0.2 * util_penalty + 0.8 * utilprice_penalty
-
-    _reset_cloud_state(cloud, environment, start, end)
-
-    return util_penalty, utilprice_penalty, constraint_penalty, sla_penalty
+    """
+    return default_evaluator.evaluate(cloud, environment, schedule,
+                                      el_prices, temperature, start, end)
+
+def evaluate_population(cloud, environment, schedules,
+                        el_prices, temperature=None,
+                        start=None, end=None, resume=False):
+    """Evaluate all the schedules at once, with the shared
+    default_evaluator (see Evaluator.evaluate_population).
+
+    """
+    return default_evaluator.evaluate_population(
+        cloud, environment, schedules, el_prices, temperature, start, end,
+        resume
+    )
 
 # TODO: maybe move to State.freq_scale_vms
 def _server_freqs_to_vm_freqs(state):
@@ -633,19 +770,9 @@ def _server_freqs_to_vm_freqs(state):
     vm_freq = {vm : state.freq_scale[state.allocation(vm)] for vm in state.vms}
     return vm_freq
 
-def _get_frequencies(state, for_vms=False):
-    """Get frequencies for VMs/servers in the given state as needed"""
-    if for_vms:
-        try:
-            freq = _server_freqs_to_vm_freqs(state)
-        except KeyError: # when VMs are not allocated anywhere
-            freq = {}
-    else:
-        freq = state.freq_scale
-    return freq
-
 def calculate_cloud_frequencies(cloud, environment, schedule,
-                                start=None, end=None, for_vms=False):
+                                start=None, end=None, for_vms=False,
+                                replay=None):
     """Calculate frequencies of all servers or VMs based on the given schedule.
 
     @param for_vms: if True return freqs for VMs, otherwise for servers
@@ -655,46 +782,20 @@ def calculate_cloud_frequencies(cloud, environment, schedule,
     counted and the first state is _initial.
 
     """
-    start, end = _reset_cloud_state(cloud, environment, start, end)
-    initial_freq = _get_frequencies(cloud.get_current(), for_vms)
-    freq_list = [initial_freq]
-    times = [start]
-    for t in schedule.actions.index.unique():
-        if t == start: # we change the initial frequencies right away
-            freq_list = []
-            times = []
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            for action in schedule.actions[t].values:
-                cloud.apply(action)
-        else:
-            action = schedule.actions[t]
-            cloud.apply(action)
-        state = cloud.get_current()
-        new_freq = _get_frequencies(state, for_vms)
-        freq_list.append(new_freq)
-        times.append(t)
-    if times[-1] < end:
-        # the last frequency values hold until the end - duplicate last
-        times.append(end)
-        freq_list.append(freq_list[-1])
-    df_freq = pd.DataFrame(freq_list, times)
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=None, for_vms=for_vms)
+    if for_vms:
+        df_freq = replay.vm_frame(replay.vm_freq)
+    else:
+        df_freq = replay.server_frame(replay.freq)
     # convert freq_scale to absolute value in Hz
     df_freq_hz = conf.f_max * df_freq
     return df_freq_hz
 
-def  _get_active_cores(state, for_vms=False):
-    if for_vms:
-        return {vm: vm.res['#CPUs'] for vm in state.vms}
-    else:
-        return {server:server.cap['#CPUs'] - res['#CPUs'] \
-                for server, res in list(state.free_cap.items())}
-
-# TODO: this pattern is being repeated much too often.
-# It should be extracted somehow. Ideally using DataFrames/Panels
-# and not for loops
 def calculate_cloud_active_cores(cloud, environment, schedule,
-                                 start=None, end=None, for_vms=False):
+                                 start=None, end=None, for_vms=False,
+                                 replay=None):
     """Calculate number of active cores of all servers over time
     based on the given schedule.
 
@@ -705,49 +806,34 @@ def calculate_cloud_active_cores(cloud, environment, schedule,
     counted and the first state is _initial.
 
     """
-    start, end = _reset_cloud_state(cloud, environment, start, end)
-    initial_cores = _get_active_cores(cloud.get_current(), for_vms)
-    cores_list = [initial_cores]
-    times = [start]
-    for t in schedule.actions.index.unique():
-        if t == start:
-            cores_list = []
-            times = []
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            for action in schedule.actions[t].values:
-                cloud.apply(action)
-        else:
-            action = schedule.actions[t]
-            cloud.apply(action)
-        state = cloud.get_current()
-        new_cores = _get_active_cores(cloud.get_current(), for_vms)
-        cores_list.append(new_cores)
-        times.append(t)
-    if times[-1] < end:
-        times.append(end)
-        cores_list.append(cores_list[-1])
-    df_cores = pd.DataFrame(cores_list, times)
-    return df_cores
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=None, for_vms=for_vms)
+    if for_vms:
+        return replay.vm_frame(replay.vm_cores)
+    return replay.server_frame(replay.active_cores)
 
 # TODO: make option for whether profit is calculated in results
 def calculate_service_profit(cloud, environment, schedule,
-                             start=None, end=None):
+                             start=None, end=None, replay=None):
     """Calculate the profit for the cloud provider for hosting the VMs."""
 
+    whole_timeline = (start is None) # called for whole simulation timeline
+    if replay is None:
+        replay = replay_schedule(cloud, environment, schedule, start, end,
+                                 method=None, for_vms=True)
     # TODO: we need this if?
     if conf.power_model == "freq" or conf.power_model == "multicore":
         freq = calculate_cloud_frequencies(cloud, environment, schedule,
-                                           start, end, for_vms=True)
+                                           for_vms=True, replay=replay)
     else:
         freq = None
-    whole_timeline = (start is None) # called for whole simulation timeline
-    start, end = _reset_cloud_state(cloud, environment, start, end)
+    start, end = replay.start, replay.end
     # TODO: test both cases
     if whole_timeline:
         considered_vms = set(environment._requests.apply(lambda a : a.vm))
     else:
-        considered_vms = cloud.get_current().vms
+        considered_vms = replay.initial_vms
 
 
     if conf.pricing_model == "performance_pricing":
@@ -770,8 +856,8 @@ def calculate_service_profit(cloud, environment, schedule,
     # )
     if conf.power_model == "multicore":
         active_cores = calculate_cloud_active_cores(cloud, environment,
-                                                    schedule, start, end,
-                                                    for_vms=True)
+                                                    schedule, for_vms=True,
+                                                    replay=replay)
     if conf.power_model == "freq" or conf.power_model == "basic":
         df_price = ph.vm_price_cpu_ram(
             df_rel_ram, freq, df_beta, C_base=conf.C_base,
@@ -791,10 +877,223 @@ def calculate_service_profit(cloud, environment, schedule,
     return total_profit
 
 
+def _data_version(data):
+    """A key of the geotemporal (forecast) data that changes whenever the
+    data does - not only when a new object is passed."""
+    if data is None:
+        return None
+    return (tuple(data.columns), hash(data.index.asi8.tobytes()),
+            hash(np.ascontiguousarray(data.values).tobytes()))
+
+
 class Evaluator:
-    pass
+    """Evaluates schedules for the fitness functions (see evaluate).
+
+    Owns the caches of the inputs that only depend on the evaluated period:
+    the (cooling adjusted) el. prices per location and the worst case utility
+    price. They are kept in an LRU cache keyed on (start, end, forecast
+    data, servers), so that different environments, forecasts and periods
+    don't clash. A single instance (default_evaluator) is shared by all the
+    schedulers through the module level functions.
+
+    """
+    cache_size = 32 # number of periods kept in the cache
+
+    def __init__(self, cache_size=None):
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self._full_util = None
+        self._inputs = OrderedDict() # key -> inputs, least recently used first
+
+    def precreate_synth_power(self, start, end, servers):
+        """Prepare the worst case (full) utilisation of the servers."""
+        full_util = {server: [1.0, 1.0] for server in servers}
+        full_util = pd.DataFrame(full_util, index=[start, end])
+        self._full_util = full_util.resample('H').ffill() # Resample and ffill
+        self.clear() # the worst case changed
+
+    def clear(self):
+        """Forget all the cached inputs."""
+        self._inputs.clear()
+
+    def _period_inputs(self, el_prices, temperature, start, end, servers):
+        """The el. prices for the period, per location and the worst case
+        average utility price - from the cache, if possible."""
+        key = (start, end, _data_version(el_prices),
+               _data_version(temperature), tuple(servers))
+        try:
+            inputs = self._inputs.pop(key)
+        except KeyError:
+            inputs = self._prepare_inputs(el_prices, temperature,
+                                          start, end, servers)
+            if len(self._inputs) >= self.cache_size:
+                self._inputs.popitem(last=False) # evict the LRU entry
+        self._inputs[key] = inputs # now the most recently used
+        return inputs
+
+    def _prepare_inputs(self, el_prices, temperature, start, end, servers):
+        el_prices_current = el_prices[start:end]
+        if temperature is not None:
+            pPUE = ph.calculate_pue(temperature[start:end])
+            el_prices_current = el_prices_current * pPUE
+        # servers at a location share the prices - keep them per location
+        locations = pd.Series([server.loc for server in servers])
+        el_prices_loc = el_prices_current[locations.unique()]
+
+        # - worst case util (1.0 for the servers of the synthetic power)
+        if self._full_util is None:
+            self.precreate_synth_power(start, end, servers)
+        full_util_current = self._full_util[start:end]
+        full = locations[[server in full_util_current.columns
+                          for server in servers]].value_counts()
+        common = el_prices_loc.index.intersection(full_util_current.index)
+        worst = el_prices_loc.loc[common, full.index].mean()
+        utilprice_worst_avg = (worst * full).sum() / full.sum()
+        return el_prices_current, el_prices_loc, utilprice_worst_avg
+
+    def evaluate(self, cloud, environment, schedule,
+                 el_prices, temperature=None,
+                 start=None, end=None):
+        """Calculate utilprice, sla and contstraint penalties
+        of all servers based on the given schedule.
+
+        @param start, end: if given, only this period will be counted,
+        cloud model starts from _real. If not, whole environment.start-end
+        counted and the first state is _initial.
+
+        """
+        return self.evaluate_population(cloud, environment, [schedule],
+                                        el_prices, temperature,
+                                        start, end)[0]
+
+    def evaluate_population(self, cloud, environment, schedules,
+                            el_prices, temperature=None,
+                            start=None, end=None, resume=False):
+        """Evaluate a whole population of schedules over the same period
+        (see evaluate). The schedules are replayed one by one, but all the
+        penalties are calculated at once on (schedules x timesteps x servers)
+        arrays.
+
+        @param resume: resume the replays after the longest prefix of
+        actions replayed before (see replay_schedule) - for populations
+        derived from each other, like the GA's
+
+        @returns: a list of (util_penalty, utilprice_penalty,
+        constraint_penalty, sla_penalty) tuples, one per schedule
+
+        """
+        if len(schedules) == 0:
+            return []
+        replays = [replay_schedule(cloud, environment, schedule, start, end,
+                                   resume=resume)
+                   for schedule in schedules]
+        start, end = replays[0].start, replays[0].end
+        servers = replays[0].servers
 
-# TODO: move all the functions as methods in here, make global caches attributes
-# and have it automatically recognise when geotemp. inputs have changed to
-# cache the new results.
+        # CONSTRAINTS
+        cap_weight, sched_weight = 0.6, 0.4
+        constraint_penalty = _weighted_means(
+            replays, end, lambda replay: (cap_weight * replay.cap_penalty +
+                                          sched_weight * replay.sched_penalty)
+        )
+
+        # SLA
+        try:
+            migrations_num = [replay.migrations_num() for replay in replays]
+        except KeyError:
+            error('Explosion! Check environment.get_requests.')
+            raise
+        # the counts of all the units one after another (by VM id)
+        vms_num = np.array([len(num) for num in migrations_num])
+        counts = np.array([count for num in migrations_num
+                           for vm, count in sorted(num.items(),
+                                                   key=lambda item: item[0].id)],
+                          dtype=float)
+        # average migration rate per 4 hours
+        duration = (end - start).total_seconds() / 3600 # hours
+        migrations_rate = 4 * counts / duration
+        # Migration rate penalty - linear 1-4 migr/4 hours -> 0.0-1.0
+        # 1 / 4 hours - tolerated, >1 / 4 hours - bad
+        penalty = np.clip((migrations_rate - 1) / 3., 0, 1)
+        # no migrations - 0
+        sla_penalty = _segment_sums(penalty, vms_num) / np.maximum(vms_num, 1)
+
+        # COST GOAL
+        #----------
+        # utility + cooling + el. price penalty
+        # -load some cached data (or create & cache if it's a miss)
+        el_prices_current, el_prices_loc, utilprice_worst_avg = \
+            self._period_inputs(el_prices, temperature, start, end, servers)
+
+        # -based on this utility (the mean over all the servers)
+        util = np.empty((len(replays), len(el_prices_current), len(servers)))
+        for i, replay in enumerate(replays): # the last change at each time
+            rows = replay.times.searchsorted(el_prices_current.index,
+                                             side='right') - 1
+            util[i] = replay.util[rows]
+            util[i, rows < 0] = np.nan
+        codes, locations = _server_locations(servers)
+        util_loc = _sum_per_location(util, codes, len(locations))
+        utilprice = util_loc * el_prices_loc.values
+        utilprice_avg = _nanmean(utilprice, axis=1).sum(axis=1)
+        utilprice_avg /= len(servers)
+        utilprice_penalty = utilprice_avg / float(utilprice_worst_avg)
+
+        # mean nonzero utilisation
+        busy = util > 0
+        busy_avg = _nanmean(np.where(busy, util, np.nan), axis=1)
+        nonzero_utilisation_avg = np.nan_to_num(_nanmean(busy_avg, axis=1))
+        # goal: high utilisation -> 0.0 good, high utilisation; 1.0 low utilisation
+        util_penalty = 1 - nonzero_utilisation_avg
+
+        #cost_penalty = 0.2 * util_penalty + 0.8 * utilprice_penalty
+
+        _reset_cloud_state(cloud, environment, start, end)
+
+        return list(zip(util_penalty.tolist(), utilprice_penalty.tolist(),
+                        constraint_penalty.tolist(), sla_penalty.tolist()))
+
+
+def _nanmean(values, axis):
+    """Mean skipping the NaNs, like pandas (NaN if there are only NaNs)."""
+    valid = ~np.isnan(values)
+    total = np.where(valid, values, 0).sum(axis=axis)
+    num = valid.sum(axis=axis)
+    return np.where(num > 0, total / np.maximum(num, 1), np.nan)
+
+def _segment_sums(values, lengths):
+    """Sums of the consecutive segments of values with the given lengths.
+    Each sum only depends on its own segment, so a unit's penalties are the
+    same whichever units it's evaluated together with."""
+    sums = np.zeros(len(lengths), dtype=values.dtype)
+    nonempty = lengths > 0
+    if nonempty.any():
+        starts = np.cumsum(lengths) - lengths
+        sums[nonempty] = np.add.reduceat(values, starts[nonempty])
+    return sums
+
+def _weighted_means(replays, end, get_values):
+    """Time weighted means (see ph.weighted_mean) of the replays'
+    get_values series, the last value holding until end."""
+    end = pd.Timestamp(end).value
+    firsts, weighted, durations = [], [], []
+    for replay in replays:
+        values = get_values(replay)
+        times = replay.times.asi8
+        if not replay.held and times[-1] != end:
+            values = np.append(values, values[-1])
+            times = np.append(times, end)
+        firsts.append(values[0])
+        weights = np.diff(times)
+        weighted.append(values[:-1] * weights)
+        durations.append(weights)
+    lengths = np.array([len(weights) for weights in durations])
+    total = _segment_sums(np.concatenate(durations), lengths)
+    weighted = _segment_sums(np.concatenate(weighted), lengths)
+    # a single value is its own mean
+    return np.where(total > 0, weighted / np.maximum(total, 1),
+                    np.array(firsts))
+
+
+default_evaluator = Evaluator()
 
@@ -1,23 +1,262 @@
 import copy
 import random
+import time
+import multiprocessing
+from collections import OrderedDict
 
 import pandas as pd
 import numpy as np
 
 from philharmonic import Schedule, Migration
+from philharmonic.cloud.model import action_rank
 from philharmonic.scheduler.ischeduler import IScheduler
 from philharmonic.scheduler import evaluator
 from philharmonic.scheduler import BCFScheduler
 from philharmonic import random_time
 from philharmonic.logger import *
 
+_hour = pd.Timedelta(hours=1).value # ns
+
+class Genome:
+    """The encoding of the migrations in the genes of the ScheduleUnits -
+    parallel int32 arrays of their times (in steps since the epoch), VM and
+    server indices. The VMs and servers get their indices when they are
+    first encoded and keep them, so the genes stay valid while the cloud
+    changes and a genome can be shared by a whole population.
+
+    @param step: the time resolution - a minute by default, the finest
+      frequency of the simulated environments (which fits int32 genes until
+      the year 6053)
+
+    """
+    step = pd.Timedelta(minutes=1)
+
+    def __init__(self, step=None):
+        if step is not None:
+            self.step = pd.Timedelta(step)
+        self._step = self.step.value # ns
+        self.vms = []
+        self.servers = []
+        self._vm_index = {}
+        self._server_index = {}
+        self.vm_ids = np.empty(0, dtype=np.int64)
+        self.server_ids = np.empty(0, dtype=np.int64)
+        # (VM index, server index) -> Migration - the first one encoded or
+        # created when first decoded
+        self._migrations = np.empty((0, 0), dtype=object)
+
+    def _indices(self, machines, known, index):
+        for machine in machines:
+            if machine not in index:
+                index[machine] = len(known)
+                known.append(machine)
+        return np.array([index[machine] for machine in machines],
+                        dtype=np.int32)
+
+    def vm_genes(self, vms):
+        """The indices of the VMs (new VMs are added to the genome)."""
+        genes = self._indices(vms, self.vms, self._vm_index)
+        if len(self.vm_ids) != len(self.vms):
+            self.vm_ids = np.array([vm.id for vm in self.vms], dtype=np.int64)
+        return genes
+
+    def server_genes(self, servers):
+        """The indices of the servers (new ones are added to the genome)."""
+        genes = self._indices(servers, self.servers, self._server_index)
+        if len(self.server_ids) != len(self.servers):
+            self.server_ids = np.array([server.id for server in self.servers],
+                                       dtype=np.int64)
+        return genes
+
+    def known_vm_genes(self, vms):
+        """The indices of those VMs that are in the genome."""
+        return np.array([self._vm_index[vm] for vm in vms
+                         if vm in self._vm_index], dtype=np.int32)
+
+    def time_genes(self, times):
+        """The int64 nanosecond timestamps as steps since the epoch."""
+        times = np.asarray(times, dtype=np.int64)
+        if (times % self._step).any():
+            raise ValueError('only times on full steps of {} can be '
+                             'encoded'.format(self.step))
+        return (times // self._step).astype(np.int32)
+
+    def times(self, steps):
+        """The int64 nanosecond timestamps of the time genes."""
+        return steps.astype(np.int64) * self._step
+
+    def encode(self, times, actions):
+        """The (time, VM index, server index) genes of the migrations at
+        the given times."""
+        if any(action.name != 'migrate' for action in actions):
+            raise ValueError('only migrations can be encoded')
+        steps = self.time_genes(pd.DatetimeIndex(times).asi8)
+        vm_genes = self.vm_genes([action.vm for action in actions])
+        server_genes = self.server_genes([action.server for action in actions])
+        self._grow()
+        for v, s, action in zip(vm_genes, server_genes, actions):
+            if self._migrations[v, s] is None: # decode to the same object
+                self._migrations[v, s] = action
+        return steps, vm_genes, server_genes
+
+    def _grow(self):
+        shape = (len(self.vms), len(self.servers))
+        if self._migrations.shape != shape:
+            migrations = np.empty(shape, dtype=object)
+            old = self._migrations
+            migrations[:old.shape[0], :old.shape[1]] = old
+            self._migrations = migrations
+
+    def migrations(self, vm_genes, server_genes):
+        """The Migration objects of the (VM, server) index pairs."""
+        self._grow()
+        migrations = self._migrations[vm_genes, server_genes]
+        for k in np.flatnonzero(np.equal(migrations, None)):
+            v, s = vm_genes[k], server_genes[k]
+            if self._migrations[v, s] is None:
+                self._migrations[v, s] = Migration(self.vms[v],
+                                                   self.servers[s])
+            migrations[k] = self._migrations[v, s]
+        return migrations
+
+
+def _no_genes():
+    return tuple(np.empty(0, dtype=np.int32) for i in range(3))
+
+def _sorted_genes(steps, vm_genes, server_genes):
+    """The genes sorted by time, without the migrations superseded by a
+    later migration of the same VM at the same time (as with Schedule.add).
+
+    """
+    order = np.argsort(steps, kind='stable')
+    steps, vm_genes, server_genes = (steps[order], vm_genes[order],
+                                     server_genes[order])
+    keys = (steps.astype(np.int64) << 32) + vm_genes
+    _, last = np.unique(keys[::-1], return_index=True)
+    keep = np.sort(len(keys) - 1 - last)
+    return steps[keep], vm_genes[keep], server_genes[keep]
+
+
 class ScheduleUnit(Schedule):
+    """A schedule of migrations, kept as genes (see Genome) on which the
+    GA operators work. The Schedule's columns (and so the actions) are only
+    decoded from the genes when they are read. The inherited methods that
+    change the columns (extend, sort, clean...) do it through _set_columns,
+    _take and _delete, which change the genes the same way.
 
-    def __init__(self):
+    """
+    def __init__(self, genome=None):
         self.changed = True
         self.no_temperature = False
         self.no_el_price = False
         super(ScheduleUnit, self).__init__()
+        self.genome = Genome() if genome is None else genome
+        self._set_genes(*_no_genes())
+
+    def _set_genes(self, steps, vm_genes, server_genes):
+        self.genes = (steps, vm_genes, server_genes)
+        for column in Schedule._columns: # decoded again when needed
+            self.__dict__.pop(column, None)
+        self._series = None
+
+    def __getattr__(self, name):
+        # only called for missing attributes - the columns not decoded yet
+        if name in Schedule._columns and 'genes' in self.__dict__:
+            self._decode()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _decode(self):
+        steps, vm_genes, server_genes = self.genes
+        self._times = self.genome.times(steps).tolist()
+        self._keys = [(t, action_rank['migrate']) for t in self._times]
+        self._vm_ids = self.genome.vm_ids[vm_genes].tolist()
+        self._server_ids = self.genome.server_ids[server_genes].tolist()
+        self._actions = list(self.genome.migrations(vm_genes, server_genes))
+
+    def _set_columns(self, times, ranks, vm_ids, server_ids, actions):
+        # encoded first, so that the unit is left as it was if that fails
+        self.genes = self.genome.encode(pd.DatetimeIndex(times), list(actions))
+        super(ScheduleUnit, self)._set_columns(times, ranks, vm_ids,
+                                               server_ids, actions)
+
+    def _take(self, positions):
+        positions = np.asarray(positions, dtype=np.intp)
+        genes = tuple(genes[positions] for genes in self.genes)
+        super(ScheduleUnit, self)._take(positions)
+        self.genes = genes
+
+    def _delete(self, i):
+        genes = tuple(np.delete(genes, i) for genes in self.genes)
+        super(ScheduleUnit, self)._delete(i)
+        self.genes = genes
+
+    def _genes_in(self, genome):
+        """The genes of this unit encoded in another genome."""
+        if genome is self.genome:
+            return self.genes
+        return genome.encode(self._times, self._actions)
+
+    def __len__(self):
+        return len(self.genes[0])
+
+    def __copy__(self):
+        # the genes are never changed in place, so they can be shared
+        new_unit = self.__class__.__new__(self.__class__)
+        new_unit.__dict__.update(self.__dict__)
+        return new_unit
+
+    def set_actions(self, actions):
+        times, actions = actions.index, list(actions.values)
+        self._set_genes(*_sorted_genes(*self.genome.encode(times, actions)))
+
+    actions = property(Schedule.get_actions, set_actions,
+                       doc="time series of the actions (sorted by rank)")
+
+    @classmethod
+    def from_codes(cls, codes, vms, servers, genome=None):
+        """Create a unit from the codes of a schedule (see Schedule.codes),
+        its genes in the given genome."""
+        unit = cls(genome)
+        unit.actions = Schedule.from_codes(codes, vms, servers).actions
+        return unit
+
+    def codes(self):
+        steps, vm_genes, server_genes = self.genes
+        return (self.genome.times(steps),
+                np.full(len(steps), action_rank['migrate'], dtype=np.int64),
+                self.genome.vm_ids[vm_genes],
+                self.genome.server_ids[server_genes])
+
+    def add(self, action, t):
+        """Add a migration (see Schedule.add)."""
+        (h,), (v,), (s,) = self.genome.encode([t], [action])
+        steps, vm_genes, server_genes = self.genes
+        exists = False
+        if hasattr(self, 'environment'): # supersede like Schedule.add
+            same = (steps == h) & (vm_genes == v)
+            exists = (same & (server_genes == s)).any()
+            keep = ~same | (server_genes == s) if exists else ~same
+            steps, vm_genes, server_genes = (steps[keep], vm_genes[keep],
+                                             server_genes[keep])
+        if not exists:
+            i = steps.searchsorted(h, side='right')
+            steps, vm_genes, server_genes = (np.insert(steps, i, h),
+                                             np.insert(vm_genes, i, v),
+                                             np.insert(server_genes, i, s))
+        self._set_genes(steps, vm_genes, server_genes)
+        return not exists
+
+    def merge(self, other, split_time):
+        """Own genes until split_time (inclusive), other's after it."""
+        split = pd.Timestamp(split_time).value // self.genome._step
+        own, others = self.genes, other._genes_in(self.genome)
+        i = own[0].searchsorted(split, side='right')
+        j = others[0].searchsorted(split, side='right')
+        merged = copy.copy(self)
+        merged._set_genes(*(np.concatenate((mine[:i], theirs[j:]))
+                            for mine, theirs in zip(own, others)))
+        return merged
 
     #TODO: make operators functions, not methods
     # - they should not have no_temperature and no_el_price references
@@ -26,41 +265,45 @@ class ScheduleUnit(Schedule):
         if self.changed:
             #TODO: maybe move this method to the Scheduler
             #TODO: set start, end for sla, constraint
-            try:
-                w_util = self.w_util
-                w_cost = self.w_cost
-                w_sla = self.w_sla
-                w_constraint = self.w_constraint
-            except AttributeError: # not configured, stick to the defaults
-                # fitness function weights - default values
-                w_util, w_cost, w_sla, w_constraint = 0.18, 0.17, 0.25, 0.4
             start, end = self.environment.t, self.environment.forecast_end
-            # we get new data about the future temp. and el. prices
-            el_prices, temperature = self.environment.current_data()
-            if self.no_temperature:
-                temperature = None # we don't consider the temp. factor
-            if self.no_el_price:
-                w_util = w_cost + w_util
-                w_cost = 0.0 # we don't consider the cost factor
-            self.util, self.cost, self.constr, self.sla = evaluator.evaluate(
+            el_prices, temperature = self._evaluation_data()
+            self._set_fitness(*evaluator.evaluate(
                 self.cloud, self.environment, self, el_prices, temperature,
                 start, end
-            )
-            weighted_sum = (
-                w_util * self.util +
-                w_cost * self.cost + w_sla * self.sla +
-                w_constraint * self.constr
-            )
-            self.fitness = weighted_sum
-            self.rfitness = 1 - self.fitness
-            #if len(self.environment.get_requests()) > 0:
-            #   import ipdb; ipdb.set_trace()
-            if np.isnan(self.fitness):
-                #import ipdb; ipdb.set_trace()
-                pass
-            self.changed = False
+            ))
         return self.fitness
 
+    def _evaluation_data(self):
+        """The el. prices and temperatures to evaluate the unit with."""
+        # we get new data about the future temp. and el. prices
+        el_prices, temperature = self.environment.current_data()
+        if self.no_temperature:
+            temperature = None # we don't consider the temp. factor
+        return el_prices, temperature
+
+    def _set_fitness(self, util, cost, constr, sla):
+        """Combine the evaluated penalties into the fitness."""
+        try:
+            w_util = self.w_util
+            w_cost = self.w_cost
+            w_sla = self.w_sla
+            w_constraint = self.w_constraint
+        except AttributeError: # not configured, stick to the defaults
+            # fitness function weights - default values
+            w_util, w_cost, w_sla, w_constraint = 0.18, 0.17, 0.25, 0.4
+        if self.no_el_price:
+            w_util = w_cost + w_util
+            w_cost = 0.0 # we don't consider the cost factor
+        self.util, self.cost, self.constr, self.sla = util, cost, constr, sla
+        weighted_sum = (
+            w_util * self.util +
+            w_cost * self.cost + w_sla * self.sla +
+            w_constraint * self.constr
+        )
+        self.fitness = weighted_sum
+        self.rfitness = 1 - self.fitness
+        self.changed = False
+
     def _random_migration(self):
         """Return a migration of a random VM, to a random server at a random
         moment within the forecast horizon."""
@@ -70,9 +313,9 @@ class ScheduleUnit(Schedule):
         t = random_time(start, end)
         # - pick random VM
         # (among union of all allocs at t and VMRequests)
-        vm = random.sample(self.cloud.vms, 1)[0]
+        vm = random.sample(list(self.cloud.vms), 1)[0]
         # - pick random server
-        server = random.sample(self.cloud.servers, 1)[0]
+        server = random.sample(list(self.cloud.servers), 1)[0]
         new_action = Migration(vm, server)
         return new_action, t
 
@@ -81,25 +324,26 @@ class ScheduleUnit(Schedule):
         self.changed = True
         # copy the ScheduleUnit
         new_unit = copy.copy(self) # maybe just modify this unit?
-        # remove one action
-        removed_action = None
-        removed_t = None
-        if len(self.actions) > 0:
-            i = random.randint(0, len(self.actions)-1)
-            removed_action = self.actions.iloc[i]
-            removed_t = self.actions.index[i]
-            new_unit.actions = new_unit.actions.drop(removed_t)
+        # remove one action (and the others at its time)
+        removed = None
+        steps = self.genes[0]
+        if len(steps) > 0:
+            i = random.randint(0, len(steps)-1)
+            removed = tuple(genes[i] for genes in self.genes)
+            new_unit._set_genes(*(genes[steps != steps[i]]
+                                  for genes in self.genes))
         # add new random action
         if len(self.cloud.vms) > 0:
             mutated = False
             tries = 0
             max_tries = 3
-            while ((not mutated or
-                    (new_action == removed_action and t == removed_t)) and
+            while ((not mutated or added == removed) and
                    tries < max_tries):
                 tries += 1
                 new_action, t = self._random_migration()
                 mutated = new_unit.add(new_action, t)
+                added = tuple(genes[0] for genes in
+                              self.genome.encode([t], [new_action]))
         return new_unit
 
     def crossover(self, other, t=None):
@@ -108,38 +352,27 @@ class ScheduleUnit(Schedule):
         end = self.environment.forecast_end
         if not t:
             t = random_time(start, end)
-        child = copy.copy(self) # TODO: better to create a new unit? state etc.
+        child = self.merge(other, t) # TODO: better to create a new unit?
         child.changed = True
-        actions1 = self.actions[:t]
-        justabit = pd.offsets.Micro(1)
-        actions2 = other.actions[t + justabit:]
-        child.actions = pd.concat([actions1, actions2])
-
-        child2 = copy.copy(self) # TODO: better to create a new unit? state etc.
+        child2 = other.merge(self, t)
         child2.changed = True
-        actions1 = other.actions[:t]
-        justabit = pd.offsets.Micro(1)
-        actions2 = self.actions[t + justabit:]
-        child2.actions = pd.concat([actions1, actions2])
         return child, child2
 
     def update(self):
         """Update to match the new forecast horizon (current time until the end
         of the forecast). Throw away old actions."""
-        if len(self.actions) == 0:
+        steps, vm_genes, server_genes = self.genes
+        if len(steps) == 0:
             return
         # throw away old actions
-        t = self.environment.t
-        end = self.environment.forecast_end
-        old_len = len(self.actions)
-        self.actions = self.actions[t:end]
-        # throy away actions on non-existing vms
-        in_vms = self.actions.map(lambda a, vms = self.cloud.vms : a.vm in vms)
-        try:
-            self.actions = self.actions[in_vms]
-        except IndexError:
-            pass
-        if len(self.actions) != old_len: # the unit has changed
+        t = pd.Timestamp(self.environment.t).value
+        end = pd.Timestamp(self.environment.forecast_end).value
+        times = self.genome.times(steps)
+        keep = (times >= t) & (times <= end)
+        # throw away actions on non-existing vms
+        keep &= np.isin(vm_genes, self.genome.known_vm_genes(self.cloud.vms))
+        if not keep.all(): # the unit has changed
+            self._set_genes(steps[keep], vm_genes[keep], server_genes[keep])
             self.changed = True
 
 
@@ -158,10 +391,11 @@ class ScheduleUnit(Schedule):
             #s += super(ScheduleUnit, self).__repr__()
         return s
 
-def create_random(environment, cloud, no_el_price=False, no_temperature=False):
+def create_random(environment, cloud, no_el_price=False, no_temperature=False,
+                  genome=None):
     """create a random unit"""
     # TODO: maybe kick out migrations that make no sense
-    unit = ScheduleUnit() # empty schedule unit
+    unit = ScheduleUnit(genome) # empty schedule unit
     unit.environment = environment
     unit.cloud = cloud
     unit.no_el_price = no_el_price
@@ -175,22 +409,224 @@ def create_random(environment, cloud, no_el_price=False, no_temperature=False):
     max_migrations = plan_duration * len(cloud.vms) // 3
     migration_number = random.randint(min_migrations, max_migrations)
     # generate migration_number of migrations
-    times = []
-    actions = []
-    for i in range(migration_number):
-        # - pick random moment
-        t = random_time(start, end)
-        times.append(t)
-        # - pick random VM
-        vm = random.sample(cloud.vms, 1)[0]
-        # - pick random server
-        server = random.sample(cloud.servers, 1)[0]
-        action = Migration(vm, server)
-        actions.append(action)
-    unit.actions = pd.Series(actions, times, name='actions')
-    unit.sort() # TODO: kick out duplicates/overrides like unit.add
+    # - random moments (rounded to a full hour, as in random_time)
+    seconds = np.random.uniform(0., (end - start).total_seconds(),
+                                migration_number)
+    times = pd.Timestamp(start).value + (seconds * 1e9).astype(np.int64)
+    steps = unit.genome.time_genes(times - times % _hour)
+    # - random VMs and servers
+    vm_genes = unit.genome.vm_genes(list(cloud.vms))
+    server_genes = unit.genome.server_genes(list(cloud.servers))
+    if migration_number > 0:
+        vm_genes = vm_genes[np.random.randint(len(vm_genes),
+                                              size=migration_number)]
+        server_genes = server_genes[np.random.randint(len(server_genes),
+                                                      size=migration_number)]
+        # kicks out overrides like add
+        unit._set_genes(*_sorted_genes(steps, vm_genes, server_genes))
     return unit
 
+# the read-only evaluation data of a fitness worker process (see FitnessPool)
+_worker = {}
+
+def _init_worker(cloud, environment, vms, el_prices, temperature):
+    _worker.update(cloud=cloud, environment=environment,
+                   el_prices=el_prices, temperature=temperature,
+                   vms={vm.id: vm for vm in vms},
+                   servers={server.id: server for server in cloud.servers})
+    evaluator.precreate_synth_power(environment.start, environment.end,
+                                    cloud.servers)
+
+def _evaluate_codes(chunk):
+    """Evaluate the schedules encoded in chunk (see Schedule.codes)."""
+    schedules = [Schedule.from_codes(codes, _worker['vms'], _worker['servers'])
+                 for codes in chunk]
+    environment = _worker['environment']
+    return evaluator.evaluate_population(
+        _worker['cloud'], environment, schedules,
+        _worker['el_prices'], _worker['temperature'],
+        environment.t, environment.forecast_end
+    )
+
+class FitnessPool:
+    """Worker processes evaluating units in parallel. Every worker gets
+    its own copy of the cloud, environment and the forecast data once, after
+    which only the schedules' codes are sent and their penalties returned,
+    so the results are the same as when evaluating in this process.
+
+    @param vms: all the VMs the evaluated schedules can refer to
+
+    """
+    def __init__(self, workers, cloud, environment, vms, no_temperature=False):
+        self.workers = workers
+        el_prices, temperature = environment.current_data()
+        if no_temperature:
+            temperature = None
+        self._pool = multiprocessing.Pool(
+            workers, _init_worker,
+            (cloud, environment, list(vms), el_prices, temperature)
+        )
+
+    def evaluate(self, units):
+        """The (util, cost, constr, sla) penalties of every unit."""
+        if not units:
+            return []
+        codes = [unit.codes() for unit in units]
+        size = -(-len(codes) // self.workers) # ceil
+        chunks = [codes[i:i + size] for i in range(0, len(codes), size)]
+        return [penalties for results in self._pool.map(_evaluate_codes, chunks)
+                for penalties in results]
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+def _run_island(scheduler, seed, conn, num_children, num_mutation):
+    """Evolve one island of the scheduler in this process, with its own
+    random seed (see GAScheduler._evolve_islands)."""
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        scheduler._evolve_island(conn, num_children, num_mutation)
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        raise
+    finally:
+        conn.close()
+
+class FitnessCache:
+    """A bounded LRU cache of the units' penalties, keyed on what they
+    depend on - the evaluation context (see _context_key) and the unit's
+    actions in a canonical order - so that units with the same content
+    share them. hits and misses count the lookups, e.g. for tuning the
+    cache_size.
+
+    """
+    cache_size = 1000 # number of units' penalties kept in the cache
+
+    def __init__(self, cache_size=None):
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self._penalties = OrderedDict() # key -> penalties, LRU first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """The cached penalties or None (a miss)."""
+        try:
+            penalties = self._penalties.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._penalties[key] = penalties # now the most recently used
+        self.hits += 1
+        return penalties
+
+    def put(self, key, penalties):
+        if key not in self._penalties and \
+           len(self._penalties) >= self.cache_size:
+            self._penalties.popitem(last=False) # evict the LRU entry
+        self._penalties.pop(key, None)
+        self._penalties[key] = penalties
+
+    def clear(self):
+        """Forget all the cached penalties (the counters stay)."""
+        self._penalties.clear()
+
+    def __len__(self):
+        return len(self._penalties)
+
+def _context_key(unit):
+    """Everything but the actions that a unit's penalties depend on: the
+    cloud's real state, the window and the forecast data. The key holds
+    the values themselves (not a hash of them), so different contexts
+    never share penalties."""
+    environment, cloud = unit.environment, unit.cloud
+    el_prices, temperature = unit._evaluation_data()
+    cloud.reset_to_real()
+    state = cloud.get_current()
+    allocation = frozenset((vm, s) for s, vms in state.alloc.items()
+                           for vm in vms)
+    return (id(cloud), allocation, frozenset(state.freq_scale.items()),
+            frozenset(state.vms), frozenset(state.paused),
+            frozenset(state.suspended),
+            pd.Timestamp(environment.t).value,
+            pd.Timestamp(environment.forecast_end).value,
+            _data_key(el_prices), _data_key(temperature))
+
+def _data_key(data):
+    """The (forecast) data as hashable values."""
+    if data is None:
+        return None
+    return (tuple(data.columns), data.index.asi8.tobytes(),
+            np.ascontiguousarray(data.values).tobytes())
+
+def _content_key(unit):
+    """The unit's actions (as codes) sorted by time, VM and server."""
+    times, ranks, vm_ids, server_ids = unit.codes()
+    order = np.lexsort((server_ids, vm_ids, ranks, times))
+    return np.stack((times, ranks, vm_ids, server_ids))[:, order].tobytes()
+
+def _evaluate_units(units, pool=None):
+    """The (util, cost, constr, sla) penalties of the units, evaluating
+    the ones with the same cloud, environment and data at once (see
+    evaluator.evaluate_population) or, given a FitnessPool (for the units'
+    cloud and environment), in its worker processes. The replays of the
+    former resume after the actions the units share with their parents.
+
+    """
+    if pool is not None:
+        return pool.evaluate(units)
+    groups = {}
+    for unit in units:
+        key = (id(unit.cloud), id(unit.environment), unit.no_temperature)
+        groups.setdefault(key, []).append(unit)
+    results = {}
+    for group in groups.values():
+        cloud, environment = group[0].cloud, group[0].environment
+        el_prices, temperature = group[0]._evaluation_data()
+        penalties = evaluator.evaluate_population(
+            cloud, environment, group, el_prices, temperature,
+            environment.t, environment.forecast_end, resume=True
+        )
+        results.update(zip(map(id, group), penalties))
+    return [results[id(unit)] for unit in units]
+
+def calculate_population_fitness(units, pool=None, cache=None):
+    """Calculate the fitness of all the changed units at once (see
+    _evaluate_units). Given a FitnessCache, the penalties of units with the
+    same content as a cached or another evaluated unit are reused.
+
+    """
+    changed = [unit for unit in units if unit.changed]
+    if cache is None:
+        for unit, penalties in zip(changed, _evaluate_units(changed, pool)):
+            unit._set_fitness(*penalties)
+        return
+    contexts = {}
+    pending = OrderedDict() # key -> units with the same content
+    for unit in changed:
+        context = (id(unit.cloud), id(unit.environment), unit.no_temperature)
+        if context not in contexts:
+            contexts[context] = _context_key(unit)
+        key = (contexts[context], _content_key(unit))
+        if key in pending: # a duplicate in this population
+            cache.hits += 1
+            pending[key].append(unit)
+            continue
+        penalties = cache.get(key)
+        if penalties is not None:
+            unit._set_fitness(*penalties)
+        else:
+            pending[key] = [unit]
+    if not pending: # all cached
+        return
+    evaluated = _evaluate_units([same[0] for same in pending.values()], pool)
+    for (key, same), penalties in zip(pending.items(), evaluated):
+        cache.put(key, penalties)
+        for unit in same:
+            unit._set_fitness(*penalties)
+
 def roulette_selection(individuals, k):
     """Select *k* individuals from the input *individuals* using *k*
     spins of a roulette. The selection is made by at the rfitness attributes,
@@ -237,11 +673,23 @@ class GAScheduler(IScheduler):
         self.artificial_boot_ratio = 0.15
         self.no_temperature = False
         self.no_el_price = False
+        self.workers = 0 # fitness worker processes (0 - evaluate serially)
+        self.genome = Genome() # shared by the whole population
+        self.fitness_cache_size = FitnessCache.cache_size # 0 - no cache
+        self.fitness_cache = None
+        self.islands = 0 # populations evolved in parallel (0, 1 - just one)
+        self.migration_interval = 5 # generations between the exchanges
+        self.migration_size = 2 # best units sent to the next island
+        self.time_budget = None # seconds per genetic_algorithm (None - no limit)
+        self.max_stagnation = None # generations without improvement allowed
+        self.stats = [] # a dict per genetic_algorithm run
 
     def initialize(self):
         evaluator.precreate_synth_power( # need this for efficient schedule eval
             self.environment.start, self.environment.end, self.cloud.servers
         )
+        if self.fitness_cache_size > 0:
+            self.fitness_cache = FitnessCache(self.fitness_cache_size)
         self.bcf = BCFScheduler()
         self.bcf.environment = self.environment
         self.bcf.cloud = self.cloud
@@ -258,14 +706,15 @@ class GAScheduler(IScheduler):
             self.population = []
             for i in range(self.population_size):
                 unit = create_random(self.environment, self.cloud,
-                                     self.no_el_price, self.no_temperature)
+                                     self.no_el_price, self.no_temperature,
+                                     self.genome)
                 self.population.append(unit)
         else:
             new_random_units = []
             # randomly create self.num_random_recreate new units
             for i in range(self.num_random_recreate):
                 unit = create_random(self.environment, self.cloud,
-                    self.no_el_price, self.no_temperature)
+                    self.no_el_price, self.no_temperature, self.genome)
                 new_random_units.append(unit)
             len_new = len(new_random_units)
             existing_population = existing_population[:-len_new]
@@ -288,7 +737,24 @@ class GAScheduler(IScheduler):
                     unit.changed = True
 
     def _termination_condition(self):
-        return (self._iteration == self.max_generations)
+        """Stop after max_generations, when another generation (as long as
+        the average one so far) wouldn't fit into the time_budget or when the
+        best fitness hasn't improved for max_stagnation generations. The
+        reason is kept in self._stop_reason.
+
+        """
+        if self._iteration == self.max_generations:
+            self._stop_reason = 'max_generations'
+        elif self.time_budget is not None and \
+             time.time() - self._start_time + np.mean(self._generation_times) \
+             > self.time_budget:
+            self._stop_reason = 'time_budget'
+        elif self.max_stagnation is not None and \
+             self._stagnation >= self.max_stagnation:
+            self._stop_reason = 'stagnation'
+        else:
+            return False
+        return True
 
     def _best_satisfies_constraints(self):
         """Best unit that satisfies hard constraints or None if none do."""
@@ -353,40 +819,36 @@ class GAScheduler(IScheduler):
                 current_actions = np.append(current_actions, action)
                 unit.changed = True
 
-    def genetic_algorithm(self):
-        """Propagate through generations, evolve ScheduleUnits and find
-        the fittest one.
+    def _evolve(self, num_children, num_mutation, pool=None, exchange=None):
+        """Evolve the population until the termination condition is met,
+        evaluating the fitness in the FitnessPool, if given. exchange is
+        called every migration_interval generations (see _evolve_island).
 
         """
-        num_children = int(round(self.population_size *
-                                 self.recombination_rate))
-        num_mutation = int(round(self.population_size *self.mutation_rate))
-        self.num_random_recreate = int(round(self.population_size *
-                                             self.random_recreate_ratio))
-        num_artificial_boot = int(round(self.population_size *
-                                        self.artificial_boot_ratio))
-
-        start = self.environment.t
-        end = self.environment.forecast_end
-
-        self._create_or_update_population()
-
-        # if there are any new boot requests, artificially add them
-        #self._artificially_add_boots(num_artificial_boot)
-
-        # TODO: check for deleted VMs and remove these actions
-
         # main loop TODO: split into smaller functions
         self._iteration = 0
+        self._generation_times = []
+        self._stagnation = 0 # generations since the best fitness improved
+        best_fitness = None
+        generation_start = time.time()
         while True: # get new generation
-            # calculate fitness
-            for unit in self.population:
-                unit.calculate_fitness()
+            # calculate fitness (all the changed units at once)
+            calculate_population_fitness(self.population, pool,
+                                         self.fitness_cache)
 
             self._iteration += 1
             debug('- generation {}'.format(self._iteration))
 
             self.population.sort(key=lambda u : u.fitness, reverse=False)
+            fitness = self.population[0].fitness
+            if best_fitness is None or fitness < best_fitness:
+                best_fitness = fitness
+                self._stagnation = 0
+            else:
+                self._stagnation += 1
+            now = time.time()
+            self._generation_times.append(now - generation_start)
+            generation_start = now
             debug('  - best fitness: {}'.format(self.population[0].fitness))
             debug('  - wrst {}'.format(repr(self.population[-1])))
             debug('  - best {}'.format(repr(self.population[0])))
@@ -397,12 +859,16 @@ class GAScheduler(IScheduler):
             if self._termination_condition():
                 break
 
+            if exchange is not None and \
+               self._iteration % self.migration_interval == 0:
+                exchange()
+
             # recombination
             # TODO: generate two children from one pair
             # choose parents weight. among all
             parents = roulette_selection(self.population, num_children)
             children = []
-            for j in range(num_children / 2):
+            for j in range(num_children // 2):
                 parent1, parent2 = parents[j], parents[j + 1]
                 child, child2 = parent1.crossover(parent2)
                 children.append(child)
@@ -412,6 +878,151 @@ class GAScheduler(IScheduler):
             # mutation
             for unit in random.sample(self.population, num_mutation):
                 unit = unit.mutation()
+
+    def _evolve_population(self, num_children, num_mutation):
+        """Evolve the (new or updated) population in this process."""
+        self._create_or_update_population()
+
+        pool = None
+        if self.workers > 1:
+            vms = set(self.cloud.vms)
+            vms.update(request.vm for request in self.environment.get_requests())
+            for unit in self.population:
+                vms.update(unit.genome.vms)
+            pool = FitnessPool(self.workers, self.cloud, self.environment,
+                               vms, self.no_temperature)
+        try:
+            self._evolve(num_children, num_mutation, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def _export(self, units):
+        """The units' codes and penalties, to send to another process."""
+        return [(unit.codes(), (unit.util, unit.cost, unit.constr, unit.sla))
+                for unit in units]
+
+    def _import(self, exported):
+        """Units of this scheduler from exported ones (see _export)."""
+        vms = {vm.id: vm for vm in self.genome.vms}
+        vms.update((vm.id, vm) for vm in self.cloud.vms)
+        servers = {server.id: server for server in self.cloud.servers}
+        units = []
+        for codes, penalties in exported:
+            unit = ScheduleUnit.from_codes(codes, vms, servers, self.genome)
+            unit.environment = self.environment
+            unit.cloud = self.cloud
+            unit.no_el_price = self.no_el_price
+            unit.no_temperature = self.no_temperature
+            unit._set_fitness(*penalties)
+            units.append(unit)
+        return units
+
+    def _evolve_island(self, conn, num_children, num_mutation):
+        """Evolve this island's population, sending its best units through
+        conn and replacing its worst ones with the units received back."""
+        self._create_or_update_population()
+
+        def exchange():
+            conn.send(('migrants',
+                       self._export(self.population[:self.migration_size])))
+            immigrants = self._import(conn.recv())
+            if immigrants:
+                self.population = (self.population[:-len(immigrants)] +
+                                   immigrants)
+                self.population.sort(key=lambda u : u.fitness)
+
+        self._evolve(num_children, num_mutation, exchange=exchange)
+        conn.send(('done', (self._iteration, self._generation_times,
+                            self._stop_reason,
+                            self._export(self.population))))
+
+    def _evolve_islands(self, num_children, num_mutation):
+        """Evolve self.islands populations, each in its own process and with
+        its own random seed, starting from this population (or random ones).
+        Every migration_interval generations the islands exchange their
+        best units in a ring. The population becomes the fittest of all the
+        islands' units.
+
+        """
+        seeds = [random.randrange(2**32) for i in range(self.islands)]
+        conns, processes = [], []
+        exported = []
+        try:
+            for seed in seeds:
+                conn, island_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_run_island,
+                    args=(self, seed, island_conn, num_children, num_mutation)
+                )
+                process.start()
+                island_conn.close() # only the island's end stays open
+                conns.append(conn)
+                processes.append(process)
+            active = list(range(self.islands))
+            self._iteration = 0
+            self._generation_times = []
+            stop_reasons = set()
+            while active:
+                messages = {i: conns[i].recv() for i in active}
+                migrating = []
+                for i in active:
+                    kind, payload = messages[i]
+                    if kind == 'error':
+                        raise RuntimeError('island {} failed: {}'.format(
+                            i, payload))
+                    elif kind == 'done':
+                        iteration, generation_times, reason, units = payload
+                        self._iteration = max(self._iteration, iteration)
+                        self._generation_times.extend(generation_times)
+                        stop_reasons.add(reason)
+                        exported.extend(units)
+                    else:
+                        migrating.append(i)
+                # every island gets the best units of the previous one
+                for k, i in enumerate(migrating):
+                    if len(migrating) > 1:
+                        conns[i].send(messages[migrating[k - 1]][1])
+                    else:
+                        conns[i].send([])
+                active = migrating
+        finally:
+            for process in processes:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        self._stop_reason = ','.join(sorted(stop_reasons))
+        population = self._import(exported)
+        population.sort(key=lambda u : u.fitness)
+        self.population = population[:self.population_size]
+
+    def genetic_algorithm(self):
+        """Propagate through generations, evolve ScheduleUnits and find
+        the fittest one.
+
+        """
+        self._start_time = time.time()
+        num_children = int(round(self.population_size *
+                                 self.recombination_rate))
+        num_mutation = int(round(self.population_size *self.mutation_rate))
+        self.num_random_recreate = int(round(self.population_size *
+                                             self.random_recreate_ratio))
+        num_artificial_boot = int(round(self.population_size *
+                                        self.artificial_boot_ratio))
+
+        start = self.environment.t
+        end = self.environment.forecast_end
+
+        # if there are any new boot requests, artificially add them
+        #self._artificially_add_boots(num_artificial_boot)
+
+        # TODO: check for deleted VMs and remove these actions
+
+        if self.islands > 1: # the islands evaluate their units serially
+            self._evolve_islands(num_children, num_mutation)
+        else:
+            self._evolve_population(num_children, num_mutation)
         if self.greedy_constraint_fix:
             # first try to get best that satisfies hard constraints
             best = self._best_satisfies_constraints()
@@ -426,6 +1037,18 @@ class GAScheduler(IScheduler):
                 best.calculate_fitness()
         else:
             best = self.population[0]
+        self.stats.append({
+            't': self.environment.t,
+            'generations': self._iteration,
+            'generation_time': np.mean(self._generation_times),
+            'duration': time.time() - self._start_time,
+            'stop_reason': self._stop_reason,
+        })
+        debug('- {generations} generations, {generation_time:.3}s each, '
+              'stopped by {stop_reason}'.format(**self.stats[-1]))
+        if self.fitness_cache is not None:
+            debug('- fitness cache: {} hits, {} misses'.format(
+                self.fitness_cache.hits, self.fitness_cache.misses))
         debug(' \u2502\n \u2514\u2500\u25BA selected {}'.format(repr(best)))
         # debug unallocated VMs
         if best.constr > 0:
@@ -1,7 +1,10 @@
 
 from nose.tools import *
 
+import random
+
 import pandas as pd
+import numpy as np
 from mock import MagicMock, patch
 
 from philharmonic.scheduler.ga import gascheduler
@@ -519,3 +522,246 @@ def test_update():
 def test_update_empty_schedule():
     schedule = ScheduleUnit()
     schedule.update()
+
+def _two_locations(num_vms=2):
+    """VMs, a server at each location - A (more expensive in the first
+    day) and B (in the second) - their cloud and the environment."""
+    vms = [VM(4,2), VM(2,1)][:num_vms]
+    servers = [Server(8,4, location="A"), Server(8,4, location="B")]
+    cloud = Cloud(servers, vms)
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = times[0]
+    env.el_prices = pd.DataFrame({'A': [0.13] * 24 + [0.05] * 24,
+                                  'B': [0.05] * 24 + [0.13] * 24}, times)
+    env.temperature = pd.DataFrame({'A': 20., 'B': 25.}, times)
+    evaluator.precreate_synth_power(env.start, env.end, servers)
+    return vms, servers, cloud, env
+
+def _small_scheduler(cloud, env, **attributes):
+    """A GAScheduler (seeded) with a small population and the attributes."""
+    random.seed(1)
+    np.random.seed(1)
+    scheduler = gascheduler.GAScheduler(cloud)
+    scheduler.environment = env
+    scheduler.population_size = 6
+    scheduler.recombination_rate = 0.34
+    scheduler.mutation_rate = 0.34
+    scheduler.max_generations = 4
+    scheduler.greedy_constraint_fix = False
+    for name, value in attributes.items():
+        setattr(scheduler, name, value)
+    scheduler.initialize()
+    return scheduler
+
+def test_population_fitness():
+    (vm1,), (server1, server2), cloud, env = _two_locations(num_vms=1)
+    units = []
+    for t in ['2013-02-25 03:00', '2013-02-25 13:00', '2013-02-25 20:00']:
+        unit = ScheduleUnit()
+        unit.cloud = cloud
+        unit.environment = env
+        actions = [Migration(vm1, server1), Migration(vm1, server2)]
+        unit.actions = pd.Series(actions, [env.t, pd.Timestamp(t)])
+        units.append(unit)
+    gascheduler.calculate_population_fitness(units)
+    assert_true(all(not unit.changed for unit in units))
+    # the GA's replays keep snapshots to resume from
+    assert_true(all(unit._replay_prefixes for unit in units))
+    batched = [unit.fitness for unit in units]
+    for unit in units:
+        unit.changed = True
+    assert_equals([unit.calculate_fitness() for unit in units], batched)
+    assert_true(batched[0] < batched[1] < batched[2])
+
+def test_fitness_pool():
+    (vm1, vm2), (server1, server2), cloud, env = _two_locations()
+    units = []
+    for t in ['2013-02-25 03:00', '2013-02-25 13:00', '2013-02-25 20:00']:
+        unit = ScheduleUnit()
+        unit.cloud = cloud
+        unit.environment = env
+        actions = [Migration(vm1, server1), Migration(vm2, server1),
+                   Migration(vm1, server2)]
+        unit.actions = pd.Series(actions, [env.t, env.t, pd.Timestamp(t)])
+        units.append(unit)
+    pool = gascheduler.FitnessPool(2, cloud, env, [vm1, vm2])
+    try:
+        gascheduler.calculate_population_fitness(units, pool)
+    finally:
+        pool.close()
+    assert_true(all(not unit.changed for unit in units))
+    parallel = [(unit.fitness, unit.util, unit.cost, unit.constr, unit.sla)
+                for unit in units]
+    for unit in units:
+        unit.changed = True
+    gascheduler.calculate_population_fitness(units)
+    serial = [(unit.fitness, unit.util, unit.cost, unit.constr, unit.sla)
+              for unit in units]
+    assert_equals(parallel, serial)
+    pool = gascheduler.FitnessPool(2, cloud, env, [vm1, vm2])
+    try:
+        assert_equals(pool.evaluate([]), [])
+    finally:
+        pool.close()
+
+def test_gascheduler_workers():
+    vms, servers, cloud, env = _two_locations()
+    serial = _small_scheduler(cloud, env)
+    best = serial.genetic_algorithm()
+    # with the fitness cache on, some generations have nothing to evaluate
+    parallel = _small_scheduler(cloud, env, workers=2)
+    assert_is_not(parallel.fitness_cache, None)
+    best2 = parallel.genetic_algorithm()
+    assert_true(parallel.fitness_cache.hits > 0)
+    assert_equals(best2.fitness, best.fitness)
+    assert_equals(list(best2.actions.index), list(best.actions.index))
+    assert_equals([action.key for action in best2.actions.values],
+                  [action.key for action in best.actions.values])
+
+def test_genes():
+    vm1 = VM(4,2)
+    vm2 = VM(2,1)
+    server1 = Server(8,4, location="A")
+    server2 = Server(8,4, location="B")
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = times[0]
+    genome = gascheduler.Genome()
+    unit = ScheduleUnit(genome)
+    unit.environment = env
+    unit.cloud = Cloud([server1, server2], set([vm1]))
+    unit.add(Migration(vm1, server1), times[3])
+    unit.add(Migration(vm2, server1), times[1])
+    unit.add(Migration(vm1, server2), times[3]) # supersedes the first
+    assert_false(unit.add(Migration(vm1, server2), times[3]))
+    hours, vm_genes, server_genes = unit.genes
+    assert_equals(hours.dtype, np.int32)
+    assert_equals(list(vm_genes), [1, 0])
+    assert_equals(list(server_genes), [0, 1])
+    assert_equals(list(unit.actions.values),
+                  [Migration(vm2, server1), Migration(vm1, server2)])
+    assert_equals(list(unit.actions.index), [times[1], times[3]])
+    other = ScheduleUnit(genome)
+    other.add(Migration(vm2, server2), times[2])
+    other.add(Migration(vm1, server1), times[5])
+    child = unit.merge(other, times[2])
+    assert_equals(list(child.actions.values),
+                  [Migration(vm2, server1), Migration(vm1, server1)])
+    unit.update() # vm2 is not in the cloud
+    assert_equals(list(unit.actions.values), [Migration(vm1, server2)])
+    assert_true(unit.changed)
+
+def test_genes_schedule_methods():
+    vm1 = VM(4,2)
+    vm2 = VM(2,1)
+    server1 = Server(8,4, location="A")
+    server2 = Server(8,4, location="B")
+    times = pd.date_range('2013-02-25 00:00', periods=60, freq='min')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=30)
+    env.t = times[0]
+    unit = ScheduleUnit()
+    unit.environment = env
+    # not on a full hour
+    unit.add(Migration(vm1, server1), times[30])
+    # the inherited methods change the genes, too
+    unit.extend([(times[0], Migration(vm2, server2)),
+                 (times[0], Migration(vm2, server1))])
+    assert_equals(len(unit), 2)
+    assert_equals(list(unit.genes[1]), [1, 0])
+    assert_equals(list(unit.codes()[0]), [times[0].value, times[30].value])
+    assert_equals(list(unit.actions.values),
+                  [Migration(vm2, server1), Migration(vm1, server1)])
+    unit.extend([(times[30], Migration(vm2, server2))], supersede=False)
+    unit.sort()
+    assert_equals(len(unit), 3)
+    assert_equals(list(unit.genes[1]), [1, 0, 1])
+    assert_raises(ValueError, unit.extend, [(times[1], VMRequest(vm1, 'boot'))])
+    assert_equals(len(unit), 3)
+    assert_raises(ValueError, unit.add, Migration(vm1, server1),
+                  times[1] + pd.offsets.Second(1))
+    unit = ScheduleUnit.from_arrays([times[5]], [Migration(vm1, server2)])
+    assert_equals(list(unit.codes()[0]), [times[5].value])
+
+def test_fitness_cache():
+    (vm1, vm2), (server1, server2), cloud, env = _two_locations()
+    orders = [[Migration(vm1, server1), Migration(vm2, server2)],
+              [Migration(vm2, server2), Migration(vm1, server1)],
+              [Migration(vm2, server1), Migration(vm1, server1)]]
+    units = []
+    for actions in orders:
+        unit = ScheduleUnit()
+        unit.cloud = cloud
+        unit.environment = env
+        unit.actions = pd.Series(actions, [env.t, env.t])
+        units.append(unit)
+    cache = gascheduler.FitnessCache()
+    gascheduler.calculate_population_fitness(units, cache=cache)
+    # the same actions in a different order share the fitness
+    assert_equals((cache.hits, cache.misses, len(cache)), (1, 2, 2))
+    assert_equals(units[0].fitness, units[1].fitness)
+    fitnesses = [unit.fitness for unit in units]
+    for unit in units:
+        unit.changed = True
+    with patch.object(gascheduler, '_evaluate_units') as mock_evaluate:
+        gascheduler.calculate_population_fitness(units, cache=cache)
+    assert_false(mock_evaluate.called) # all cached
+    assert_equals((cache.hits, cache.misses), (4, 2))
+    assert_equals([unit.fitness for unit in units], fitnesses)
+    # a different window is a different key
+    env.t = env.t + pd.offsets.Hour(1)
+    units[0].changed = True
+    gascheduler.calculate_population_fitness(units, cache=cache)
+    assert_equals((cache.hits, cache.misses), (4, 3))
+    # so is different forecast data
+    key = gascheduler._context_key(units[0])
+    env.temperature = env.temperature + 1.
+    assert_not_equals(gascheduler._context_key(units[0]), key)
+
+def test_fitness_cache_lru():
+    cache = gascheduler.FitnessCache(cache_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert_equals(cache.get('a'), 1)
+    cache.put('c', 3) # evicts b, the least recently used
+    assert_is(cache.get('b'), None)
+    assert_equals((cache.get('a'), cache.get('c')), (1, 3))
+    assert_equals((cache.hits, cache.misses), (3, 1))
+
+def test_gascheduler_islands():
+    vms, servers, cloud, env = _two_locations()
+    scheduler = _small_scheduler(cloud, env, islands=2, migration_interval=1,
+                                 migration_size=1)
+    best = scheduler.genetic_algorithm()
+    assert_equals(len(scheduler.population), 6)
+    assert_is(best, scheduler.population[0])
+    assert_is(best.cloud, cloud)
+    assert_equals(scheduler._iteration, 4)
+    fitnesses = [unit.fitness for unit in scheduler.population]
+    assert_equals(fitnesses, sorted(fitnesses))
+    # the islands' seeds come from the random module
+    scheduler2 = _small_scheduler(cloud, env, islands=2, migration_interval=1,
+                                  migration_size=1)
+    best2 = scheduler2.genetic_algorithm()
+    assert_equals(best2.fitness, best.fitness)
+    assert_equals(list(best2.actions.values), list(best.actions.values))
+
+def test_gascheduler_early_termination():
+    vms, servers, cloud, env = _two_locations()
+    # no time for more than the first generation
+    scheduler = _small_scheduler(cloud, env, max_generations=100,
+                                 time_budget=0.)
+    best = scheduler.genetic_algorithm()
+    assert_is(best, scheduler.population[0])
+    stats = scheduler.stats[-1]
+    assert_equals(stats['generations'], 1)
+    assert_equals(stats['stop_reason'], 'time_budget')
+    assert_true(stats['generation_time'] > 0)
+    # stop when the best fitness doesn't improve
+    scheduler.time_budget = None
+    scheduler.max_stagnation = 2
+    scheduler.genetic_algorithm()
+    stats = scheduler.stats[-1]
+    assert_equals(stats['stop_reason'], 'stagnation')
+    assert_true(3 <= stats['generations'] < 100)
+    assert_equals(len(scheduler.stats), 2)
@@ -63,6 +63,108 @@ def test_calculate_cloud_utilisation():
     assert_true((df_util[s2] == [0., 0., 0.375, 0.375]).all())
     assert_true((df_util[s3] == [0., 0., 0., 0.0]).all())
 
+def test_calculate_cloud_utilisation_from_checkpoint():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], [vm1, vm2])
+    cloud.checkpoint_interval = pd.offsets.Hour(1)
+    cloud._interval = cloud.checkpoint_interval
+
+    times = pd.date_range('2010-02-26 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    schedule = Schedule()
+    t1 = pd.Timestamp('2010-02-26 11:00')
+    t2 = pd.Timestamp('2010-02-26 13:00')
+    t3 = pd.Timestamp('2010-02-26 15:00')
+    for action, t in [(Migration(vm1, s1), t1), (Migration(vm2, s2), t2),
+                      (Migration(vm1, s2), t3)]:
+        schedule.add(action, t)
+        cloud.apply_real(action, t=t) # the real schedule was carried out
+    # evaluate a period of the past - start from a checkpoint, not _real
+    start = pd.Timestamp('2010-02-26 14:00')
+    df_util = calculate_cloud_utilisation(cloud, env, schedule, start=start)
+    assert_true((df_util[s1] == [0.5, 0., 0.]).all())
+    assert_true((df_util[s2] == [0.375, 0.625, 0.625]).all())
+
+def test_replay_schedule():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], set([vm1, vm2]))
+
+    times = pd.date_range('2010-02-26 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    schedule = Schedule()
+    t1 = pd.Timestamp('2010-02-26 11:00')
+    t2 = pd.Timestamp('2010-02-26 13:00')
+    schedule.add(Migration(vm1, s1), t1)
+    schedule.add(Migration(vm2, s1), t1)
+    schedule.add(Migration(vm2, s2), t2)
+    replay = replay_schedule(cloud, env, schedule, for_vms=True)
+    assert_equals(list(replay.times), [env.start, t1, t2, env.end])
+    assert_equals(list(replay.overcap_ratio), [0., 0.5, 0., 0.])
+    assert_equals(list(replay.sched_penalty), [1., 0., 0., 0.])
+    assert_equals(replay.migrations, [(t2, vm2, s1, s2)])
+    assert_equals(replay.migrations_num(), {vm1: 1, vm2: 2})
+    vm_cores = replay.vm_frame(replay.vm_cores)
+    assert_true((vm_cores[vm2] == [2, 2, 2, 2]).all())
+    # the metrics only read the replay
+    with patch.object(cloud, 'apply') as apply:
+        util = calculate_cloud_utilisation(cloud, env, schedule,
+                                           replay=replay)
+        penalty = calculate_constraint_penalties(cloud, env, schedule,
+                                                 replay=replay)
+        assert_false(apply.called)
+    assert_true((util[s1] == [0., 1., 0.5, 0.5]).all())
+    assert_equals(penalty,
+                  calculate_constraint_penalties(cloud, env, schedule))
+
+def test_replay_schedule_resume():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], set([vm1, vm2]))
+    times = pd.date_range('2010-02-26 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    parent = Schedule()
+    parent.add(Migration(vm1, s1), times[1])
+    parent.add(Migration(vm2, s1), times[1])
+    parent.add(Migration(vm2, s2), times[3])
+    parent.add(Migration(vm1, s2), times[5])
+    replay_schedule(cloud, env, parent, resume=True)
+    assert_equals(len(parent._replay_prefixes), 3) # one per action time
+    other = Schedule()
+    other.add(Migration(vm1, s1), times[6])
+    child = parent.merge(other, times[4]) # shares the first two times
+    with patch.object(cloud, 'apply', wraps=cloud.apply) as apply:
+        resumed = replay_schedule(cloud, env, child, resume=True)
+        assert_equals(apply.call_count, 1) # only the action at times[6]
+    fresh = replay_schedule(cloud, env, child)
+    assert_equals(list(resumed.times), list(fresh.times))
+    for name in Replay.step_series:
+        assert_true((getattr(resumed, name) == getattr(fresh, name)).all())
+    assert_equals(resumed.migrations, fresh.migrations)
+    assert_equals(resumed.migrations_num(), fresh.migrations_num())
+    # the parent's own later states aren't kept by the child
+    assert_equals(len(child._replay_prefixes), 3)
+    assert_false('_replay_prefixes' in child.__getstate__())
+    # only snapshots of the same context and exactly the same actions
+    with patch.object(cloud, 'apply', wraps=cloud.apply) as apply:
+        replay_schedule(cloud, env, child, method=None, resume=True)
+        assert_equals(apply.call_count, 4)
+    other = parent.merge(Schedule(), times[4])
+    other._replay_prefixes = {
+        key: (((0, (4, -1, -1)),) * key[1],) + snapshot[1:]
+        for key, snapshot in parent._replay_prefixes.items()
+    }
+    with patch.object(cloud, 'apply', wraps=cloud.apply) as apply:
+        replay_schedule(cloud, env, other, resume=True)
+        assert_equals(apply.call_count, 3)
+
 @patch('philharmonic.scheduler.evaluator.conf')
 def test_calculate_cloud_frequencies(mock_conf):
     # some servers
@@ -151,6 +253,16 @@ def test_generate_cloud_power():
     precreate_synth_power(index[0], index[-1], ['s1'])
     power = generate_cloud_power(util)
 
+def test_calculate_power_values():
+    util = np.array([[0, 0.5], [0.25, 1.]])
+    out = np.empty_like(util)
+    power = calculate_power_values(util, power_model='base', out=out)
+    assert_true(power is out)
+    expected = ph.calculate_power(util, conf.P_idle, conf.P_peak)
+    assert_true((power == expected).all())
+    assert_raises(ValueError, calculate_power_values, util,
+                  power_model='nuclear')
+
 @patch('philharmonic.scheduler.evaluator.conf')
 def test_generate_cloud_power_multicore(mock_conf):
     mock_conf = _configure(mock_conf)
@@ -615,6 +727,34 @@ def test_calculate_migration_overhead():
     assert_greater(migration_cost, 0.)
 
 
+def test_migration_overheads():
+    s1 = Server(4, 2, location='A')
+    s2 = Server(4, 2, location='B')
+    vm1 = VM(2, 2);
+    cloud = Cloud([s1, s2], set([vm1]), auto_allocate=False)
+    times = pd.date_range('2010-02-26 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.el_prices = pd.DataFrame({'A': 0.1, 'B': 0.3}, times)
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), times[0]) # boot - no overhead
+    schedule.add(Migration(vm1, s2), times[2])
+    schedule.add(Migration(vm1, s1), times[4])
+    replay = replay_schedule(cloud, env, schedule, method=None)
+    overheads = migration_overheads(replay, env.el_prices)
+    assert_equals(list(overheads.index), [times[2], times[4]])
+    assert_equals(list(overheads['target']), [s2, s1])
+    # 2 GB: 3 pre-copy iterations of a 30% dirtying rate
+    assert_equals(list(overheads['n']), [3, 3])
+    data = 2000 * (1 - 0.3**4) / 0.7
+    assert_almost_equals(overheads['data'].iloc[0], data)
+    energy = (0.512 * data + 20.165) / 3.6e6
+    assert_almost_equals(overheads['energy'].iloc[1], energy)
+    assert_almost_equals(overheads['cost'].iloc[0], energy * 0.2)
+    total_energy, total_cost = calculate_migration_overhead(
+        cloud, env, schedule, replay=replay)
+    assert_almost_equals(total_energy, 2 * energy)
+    assert_almost_equals(total_cost, 2 * energy * 0.2)
+
 def test_evaluate():
     # some servers
     s1 = Server(4000, 2, location='A')
@@ -647,3 +787,99 @@ def test_evaluate():
     assert_true(0 <= cost_penalty <= 1, 'normalised value expected')
     assert_true(0 <= constraint_penalty <= 1, 'normalised value expected')
     assert_true(0 <= sla_penalty <= 1, 'normalised value expected')
+
+def test_evaluator_caches():
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    vm1 = VM(2000, 1)
+    cloud = Cloud([s1, s2], set([vm1]))
+    times = pd.date_range('2010-02-26 0:00', '2010-02-27 0:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    el_prices = pd.DataFrame({'A': 0.1, 'B': 0.2}, times)
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), times[0])
+
+    evaluator = Evaluator(cache_size=2)
+    evaluator.precreate_synth_power(env.start, env.end, cloud.servers)
+    cheap_a = evaluator.evaluate(cloud, env, schedule, el_prices)
+    assert_false(hasattr(schedule, '_replay_prefixes')) # no resume snapshots
+    # an equal forecast in a new object is a cache hit
+    evaluator.evaluate(cloud, env, schedule, el_prices.copy())
+    assert_equals(len(evaluator._inputs), 1)
+    # a different forecast for the same period isn't
+    swapped = el_prices.rename(columns={'A': 'B', 'B': 'A'})
+    expensive_a = evaluator.evaluate(cloud, env, schedule, swapped)
+    assert_greater(expensive_a[1], cheap_a[1])
+    evaluator.evaluate(cloud, env, schedule, el_prices, start=times[1])
+    assert_equals(len(evaluator._inputs), 2) # the LRU entry was evicted
+    assert_equals(evaluator.evaluate(cloud, env, schedule, el_prices), cheap_a)
+
+@patch('philharmonic.scheduler.evaluator.conf')
+def test_combined_energy_exact(mock_conf):
+    _configure(mock_conf)
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    vm1 = VM(2000, 1)
+    cloud = Cloud([s1, s2], set([vm1]))
+    times = pd.date_range('2010-02-26 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), times[0])
+    schedule.add(Migration(vm1, s2), times[2])
+    # 185 W for 2 h on s1, then 142.5 W for 6 h on s2 (both at f_max)
+    energy = combined_energy(cloud, env, schedule, exact=True)
+    assert_almost_equals(energy, (185 * 2 + 142.5 * 6) / 1000.)
+    el_prices = pd.DataFrame({'A': 0.1, 'B': 0.2}, times)
+    cost = combined_cost(cloud, env, schedule, el_prices, exact=True)
+    assert_almost_equals(cost, 0.1 * 185 * 2 / 1000. + 0.2 * 142.5 * 6 / 1000.)
+
+def test_location_sum():
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    s3 = Server(4000, 4, location='A')
+    idx = inputgen.two_days()
+    power = pd.DataFrame({s1: 100., s2: 200., s3: 150.}, idx)
+    power_loc = location_sum(power)
+    assert_equals(list(power_loc.columns), ['A', 'B'])
+    assert_true((power_loc['A'] == 250.).all())
+    assert_true((power_loc['B'] == 200.).all())
+    # the same total cost, whether per server or per location
+    el_prices = pd.DataFrame({'A': 0.05, 'B': 0.13}, idx)
+    cost = calculate_cloud_cost(power, el_prices)
+    cost_loc = calculate_cloud_cost(power_loc, el_prices)
+    assert_almost_equals(cost_loc['A'], cost[s1] + cost[s3])
+    assert_almost_equals(cost_loc.sum(), cost.sum())
+
+def test_evaluate_population():
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    s3 = Server(4000, 4, location='A')
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 2)
+    cloud = Cloud([s1, s2, s3], set([vm1, vm2]))
+    times = pd.date_range('2010-02-26 8:00', '2010-02-27 8:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    el_prices = pd.DataFrame({'A': 0.1, 'B': 0.2}, times)
+    el_prices.iloc[12:, 0] = 0.3
+    temperature = pd.DataFrame({'A': 20., 'B': 25.}, times)
+    precreate_synth_power(env.start, env.end, cloud.servers)
+    schedules = []
+    for hour in [2, 5, 17]:
+        schedule = Schedule()
+        schedule.add(Migration(vm1, s1), times[0])
+        schedule.add(Migration(vm2, s3), times[0])
+        schedule.add(Migration(vm1, s2), times[hour])
+        schedule.add(Migration(vm2, s2), times[hour + 1])
+        schedule.add(Migration(vm2, s1), times[hour + 3])
+        schedules.append(schedule)
+    schedules.append(Schedule()) # nothing allocated
+    batched = evaluate_population(cloud, env, schedules, el_prices,
+                                  temperature, times[1], times[-1])
+    assert_equals(len(batched), len(schedules))
+    for schedule, penalties in zip(schedules, batched):
+        single = evaluate(cloud, env, schedule, el_prices, temperature,
+                          times[1], times[-1])
+        for value, expected in zip(penalties, single):
+            assert_almost_equals(value, expected)
+    assert_equals(batched[-1][0], 1.) # no utilisation
+    assert_equals(evaluate_population(cloud, env, [], el_prices), [])
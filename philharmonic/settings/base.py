@@ -225,6 +225,18 @@ inputgen_settings = {
 # Simulation details
 #===================
 
+# The implementation of the cloud State. Available options:
+# - "dict" - per-server dicts and sets (default)
+# - "array" - NumPy resource matrices (faster copies for large clouds)
+state_engine = "dict"
+
+# the cloud keeps copies of the real state at least this far apart
+# (pd.offsets.* or None), so that evaluating a period of the past can
+# start from the nearest one instead of the initial state
+checkpoint_interval = pd.offsets.Hour(1)
+# at most this many checkpoints (they get sparser as the simulation runs)
+max_checkpoints = 48
+
 # the frequency at which to generate the power signals
 # power_freq = '5min'
 power_freq = '1min'
@@ -23,6 +23,24 @@ gaconf = {
     "w_cost": 0.4,
     "w_sla": 0.,
     "w_constraint": 0.2,
+    # number of worker processes evaluating the fitness in parallel
+    # (0 - evaluate in the scheduler's process)
+    "workers": 0,
+    # the number of evaluated units kept in the LRU fitness cache
+    # (0 - no cache)
+    "fitness_cache_size": 1000,
+    # island model - the number of populations evolved in parallel
+    # processes (0 - a single population), exchanging their
+    # migration_size best units every migration_interval generations
+    "islands": 0,
+    "migration_interval": 5,
+    "migration_size": 2,
+    # anytime GA - stop early (returning the best unit so far) when the
+    # wall-clock time budget in seconds would be exceeded by another
+    # generation or the best fitness hasn't improved for max_stagnation
+    # generations (None - no limit)
+    "time_budget": None,
+    "max_stagnation": None,
 }
 
 if production_settings:
@@ -94,14 +94,14 @@ ev = evaluator
     info(util.max().max())"""
 
 
-def generate_series_results(cloud, env, schedule, nplots):
+def generate_series_results(cloud, env, schedule, nplots, replay=None):
     """Generate power of IT equipment (power) and power of IT equipment
     including the cooling overhead time series for the simulation duration.
     """
     info('\nDynamic results\n---------------')
     util, power, power_total, freq = ev.calculate_components(
         cloud, env, schedule, env.el_prices, env.temperature,
-        power_model=conf.power_model
+        power_model=conf.power_model, replay=replay
     )
 
     info('Utilisation (%)')
@@ -167,14 +167,18 @@ def serialise_results(cloud, env, schedule):
         ax.set_title('Temperature (C)')
         env.temperature.plot(ax=ax)
 
+    # all the metrics come from a single pass through the schedule
+    replay = evaluator.replay_schedule(cloud, env, schedule,
+                                       method=conf.power_model, for_vms=True)
+
     # dynamic results
     #----------------
-    generate_series_results(cloud, env, schedule, nplots)
+    generate_series_results(cloud, env, schedule, nplots, replay)
 
     # the values used for the aggregated results
-    energy = evaluator.combined_energy(cloud, env, schedule)
+    energy = evaluator.combined_energy(cloud, env, schedule, replay=replay)
     energy_total = evaluator.combined_energy(cloud, env, schedule,
-                                             env.temperature)
+                                             env.temperature, replay=replay)
 
     # Aggregated results
     #===================
@@ -183,7 +187,7 @@ def serialise_results(cloud, env, schedule):
     # migration overhead
     #-------------------
     migration_energy, migration_cost = evaluator.calculate_migration_overhead(
-        cloud, env, schedule
+        cloud, env, schedule, replay=replay
     )
     info('Migration energy (kWh)')
     info(migration_energy)
@@ -203,7 +207,8 @@ def serialise_results(cloud, env, schedule):
     info(' - total electricity cost without cooling:')
     en_cost_IT_total = evaluator.combined_cost(cloud, env, schedule,
                                                env.el_prices,
-                                               power_model=conf.power_model)
+                                               power_model=conf.power_model,
+                                               replay=replay)
     info(en_cost_IT_total)
 
     # TODO: reenable
@@ -214,7 +219,7 @@ def serialise_results(cloud, env, schedule):
     info(' - total electricity cost with cooling:')
     en_cost_with_cooling_total = evaluator.combined_cost(
         cloud, env, schedule, env.el_prices, env.temperature,
-        power_model=conf.power_model
+        power_model=conf.power_model, replay=replay
     )
     info(en_cost_with_cooling_total)
     info(' - total electricity cost with migrations:')
@@ -226,14 +231,18 @@ def serialise_results(cloud, env, schedule):
     schedule_unscaled.actions = schedule.actions[
         schedule.actions.apply(lambda a : not a.name.endswith('freq'))
     ]
+    replay_unscaled = evaluator.replay_schedule(cloud, env, schedule_unscaled,
+                                                method=conf.power_model,
+                                                for_vms=True)
 
     # QoS aspects
     info(' - total profit from users:')
-    serv_profit = evaluator.calculate_service_profit(cloud, env, schedule)
+    serv_profit = evaluator.calculate_service_profit(cloud, env, schedule,
+                                                     replay=replay)
     info(f'${serv_profit}')
     info(' - profit loss due to scaling:')
     serv_profit_unscaled = evaluator.calculate_service_profit(
-        cloud, env, schedule_unscaled
+        cloud, env, schedule_unscaled, replay=replay_unscaled
     )
     scaling_profit_loss = serv_profit_unscaled - serv_profit
     scaling_profit_loss_rel = scaling_profit_loss / serv_profit_unscaled
@@ -244,7 +253,7 @@ def serialise_results(cloud, env, schedule):
     info(' - frequency scaling savings (compared to no scaling):')
     en_cost_combined_unscaled = evaluator.combined_cost (
         cloud, env, schedule_unscaled, env.el_prices, env.temperature,
-        power_model=conf.power_model) + migration_cost
+        power_model=conf.power_model, replay=replay_unscaled) + migration_cost
 
     scaling_savings_abs = en_cost_combined_unscaled - en_cost_combined
     info(f'${scaling_savings_abs}')
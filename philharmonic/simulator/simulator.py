@@ -164,7 +164,7 @@ class Simulator(IManager):
     def apply_actions(self, actions):
         # self.cloud.reset_to_real()
         for t, action in actions.items():
-            self.cloud.apply_real(action)
+            self.cloud.apply_real(action, t=t)
             self.real_schedule.add(action, t)
             self.driver.apply_action(action, t)
             # Log the current state
@@ -102,6 +102,53 @@ def calculate_power_multicore(
 
 ##################
 
+# array-native models
+#####################
+# The same models on raw NumPy arrays (or scalars - giving 0-d arrays),
+# without the pandas overhead - the result can be written into out
+# (an existing array).
+
+def _out_array(out, *inputs):
+    """out or a new array of the inputs' (broadcast) shape."""
+    if out is None:
+        out = np.empty(np.broadcast(*inputs).shape)
+    return out
+
+def calculate_power_array(util, P_idle=100, P_peak=200, out=None):
+    """calculate_power for arrays."""
+    util = np.asarray(util, dtype=float)
+    out = _out_array(out, util)
+    out = np.multiply(util, P_peak - P_idle, out=out) # dynamic part
+    # a server with no load is suspended (otherwise idle power applies)
+    return np.add(out, P_idle, out=out, where=out > 0)
+
+def calculate_power_freq_array(ut, f=2000, P_idle=100, P_base=150,
+                               P_dif=15, f_base=1000, out=None):
+    """calculate_power_freq for arrays."""
+    ut, f = np.asarray(ut, dtype=float), np.asarray(f, dtype=float)
+    out = _out_array(out, ut, f)
+    out = np.multiply(
+        ut, P_base + P_dif * ((f - float(f_base)) / f_base)**3 - P_idle,
+        out=out
+    )
+    # a server with no load is suspended (otherwise idle power applies)
+    return np.add(out, P_idle, out=out, where=out > 0)
+
+def calculate_power_multicore_array(
+        util, freq, active_cores, max_cores, max_capacity=8, freq_abs_min=1800,
+        freq_abs_delta=200, power_weights=None, out=None):
+    """calculate_power_multicore for arrays."""
+    try:
+        freq_discr = ((freq - freq_abs_min).astype(int) / freq_abs_delta) + 1
+    except AttributeError: # it's a scalar
+        freq_discr = ((freq - freq_abs_min) / freq_abs_delta) + 1
+    c = active_cores
+    max_power = _calculate_peakpower_freq_multicore(freq_discr, c, power_weights)
+    idle_power =  _calculate_peakpower_freq_multicore(freq_discr, 0, power_weights)
+    return np.add(idle_power, (max_power - idle_power) * util, out=out)
+
+#####################
+
 
 def calculate_price_old(power, price_file, start_date=None, old_parser=False):
     """parse prices from a price_file ($/kWh), realign it to start_date
@@ -203,6 +250,43 @@ def calculate_energy(power, estimate=False):
     if isinstance(power, pd.Series):
         return _calculate_series_energy(power, estimate)
 
+def align_piecewise(*signals):
+    """Reindex piecewise-constant signals (every value holds until the next
+    index) to the union of all their change points.
+
+    """
+    index = signals[0].index
+    for signal in signals[1:]:
+        index = index.union(signal.index)
+    return [signal.reindex(index, method='ffill') for signal in signals]
+
+def integrate_piecewise(signal, end=None):
+    """Calculates the exact integral of a piecewise-constant signal over time,
+    i.e. the sum of value * duration over its change points.
+    @param signal: Series or DataFrame - every value holds until the next
+    index (the last one until end, if given)
+    @return: integral in value * seconds (e.g. Joules for power in Watts)
+
+    """
+    times = signal.index.asi8
+    if end is None:
+        end = times[-1]
+    else:
+        end = pd.Timestamp(end).value
+    durations = np.diff(np.append(times, end)) / 10**9
+    return signal.mul(durations, axis=0).sum()
+
+def calculate_price_piecewise(power, prices, end=None):
+    """Exact price of the energy of a piecewise-constant power signal (W)
+    with piecewise-constant electricity prices ($/kWh) - no resampling.
+    Should work for DataFrames (with matching columns) too.
+
+    @Return: calculated price in $
+
+    """
+    power, prices = align_piecewise(power, prices)
+    return integrate_piecewise(power * per_kwh2per_joul(prices), end)
+
 def calculate_cooling_overhead_old(power, temperature):
     """Use a model of cooling overhead and real-time temperatures
     to calculate real-time PUE values and calculate the resulting power.
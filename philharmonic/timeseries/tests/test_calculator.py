@@ -158,6 +158,35 @@ def test_calculate_power_multicore():
     #assert_equals(list(power['s1'][num:]), [132.5] * num)
     #assert_equals(list(power['s2']), [148.75] * 2 * num)
 
+def test_calculate_power_arrays():
+    index = pd.date_range('2013-01-01', periods=6, freq='H')
+    util = pd.DataFrame({'s1': [0, 0, 0, 0.5, 0.5, 0.5], 's2': 0.75}, index)
+    freq = pd.DataFrame({'s1': 2000., 's2': 1600.}, index)
+    cores = pd.DataFrame({'s1': [3, 3, 3, 4, 4, 4], 's2': 0}, index)
+    weights = [1.318, 0.03559, 0.2243, -0.003184, 0.03137, 0.0004377, 0.007106]
+    assert_true((ph.calculate_power_array(util.values) ==
+                 ph.calculate_power(util).values).all())
+    power = ph.calculate_power_freq(util, freq)
+    out = ph.calculate_power_freq_array(util.values, freq.values)
+    assert_true((out == power.values).all())
+    power = ph.calculate_power_multicore(util, freq, cores, 4,
+                                        power_weights=weights)
+    result = ph.calculate_power_multicore_array(
+        util.values, freq.values, cores.values, 4, power_weights=weights,
+        out=out
+    )
+    assert_true(result is out) # written into the given array
+    assert_true((out == power.values).all())
+    # scalars
+    assert_equals(float(ph.calculate_power_array(0.5)), 150.)
+    assert_equals(float(ph.calculate_power_array(0)), 0.)
+    assert_equals(float(ph.calculate_power_freq_array(0.5, 2000)),
+                  float(ph.calculate_power_freq(pd.Series([0.5]), 2000)[0]))
+    assert_equals(float(ph.calculate_power_multicore_array(
+        0.5, 2000., 3, 4, power_weights=weights)),
+                  ph.calculate_power_multicore(0.5, 2000., 3, 4,
+                                               power_weights=weights))
+
 def test_vm_price():
     cost = ph.vm_price(2000)
     assert_is_instance(cost, float)
@@ -194,6 +223,26 @@ def test_vm_price_multicore():
     assert_greater(cost3, cost1)
     assert_equals(cost4, cost5)
 
+def test_integrate_piecewise():
+    index = pd.DatetimeIndex(['2013-01-01 00:00', '2013-01-01 01:00',
+                              '2013-01-01 03:00'])
+    power = pd.DataFrame({'s1': [100, 200, 200], 's2': [0, 0, 50]}, index)
+    energy = ph.integrate_piecewise(power)
+    assert_equals(energy['s1'], 100 * 3600 + 200 * 7200)
+    assert_equals(energy['s2'], 0)
+    energy = ph.integrate_piecewise(power['s2'], end='2013-01-01 04:00')
+    assert_equals(energy, 50 * 3600)
+
+def test_calculate_price_piecewise():
+    index = pd.DatetimeIndex(['2013-01-01 00:00', '2013-01-01 01:00',
+                              '2013-01-01 03:00'])
+    power = pd.Series([100, 200, 200], index)
+    prices = pd.Series([0.1, 0.2], pd.DatetimeIndex(['2013-01-01 00:00',
+                                                     '2013-01-01 02:00']))
+    # 0.1 kWh at 0.1 $/kWh, then 0.2 kWh at 0.1 $/kWh and at 0.2 $/kWh
+    price = ph.calculate_price_piecewise(power, prices)
+    assert_almost_equals(price, 0.01 + 0.02 + 0.04)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testEnergyPrice']
     unittest.main()
@@ -11,7 +11,7 @@ def random_time(start, end, round_to_hour=True):
 
     """
     delta = end - start
-    offset = pd.offsets.Second(np.random.uniform(0., delta.total_seconds()))
+    offset = pd.Timedelta(seconds=np.random.uniform(0., delta.total_seconds()))
     t = start + offset
     if round_to_hour:
         t = pd.Timestamp(t.date()) + pd.offsets.Hour(t.hour)  # round to hour